@@ -1,12 +1,184 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Key
 import os
+import base64
+import gzip
+import hashlib
+import hmac
+import re
+import time
+from collections import OrderedDict
 from decimal import Decimal
+from urllib.parse import quote
+from instrumentation import Metrics, StartupProfile, get_logger, mark_invocation
+from metadata_table import (
+    CONTENT_HASH_INDEX, PHASH_BAND_INDEX, PHASH_BANDS, USER_ID_INDEX, deserialize_item, image_key, phash_band_keys,
+    phash_bands, phash_entries, rendition_object_bytes, rendition_object_keys, serialize, serialize_item,
+    status_row_id, user_summary_id
+)
 
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.client('s3')
-table = dynamodb.Table(os.environ['METADATA_TABLE'])
+# STARTUP_PROFILE=true prints how long each of these phases took on a cold start
+startup = StartupProfile('image-api')
+with startup.phase('import_boto3'):
+    import boto3
+try:
+    # Not in the Lambda runtime; bundle it to offer br next to gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+TABLE_NAME = os.environ['METADATA_TABLE']
+logger = get_logger('image-api')
+
+# Low-level clients are created on first use and kept for warm invocations, so
+# their connection pools are reused. The GET path never builds the S3 client or
+# the boto3 resource layer; items are (de)serialized by the metadata_table helpers.
+_clients = {}
+# Credentials and the day's SigV4 signing key for presigned URLs, kept for warm invocations
+_credentials = None
+_signing_key = None
+
+# Pagination settings for the image listing
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '500'))
+# Upper bound on DynamoDB round trips per page when the status filter drops items
+MAX_QUERY_ROUNDS = 5
+# Items read per round when search filters are set, so selective filters still fill pages
+FILTERED_READ_SIZE = int(os.environ.get('FILTERED_READ_SIZE', '200'))
+# Attributes format_image needs; nothing else is read from the index
+LISTING_ATTRIBUTES = (
+    'image_id', 'user_id', 'original_key', 'thumbnail_key', 'original_name', 'upload_time', 'processed_time',
+    'original_size', 'original_width', 'original_height', 'thumbnail_width', 'thumbnail_height',
+    'content_type', 'placeholder', 'dominant_color', 'renditions'
+)
+# Listing fields a client may select with fields= -> attributes they are built from.
+# The id is always returned, and the cursor needs the index keys of the last item.
+IMAGE_FIELDS = {
+    'id': ('image_id',),
+    'originalKey': ('original_key',),
+    'thumbnailKey': ('thumbnail_key',),
+    'thumbnailUrl': ('thumbnail_key',),
+    'originalName': ('original_name', 'original_key'),
+    'uploadTime': ('upload_time',),
+    'processedTime': ('processed_time',),
+    'size': ('original_size',),
+    'originalWidth': ('original_width',),
+    'originalHeight': ('original_height',),
+    'thumbnailWidth': ('thumbnail_width',),
+    'thumbnailHeight': ('thumbnail_height',),
+    'contentType': ('content_type',),
+    'placeholder': ('placeholder',),
+    'dominantColor': ('dominant_color',),
+    'renditions': ('renditions',)
+}
+CURSOR_ATTRIBUTES = ('image_id', 'user_id', 'upload_time')
+# Response shapes: full URLs on every image, or URLs relative to one urlBase with nulls left out
+RESPONSE_FORMATS = ('full', 'compact')
+# ISO 8601 timestamps or a leading part of one (2024, 2024-06, 2024-06-01T12)
+UPLOAD_TIME_PATTERN = re.compile(r'^\d{4}(-\d{2}(-\d{2}([T ][\d:.]*(Z|[+-]\d{2}:?\d{2})?)?)?)?$')
+# Numeric search parameters -> (attribute, comparison)
+DIMENSION_FILTERS = {
+    'min_width': ('original_width', '>='),
+    'max_width': ('original_width', '<='),
+    'min_height': ('original_height', '>='),
+    'max_height': ('original_height', '<=')
+}
+# Serialized listing pages kept by a warm container (0 entries disables the cache)
+LISTING_CACHE_MAX_ENTRIES = int(os.environ.get('LISTING_CACHE_MAX_ENTRIES', '256'))
+LISTING_CACHE_MAX_BYTES = int(os.environ.get('LISTING_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+LISTING_CACHE_TTL_SECONDS = float(os.environ.get('LISTING_CACHE_TTL_SECONDS', '300'))
+# Listing bodies smaller than this are sent uncompressed whatever the client accepts
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+# Moderate levels: each page is compressed once per version and encoding, then served from the cache
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Values reaching the encoder are plain str/int/float/list/dict (deserialize turns
+# numbers into int or float), so no default hook or circular check is needed
+json_encoder = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':'))
+
+LISTING_CACHE_CONTROL = 'private, max-age=0, must-revalidate'
+# Optional per-user limits reported by the stats endpoint (0 = unlimited)
+USER_QUOTA_IMAGES = int(os.environ.get('USER_QUOTA_IMAGES', '0'))
+USER_QUOTA_BYTES = int(os.environ.get('USER_QUOTA_BYTES', '0'))
+# Hamming distance up to which two images count as near-duplicates; the banded
+# index finds every match closer than PHASH_BANDS bits
+SIMILAR_MAX_DISTANCE = min(int(os.environ.get('SIMILAR_MAX_DISTANCE', '6')), PHASH_BANDS - 1)
+DEFAULT_SIMILAR_LIMIT = 20
+# Long-poll bounds for the status endpoint (API Gateway gives up after 29 seconds)
+MAX_STATUS_WAIT_SECONDS = int(os.environ.get('MAX_STATUS_WAIT_SECONDS', '20'))
+STATUS_POLL_INITIAL_DELAY = 0.25
+STATUS_POLL_MAX_DELAY = 2.0
+
+# Batch delete limits (BatchGetItem takes 100 keys, DeleteObjects takes 1000)
+MAX_BATCH_DELETE = int(os.environ.get('MAX_BATCH_DELETE', '1000'))
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+S3_DELETE_BATCH_SIZE = 1000
+
+# Presigned URLs for originals. A cached URL is handed out again only while at
+# least ORIGINAL_URL_MIN_REMAINING_SECONDS of its lifetime is left.
+ORIGINAL_URL_EXPIRES_SECONDS = int(os.environ.get('ORIGINAL_URL_EXPIRES_SECONDS', '3600'))
+ORIGINAL_URL_MIN_REMAINING_SECONDS = int(os.environ.get('ORIGINAL_URL_MIN_REMAINING_SECONDS', '900'))
+ORIGINAL_URL_CACHE_MAX_ENTRIES = int(os.environ.get('ORIGINAL_URL_CACHE_MAX_ENTRIES', '10000'))
+# Image IDs per request: one BatchGetItem
+MAX_ORIGINAL_URLS = BATCH_GET_SIZE
+ORIGINAL_URL_ATTRIBUTES = 'image_id, user_id, original_bucket, original_key, original_name, original_size, content_type'
+
+def get_client(service):
+    """Cached low-level boto3 client for a service, created on first use"""
+    client = _clients.get(service)
+    if client is None:
+        with startup.phase(f"{service}_client"):
+            client = boto3.client(service)
+        _clients[service] = client
+    return client
+
+def get_credentials():
+    """The container's AWS credentials as boto3 resolves them (the function role's, in Lambda)"""
+    global _credentials
+    if _credentials is None:
+        _credentials = boto3.Session().get_credentials()
+    # Frozen per call, so refreshed credentials are picked up
+    return _credentials.get_frozen_credentials()
+
+def presign_get_url(bucket, key, expires_in, now):
+    """SigV4 query-string signed GET URL for an S3 object, computed locally
+
+    Same result as the S3 client's generate_presigned_url, without building an
+    S3 client. The signing key only changes daily, so it is derived once and
+    reused. Only the host header is signed, so the URL also serves Range requests.
+    """
+    global _signing_key
+    credentials = get_credentials()
+    region = os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1')
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))
+    datestamp = amz_date[:8]
+    scope = f"{datestamp}/{region}/s3/aws4_request"
+    
+    if _signing_key is None or _signing_key[0] != (credentials.secret_key, datestamp, region):
+        signing_key = f"AWS4{credentials.secret_key}".encode('utf-8')
+        for part in (datestamp, region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+        _signing_key = ((credentials.secret_key, datestamp, region), signing_key)
+    
+    host = f"{bucket}.s3.{region}.amazonaws.com"
+    path = quote(f"/{key}", safe='/~')
+    params = {
+        'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+        'X-Amz-Credential': f"{credentials.access_key}/{scope}",
+        'X-Amz-Date': amz_date,
+        'X-Amz-Expires': str(expires_in),
+        'X-Amz-SignedHeaders': 'host'
+    }
+    if credentials.token:
+        params['X-Amz-Security-Token'] = credentials.token
+    query = '&'.join(f"{name}={quote(value, safe='-_.~')}" for name, value in sorted(params.items()))
+    canonical_request = f"GET\n{path}\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+    ])
+    signature = hmac.new(_signing_key[1], string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"https://{host}{path}?{query}&X-Amz-Signature={signature}"
 
 def decimal_default(obj):
     """JSON serializer for DynamoDB Decimal types"""
@@ -14,15 +186,427 @@ def decimal_default(obj):
         return float(obj)
     raise TypeError
 
+def encode_cursor(last_evaluated_key):
+    """Turn a DynamoDB LastEvaluatedKey into an opaque URL-safe cursor"""
+    if not last_evaluated_key:
+        return None
+    raw = json.dumps(deserialize_item(last_evaluated_key), default=decimal_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, user_id):
+    """Turn a cursor produced by encode_cursor for user_id's listing back into an ExclusiveStartKey
+
+    Anything else would reach DynamoDB as a start key it rejects, so it is
+    refused here: exactly the listing index's key attributes, all strings, in
+    this user's partition.
+    """
+    padded = cursor + '=' * (-len(cursor) % 4)
+    key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    if not isinstance(key, dict) or set(key) != set(CURSOR_ATTRIBUTES) or \
+            not all(isinstance(value, str) for value in key.values()):
+        raise ValueError('cursor does not contain a valid key')
+    if key['user_id'] != user_id:
+        raise ValueError('cursor belongs to another listing')
+    return serialize_item(key)
+
+def parse_page_size(value):
+    """Validate the limit query parameter and clamp it to MAX_PAGE_SIZE"""
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return min(limit, MAX_PAGE_SIZE)
+
+def parse_listing_filters(query_params):
+    """Build the key condition, filter and values of a listing query from its search parameters
+
+    Upload-time bounds narrow the key condition on the upload_time sort key, so
+    DynamoDB only reads that slice of the index. A partial timestamp bound covers
+    the whole period it names: uploaded_from=2024-06&uploaded_to=2024-06 is June.
+    Content type and dimensions become a FilterExpression.
+    """
+    key_condition = 'user_id = :user_id'
+    filters = ['attribute_exists(thumbnail_key)', '#status = :status']
+    values = {':status': {'S': 'processed'}}
+
+    bounds = {}
+    for name in ('uploaded_from', 'uploaded_to'):
+        value = query_params.get(name)
+        if value:
+            if not UPLOAD_TIME_PATTERN.match(value):
+                raise ValueError(f'{name} must be an ISO 8601 date or timestamp')
+            bounds[name] = value
+    if 'uploaded_to' in bounds:
+        # '~' sorts after every character of an ISO timestamp, so the bound is inclusive of its period
+        bounds['uploaded_to'] += '~'
+    if len(bounds) == 2:
+        if bounds['uploaded_from'] > bounds['uploaded_to']:
+            raise ValueError('uploaded_from must not be after uploaded_to')
+        key_condition += ' AND upload_time BETWEEN :uploaded_from AND :uploaded_to'
+    elif 'uploaded_from' in bounds:
+        key_condition += ' AND upload_time >= :uploaded_from'
+    elif 'uploaded_to' in bounds:
+        key_condition += ' AND upload_time <= :uploaded_to'
+    values.update({f":{name}": {'S': value} for name, value in bounds.items()})
+
+    content_types = [value.strip().lower() for value in (query_params.get('content_type') or '').split(',') if value.strip()]
+    if content_types:
+        placeholders = [f":content_type{index}" for index in range(len(content_types))]
+        filters.append(f"content_type IN ({', '.join(placeholders)})")
+        values.update({placeholder: {'S': value} for placeholder, value in zip(placeholders, content_types)})
+
+    for name, (attribute, operator) in DIMENSION_FILTERS.items():
+        value = query_params.get(name)
+        if value not in (None, ''):
+            if not value.isdigit():
+                raise ValueError(f'{name} must be a non-negative integer')
+            filters.append(f"{attribute} {operator} :{name}")
+            values[f":{name}"] = {'N': value}
+
+    # Only filters (not the key condition) can drop items from a round
+    filtered = len(filters) > 2
+    return key_condition, ' AND '.join(filters), values, filtered
+
+def parse_fields(value):
+    """Validate the fields query parameter; None selects every field"""
+    if value in (None, ''):
+        return None
+    fields = ['id']
+    for name in value.split(','):
+        name = name.strip()
+        if name not in IMAGE_FIELDS:
+            raise ValueError(f"unknown field '{name}'; choose from {', '.join(IMAGE_FIELDS)}")
+        if name not in fields:
+            fields.append(name)
+    return tuple(fields)
+
+def listing_projection(fields, collapse):
+    """ProjectionExpression of a listing query: the selected fields' attributes plus the cursor keys"""
+    if fields is None:
+        attributes = list(LISTING_ATTRIBUTES)
+    else:
+        attributes = list(CURSOR_ATTRIBUTES)
+        for name in fields:
+            attributes.extend(attribute for attribute in IMAGE_FIELDS[name] if attribute not in attributes)
+    if collapse:
+        attributes.append('phash')
+    return ', '.join(attributes)
+
+def parse_response_format(value):
+    """Validate the format query parameter of the listing"""
+    if value in (None, ''):
+        return 'full'
+    if value not in RESPONSE_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(RESPONSE_FORMATS)}")
+    return value
+
+def choose_encoding(accept_encoding):
+    """Best content coding this function can produce for an Accept-Encoding header, or None"""
+    weights = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.partition(';')
+        weight = 1.0
+        for param in params.split(';'):
+            name, _, number = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    weight = float(number)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+    # Ties go to br, which is smaller at a similar cost
+    available = ('br', 'gzip') if brotli else ('gzip',)
+    best = max(available, key=lambda coding: weights.get(coding, weights.get('*', 0.0)))
+    return best if weights.get(best, weights.get('*', 0.0)) > 0 else None
+
+def compress_body(body, encoding):
+    """Encode a response body for the client; returns the body and its Content-Encoding (None if sent as is)"""
+    raw = body.encode('utf-8')
+    if encoding is None or len(raw) < COMPRESSION_MIN_BYTES:
+        return body, None
+    if encoding == 'br':
+        data = brotli.compress(raw, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(raw, GZIP_LEVEL, mtime=0)
+    # API Gateway decodes base64 bodies flagged isBase64Encoded back to bytes
+    return base64.b64encode(data).decode('ascii'), encoding
+
+def parse_max_distance(value):
+    """Validate the max_distance query parameter of near-duplicate lookups"""
+    if value in (None, ''):
+        return SIMILAR_MAX_DISTANCE
+    if not value.isdigit() or int(value) >= PHASH_BANDS:
+        raise ValueError(f'max_distance must be an integer from 0 to {PHASH_BANDS - 1}')
+    return int(value)
+
+def hamming_distance(left, right):
+    """Number of differing bits between two hex perceptual hashes"""
+    return bin(int(left, 16) ^ int(right, 16)).count('1')
+
+def find_similar_ids(user_id, image_id, phash, max_distance):
+    """(distance, image_id) pairs of indexed images within max_distance of phash, closest first"""
+    matches = {}
+    for band_key in phash_band_keys(user_id, phash):
+        query_kwargs = {
+            'TableName': TABLE_NAME,
+            'IndexName': PHASH_BAND_INDEX,
+            'KeyConditionExpression': 'phash_band = :band',
+            'ExpressionAttributeValues': {':band': {'S': band_key}},
+            'ProjectionExpression': 'target_image_id, phash'
+        }
+        while True:
+            response = get_client('dynamodb').query(**query_kwargs)
+            for entry in response.get('Items', []):
+                other_id, other_phash = entry['target_image_id']['S'], entry['phash']['S']
+                if other_id != image_id and other_id not in matches:
+                    distance = hamming_distance(phash, other_phash)
+                    if distance <= max_distance:
+                        matches[other_id] = distance
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return sorted((distance, other_id) for other_id, distance in matches.items())
+
+def collapse_near_duplicates(images, max_distance):
+    """Fold every image into the newest earlier image of the page within max_distance
+
+    Returns the images that are kept, each with a 'similar' list of the image_ids
+    folded into it. Candidates come from per-band buckets of the kept hashes, so
+    a page is not compared pair by pair.
+    """
+    kept = []
+    buckets = {}
+    for image in images:
+        phash = image.get('phash')
+        if phash:
+            bands = list(enumerate(phash_bands(phash)))
+            candidates = {position for band in bands for position in buckets.get(band, ())}
+            match = next(
+                (position for position in sorted(candidates)
+                 if hamming_distance(phash, kept[position]['phash']) <= max_distance),
+                None
+            )
+            if match is not None:
+                kept[match]['similar'].append(image['image_id'])
+                continue
+            for band in bands:
+                buckets.setdefault(band, []).append(len(kept))
+        image['similar'] = []
+        kept.append(image)
+    return kept
+
+def get_user_version(user_id):
+    """Current listing version of a user; bumped by every write that changes the listing"""
+    response = get_client('dynamodb').get_item(
+        TableName=TABLE_NAME,
+        Key=image_key(user_summary_id(user_id)),
+        ProjectionExpression='#version',
+        ExpressionAttributeNames={'#version': 'version'},
+        ConsistentRead=True
+    )
+    return int(response.get('Item', {}).get('version', {}).get('N', 0))
+
+def bump_user_version(user_id, removed=(), kept_keys=frozenset()):
+    """Atomically increment the user's listing version so cached ETags stop matching
+
+    The usage totals of the removed rows are subtracted in the same update.
+    Thumbnail objects still referenced by other rows (kept_keys) stay counted.
+    """
+    counted = [item for item in removed if item.get('status') == 'processed']
+    released = {}
+    for item in counted:
+        released.update(rendition_object_bytes(item))
+    try:
+        get_client('dynamodb').update_item(
+            TableName=TABLE_NAME,
+            Key=image_key(user_summary_id(user_id)),
+            UpdateExpression='ADD #version :one, image_count :images, original_bytes :original, thumbnail_bytes :thumbnail',
+            ExpressionAttributeNames={'#version': 'version'},
+            ExpressionAttributeValues={
+                ':one': {'N': '1'},
+                ':images': serialize(-len(counted)),
+                ':original': serialize(-sum(item.get('original_size', 0) for item in counted)),
+                ':thumbnail': serialize(-sum(size for key, size in released.items() if key not in kept_keys))
+            }
+        )
+    except Exception as version_error:
+        logger.error("Failed to bump listing version for %s: %s", user_id, version_error)
+    # Pages cached by this container are stale even if the bump failed, and
+    # URLs of deleted originals must not be handed out again
+    listing_cache.invalidate(user_id)
+    original_url_cache.invalidate(user_id)
+
+class ListingCache:
+    """Size-bounded LRU of encoded listing pages, keyed by user, query parameters and encoding
+
+    Every entry remembers the listing version it was built from. The version is
+    read on each request anyway (for the ETag), so a page built before the
+    user's latest write is never served; TTL and the byte cap only bound memory.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(user_id, query_params, encoding=None):
+        return user_id, json.dumps(sorted(query_params.items())), encoding
+
+    def get(self, user_id, query_params, version, encoding=None):
+        """Cached (body, content encoding) for this page at this version, or None"""
+        key = self.key(user_id, query_params, encoding)
+        entry = self.entries.get(key)
+        if entry is not None:
+            body, content_encoding, entry_version, expires = entry
+            if entry_version != version:
+                # The user has written since; none of their pages are current
+                self.invalidate(user_id)
+            elif expires < time.monotonic():
+                self._remove(key)
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body, content_encoding
+        self.misses += 1
+        return None
+
+    def put(self, user_id, query_params, version, body, content_encoding=None, encoding=None):
+        """Store a page, evicting least recently used entries to stay within the caps"""
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+        key = self.key(user_id, query_params, encoding)
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (body, content_encoding, version, time.monotonic() + self.ttl_seconds)
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        """Drop every cached page of a user"""
+        for key in [key for key in self.entries if key[0] == user_id]:
+            self._remove(key)
+
+    def _remove(self, key):
+        body, _, _, _ = self.entries.pop(key)
+        self.size -= len(body)
+
+# Lives as long as the container, so warm invocations share it
+listing_cache = ListingCache(LISTING_CACHE_MAX_ENTRIES, LISTING_CACHE_MAX_BYTES, LISTING_CACHE_TTL_SECONDS)
+
+class SignedUrlCache:
+    """LRU of presigned original URLs issued by this container, keyed by user and image ID
+
+    Ownership was checked when a URL was signed, so a hit needs no DynamoDB
+    read. Entries are dropped once less than min_remaining seconds of their
+    lifetime is left, so a client never gets a URL that is about to expire.
+    """
+
+    def __init__(self, max_entries, min_remaining):
+        self.max_entries = max_entries
+        self.min_remaining = min_remaining
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, image_id, now):
+        """Cached URL object for this image, or None"""
+        key = (user_id, image_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            original, expires = entry
+            if expires - now >= self.min_remaining:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return original
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, user_id, image_id, original, expires):
+        """Store a freshly signed URL, evicting the least recently used ones"""
+        if self.max_entries <= 0:
+            return
+        key = (user_id, image_id)
+        self.entries.pop(key, None)
+        self.entries[key] = (original, expires)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop every URL issued for a user's images"""
+        for key in [key for key in self.entries if key[0] == user_id]:
+            del self.entries[key]
+
+original_url_cache = SignedUrlCache(ORIGINAL_URL_CACHE_MAX_ENTRIES, ORIGINAL_URL_MIN_REMAINING_SECONDS)
+
+def make_listing_etag(user_id, version, query_params, encoding=None):
+    """ETag for one listing page: the user's version plus a digest of the query
+
+    Each content coding is a different representation, so it gets its own tag.
+    """
+    digest = hashlib.sha1(json.dumps([user_id, sorted(query_params.items())]).encode('utf-8')).hexdigest()[:16]
+    return f'"{version}-{digest}-{encoding}"' if encoding else f'"{version}-{digest}"'
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches etag (weak comparison)"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in [candidate[2:] if candidate.startswith('W/') else candidate for candidate in candidates]
+
+def listing_response(headers, etag, body, content_encoding):
+    """200 response carrying a listing page, compressed or not"""
+    response = {
+        'statusCode': 200,
+        'headers': {**headers, 'ETag': etag, 'Cache-Control': LISTING_CACHE_CONTROL, 'Vary': 'Accept-Encoding'},
+        'body': body
+    }
+    if content_encoding:
+        response['headers']['Content-Encoding'] = content_encoding
+        response['isBase64Encoded'] = True
+    return response
+
+def get_header(event, name):
+    """Case-insensitive request header lookup"""
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
 def lambda_handler(event, context):
-    print(f"Received event: {json.dumps(event)}")
+    cold_start = mark_invocation()
+    metrics = Metrics('image-api', cold_start)
+    metrics.set_property('HttpMethod', event.get('httpMethod'))
+    metrics.set_property('Resource', event.get('resource'))
+    with metrics.stage('total'):
+        response = handle_request(event, context, metrics)
+    metrics.set_property('StatusCode', response['statusCode'])
+    if cold_start:
+        metrics.add('init_ms', startup.init_ms, 'Milliseconds')
+    metrics.flush()
+    startup.report()
+    return response
+
+def handle_request(event, context, metrics):
+    """Route an API Gateway proxy event to the matching operation"""
+    logger.debug("Received event: %s", event)
     
     try:
         # Enable CORS
         headers = {
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-            'Access-Control-Allow-Methods': 'GET,POST,DELETE,OPTIONS'
+            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,If-None-Match',
+            'Access-Control-Allow-Methods': 'GET,POST,DELETE,OPTIONS',
+            'Access-Control-Expose-Headers': 'ETag'
         }
         
         # Handle preflight requests
@@ -51,21 +635,45 @@ def lambda_handler(event, context):
                 })
             }
         
+        query_params = event.get('queryStringParameters') or {}
+        
         # Handle different HTTP methods
-        if event['httpMethod'] == 'GET':
-            return get_user_images(user_id, headers)
+        if event['httpMethod'] == 'GET' and event.get('resource', '').endswith('/status'):
+            return get_upload_status(user_id, query_params, headers, metrics, context)
+        elif event['httpMethod'] == 'GET' and event.get('resource', '').endswith('/stats'):
+            return get_user_stats(user_id, query_params, headers, metrics)
+        elif event['httpMethod'] == 'GET' and event.get('resource', '').endswith('/similar'):
+            return get_similar_images(user_id, path_params.get('image_id'), query_params, headers, metrics)
+        elif event['httpMethod'] == 'GET' and event.get('resource', '').endswith('/originals'):
+            return get_original_urls(user_id, query_params, headers, metrics)
+        elif event['httpMethod'] == 'GET':
+            return get_user_images(user_id, headers, metrics, query_params, get_header(event, 'If-None-Match'),
+                                   get_header(event, 'Accept-Encoding'))
         elif event['httpMethod'] == 'DELETE':
             image_id = path_params.get('image_id')
             if not image_id:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'error': 'image_id is required for DELETE operation',
-                        'message': 'Please provide image_id in path parameters'
-                    })
-                }
-            return delete_user_image(user_id, image_id, headers)
+                # DELETE on the collection removes every image listed in the body.
+                # The API treats every media type as binary (so listings can be
+                # sent compressed), which makes request bodies arrive base64 encoded.
+                try:
+                    raw_body = event.get('body') or '{}'
+                    if event.get('isBase64Encoded'):
+                        raw_body = base64.b64decode(raw_body).decode('utf-8')
+                    body = json.loads(raw_body)
+                except ValueError:
+                    body = {}
+                image_ids = body.get('image_ids') if isinstance(body, dict) else None
+                if not image_ids or not isinstance(image_ids, list):
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({
+                            'error': 'image_id is required for DELETE operation',
+                            'message': 'Please provide image_id in path parameters or an image_ids list in the request body'
+                        })
+                    }
+                return delete_user_images(user_id, image_ids, headers, metrics)
+            return delete_user_image(user_id, image_id, headers, metrics)
         else:
             return {
                 'statusCode': 405,
@@ -74,9 +682,7 @@ def lambda_handler(event, context):
             }
             
     except Exception as e:
-        print(f"Error: {str(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error handling request: %s", e)
         return {
             'statusCode': 500,
             'headers': {
@@ -90,86 +696,298 @@ def lambda_handler(event, context):
             })
         }
 
-def get_user_images(user_id, headers):
-    """Fetch all images for a specific user"""
+def thumbnail_url_base(thumbnail_bucket, region):
+    """Public URL prefix of the thumbnail bucket"""
+    return f"https://{thumbnail_bucket}.s3.{region}.amazonaws.com/"
+
+def format_image(image, url_base, fields=None, compact=False):
+    """Shape a metadata item into the camelCase image object returned by the API
+
+    fields limits the object to those keys. Compact objects leave out null values
+    and carry URLs relative to url_base, which the page sends once.
+    """
+    if compact:
+        url_base = ''
+    thumbnail_key = image.get('thumbnail_key')
+    
+    formatted = {
+        'id': image['image_id'],
+        'originalKey': image.get('original_key'),
+        'thumbnailKey': thumbnail_key,
+        'thumbnailUrl': url_base + thumbnail_key if thumbnail_key else None,
+        'originalName': image.get('original_name', image.get('original_key')),
+        'uploadTime': image.get('upload_time'),
+        'processedTime': image.get('processed_time'),
+        'size': image.get('original_size', 0),
+        'originalWidth': image.get('original_width'),
+        'originalHeight': image.get('original_height'),
+        'thumbnailWidth': image.get('thumbnail_width'),
+        'thumbnailHeight': image.get('thumbnail_height'),
+        'contentType': image.get('content_type', 'image/jpeg'),
+        # Inline preview (data URI) and background colour for painting the grid before thumbnails load
+        'placeholder': image.get('placeholder'),
+        'dominantColor': image.get('dominant_color'),
+        'renditions': [
+            {
+                'size': rendition['size'],
+                'url': url_base + rendition['key'],
+                'width': rendition['width'],
+                'height': rendition['height'],
+                'bytes': rendition['bytes'],
+                'contentType': rendition.get('content_type'),
+                # Modern encodings for <picture>/srcset; the url above is the fallback
+                'formats': [
+                    {
+                        'format': variant['format'],
+                        'contentType': variant['content_type'],
+                        'url': url_base + variant['key'],
+                        'bytes': variant['bytes']
+                    }
+                    for variant in rendition.get('formats', [])
+                ]
+            }
+            for rendition in image.get('renditions', [])
+        ]
+    }
+    if fields is not None:
+        formatted = {name: formatted[name] for name in fields}
+    if compact:
+        formatted = {name: value for name, value in formatted.items() if value is not None}
+    return formatted
+
+def get_user_images(user_id, headers, metrics, query_params=None, if_none_match=None, accept_encoding=None):
+    """Fetch one page of a user's images, newest first"""
+    query_params = query_params or {}
     try:
-        print(f"Querying DynamoDB for user_id: {user_id}")
+        encoding = choose_encoding(accept_encoding)
+        # A single small read decides whether anything changed since the
+        # client's copy; if not, the library is never queried
+        with metrics.stage('version_read'):
+            version = get_user_version(user_id)
+        etag = make_listing_etag(user_id, version, query_params, encoding)
+        if etag_matches(if_none_match, etag):
+            return {
+                'statusCode': 304,
+                'headers': {**headers, 'ETag': etag, 'Cache-Control': LISTING_CACHE_CONTROL, 'Vary': 'Accept-Encoding'},
+                'body': ''
+            }
         
-        # First, let's try to scan all items to see what's in the table (for debugging)
-        try:
-            scan_response = table.scan(Limit=5)
-            print(f"Sample items in table: {scan_response.get('Items', [])}")
-        except Exception as scan_error:
-            print(f"Error scanning table: {scan_error}")
+        cached = listing_cache.get(user_id, query_params, version, encoding)
+        metrics.add('listing_cache_hits', 1 if cached is not None else 0, 'Count')
+        metrics.add('listing_cache_misses', 0 if cached is not None else 1, 'Count')
+        metrics.add('listing_cache_bytes', listing_cache.size, 'Bytes')
+        # Container-lifetime totals, for sizing the cache against real traffic
+        metrics.set_property('ListingCache', {
+            'entries': len(listing_cache.entries),
+            'hits': listing_cache.hits,
+            'misses': listing_cache.misses,
+            'evictions': listing_cache.evictions
+        })
+        if cached is not None:
+            return listing_response(headers, etag, *cached)
         
-        # Query DynamoDB for user's images using GSI
         try:
-            response = table.query(
-                IndexName='user-id-index',
-                KeyConditionExpression=Key('user_id').eq(user_id),
-                ScanIndexForward=False,  # Sort by sort key descending (newest first)
-                FilterExpression='attribute_exists(thumbnail_key) AND #status = :status',
-                ExpressionAttributeNames={'#status': 'status'},
-                ExpressionAttributeValues={':status': 'processed'}
-            )
-            print(f"Query response: {response}")
-        except Exception as query_error:
-            print(f"GSI query failed: {query_error}")
-            # Try a scan as fallback
-            print(f"Trying scan as fallback...")
-            response = table.scan(
-                FilterExpression='user_id = :user_id AND attribute_exists(thumbnail_key) AND #status = :status',
-                ExpressionAttributeNames={'#status': 'status'},
-                ExpressionAttributeValues={
-                    ':user_id': user_id,
-                    ':status': 'processed'
-                }
-            )
-            print(f"Scan response: {response}")
+            limit = parse_page_size(query_params.get('limit'))
+            cursor = query_params.get('cursor')
+            exclusive_start_key = decode_cursor(cursor, user_id) if cursor else None
+        except (ValueError, TypeError) as param_error:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Invalid pagination parameters',
+                    'message': str(param_error)
+                })
+            }
+        try:
+            key_condition, filter_expression, values, filtered = parse_listing_filters(query_params)
+            collapse = (query_params.get('collapse') or '').lower() in ('true', '1')
+            max_distance = parse_max_distance(query_params.get('max_distance'))
+            fields = parse_fields(query_params.get('fields'))
+            compact = parse_response_format(query_params.get('format')) == 'compact'
+        except ValueError as filter_error:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Invalid search parameters',
+                    'message': str(filter_error)
+                })
+            }
+        
+        # Query the user-upload-time-index GSI, which is sorted by upload_time, so
+        # DynamoDB returns newest first. Filters are applied after the read, so a round can
+        # come back short; keep reading until the page is full or the index is
+        # exhausted. Unfiltered rounds never read more items than are still needed.
+        # Filtered rounds read FILTERED_READ_SIZE items so selective searches do not
+        # crawl; surplus matches are cut and the cursor points at the last one kept,
+        # so the returned cursor never skips images either way.
+        images = []
+        last_evaluated_key = exclusive_start_key
+        rounds = 0
+        while len(images) < limit and rounds < MAX_QUERY_ROUNDS:
+            query_kwargs = {
+                'TableName': TABLE_NAME,
+                'IndexName': USER_ID_INDEX,
+                'KeyConditionExpression': key_condition,
+                'ScanIndexForward': False,  # Sort by upload_time descending (newest first)
+                'FilterExpression': filter_expression,
+                'ProjectionExpression': listing_projection(fields, collapse),
+                'ExpressionAttributeNames': {'#status': 'status'},
+                'ExpressionAttributeValues': {':user_id': {'S': user_id}, **values},
+                'Limit': max(limit - len(images), FILTERED_READ_SIZE) if filtered else limit - len(images)
+            }
+            if last_evaluated_key:
+                query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+            
+            with metrics.stage('query'):
+                response = get_client('dynamodb').query(**query_kwargs)
+            images.extend(deserialize_item(item) for item in response.get('Items', []))
+            last_evaluated_key = response.get('LastEvaluatedKey')
+            rounds += 1
+            
+            if not last_evaluated_key:
+                break
         
-        images = response['Items']
-        print(f"Found {len(images)} images for user {user_id}")
+        if len(images) > limit:
+            images = images[:limit]
+            last_kept = images[-1]
+            last_evaluated_key = serialize_item({
+                'image_id': last_kept['image_id'],
+                'user_id': last_kept['user_id'],
+                'upload_time': last_kept['upload_time']
+            })
         
-        # Process images to add thumbnail URLs and format data
-        processed_images = []
-        thumbnail_bucket = os.environ.get('THUMBNAIL_BUCKET')
-        # AWS_DEFAULT_REGION is available in Lambda, or use fallback
-        region = os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1')
+        if collapse:
+            # Bursts are uploaded together, so their shots sit next to each other on a page
+            images = collapse_near_duplicates(images, max_distance)
         
-        for image in images:
-            print(f"Processing image: {image}")
-            
-            thumbnail_url = f"https://{thumbnail_bucket}.s3.{region}.amazonaws.com/{image['thumbnail_key']}"
+        metrics.add('query_rounds', rounds, 'Count')
+        metrics.add('items_returned', len(images), 'Count')
+        logger.debug("Found %d images for user %s in %d round(s)", len(images), user_id, rounds)
+        
+        with metrics.stage('serialize'):
+            # Process images to add thumbnail URLs and format data
+            thumbnail_bucket = os.environ.get('THUMBNAIL_BUCKET')
+            # AWS_DEFAULT_REGION is available in Lambda, or use fallback
+            region = os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1')
+            url_base = thumbnail_url_base(thumbnail_bucket, region)
+            processed_images = [format_image(image, url_base, fields, compact) for image in images]
+            if collapse:
+                for formatted, image in zip(processed_images, images):
+                    formatted['similarIds'] = image['similar']
             
-            processed_image = {
-                'id': image['image_id'],
-                'originalKey': image['original_key'],
-                'thumbnailKey': image['thumbnail_key'],
-                'thumbnailUrl': thumbnail_url,
-                'originalName': image.get('original_name', image['original_key']),
-                'uploadTime': image['upload_time'],
-                'processedTime': image.get('processed_time'),
-                'size': image.get('original_size', 0),
-                'originalWidth': image.get('original_width'),
-                'originalHeight': image.get('original_height'),
-                'thumbnailWidth': image.get('thumbnail_width'),
-                'thumbnailHeight': image.get('thumbnail_height'),
-                'contentType': image.get('content_type', 'image/jpeg')
+            result = {
+                'images': processed_images,
+                'count': len(processed_images),
+                'user_id': user_id,
+                'next_cursor': encode_cursor(last_evaluated_key),
+                'has_more': last_evaluated_key is not None
             }
-            
-            processed_images.append(processed_image)
-            print(f"Processed image: {processed_image}")
+            if compact:
+                result['urlBase'] = url_base
+            body = json_encoder.encode(result)
+        metrics.add('body_bytes', len(body), 'Bytes')
+        with metrics.stage('compress'):
+            body, content_encoding = compress_body(body, encoding)
+        metrics.add('response_bytes', len(body), 'Bytes')
+        listing_cache.put(user_id, query_params, version, body, content_encoding, encoding)
+        
+        return listing_response(headers, etag, body, content_encoding)
         
-        # Sort by upload time (newest first)
-        processed_images.sort(key=lambda x: x['uploadTime'], reverse=True)
+    except Exception as e:
+        logger.exception("Error fetching images for user %s: %s", user_id, e)
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Failed to fetch images',
+                'message': str(e),
+                'user_id': user_id
+            })
+        }
+
+def get_status_row(user_id, original_key):
+    """Processing status row the resizer writes for each original key"""
+    response = get_client('dynamodb').get_item(
+        TableName=TABLE_NAME,
+        Key=image_key(status_row_id(user_id, original_key)),
+        ConsistentRead=True
+    )
+    return deserialize_item(response.get('Item'))
+
+def get_image_status(user_id, original_key, wait_seconds, context=None):
+    """Look up one upload's status, optionally waiting until it is processed or failed"""
+    deadline = time.monotonic() + wait_seconds
+    if context is not None:
+        # Leave room to build the response before the Lambda itself times out
+        deadline = min(deadline, time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 2)
+    
+    delay = STATUS_POLL_INITIAL_DELAY
+    while True:
+        status_row = get_status_row(user_id, original_key)
+        if status_row and status_row.get('status') in ('processed', 'error'):
+            return status_row
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return status_row
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, STATUS_POLL_MAX_DELAY)
+
+def get_upload_status(user_id, query_params, headers, metrics, context=None):
+    """Report whether a single upload has been processed, by its original key"""
+    try:
+        original_key = query_params.get('original_key')
+        if not original_key:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'original_key is required',
+                    'message': 'Please provide original_key in query parameters'
+                })
+            }
+        try:
+            wait_seconds = min(max(float(query_params.get('wait') or 0), 0), MAX_STATUS_WAIT_SECONDS)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Invalid wait parameter',
+                    'message': 'wait must be a number of seconds'
+                })
+            }
         
+        with metrics.stage('status_wait'):
+            status_row = get_image_status(user_id, original_key, wait_seconds, context)
         result = {
-            'images': processed_images,
-            'count': len(processed_images),
-            'user_id': user_id
+            'original_key': original_key,
+            'status': status_row.get('status', 'pending') if status_row else 'pending'
         }
+        if status_row and status_row.get('kind') == 'archive':
+            # A ZIP upload: one import job with a result per member
+            result['import'] = {
+                'total': status_row.get('total_members', 0),
+                'completed': status_row.get('next_member', 0),
+                'processed': status_row.get('processed_count', 0),
+                'deduplicated': status_row.get('deduplicated_count', 0),
+                'failed': status_row.get('error_count', 0),
+                'skipped': status_row.get('skipped_count', 0),
+                'results': status_row.get('results', []),
+                'results_truncated': status_row.get('results_truncated', False)
+            }
+        elif status_row:
+            result['image_id'] = status_row.get('target_image_id')
+        if status_row and status_row.get('error_message'):
+            result['error_message'] = status_row['error_message']
         
-        print(f"Returning result: {result}")
+        if result['status'] == 'processed' and 'import' not in result:
+            image = get_image(status_row['target_image_id'])
+            if image and image.get('user_id') == user_id and image.get('thumbnail_key'):
+                thumbnail_bucket = os.environ.get('THUMBNAIL_BUCKET')
+                region = os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1')
+                result['image'] = format_image(image, thumbnail_url_base(thumbnail_bucket, region))
         
         return {
             'statusCode': 200,
@@ -178,117 +996,478 @@ def get_user_images(user_id, headers):
         }
         
     except Exception as e:
-        print(f"Error fetching images for user {user_id}: {str(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error fetching status for user %s: %s", user_id, e)
         return {
             'statusCode': 500,
             'headers': headers,
             'body': json.dumps({
-                'error': 'Failed to fetch images',
+                'error': 'Failed to fetch image status',
                 'message': str(e),
                 'user_id': user_id
             })
         }
 
-def delete_user_image(user_id, image_id, headers):
-    """Delete a specific image for a user"""
+def get_image(image_id):
+    """Fetch one row by image_id"""
+    response = get_client('dynamodb').get_item(TableName=TABLE_NAME, Key=image_key(image_id))
+    return deserialize_item(response.get('Item'))
+
+def get_user_summary(user_id):
+    """The user's summary row: listing version and usage totals"""
+    response = get_client('dynamodb').get_item(
+        TableName=TABLE_NAME,
+        Key=image_key(user_summary_id(user_id)),
+        ConsistentRead=True
+    )
+    return deserialize_item(response.get('Item')) or {}
+
+def get_user_stats(user_id, query_params, headers, metrics):
+    """Usage totals of a user from their summary row, with an optional quota check"""
+    try:
+        try:
+            upload_bytes = int(query_params.get('upload_bytes') or 0)
+            if upload_bytes < 0:
+                raise ValueError
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Invalid upload_bytes parameter',
+                    'message': 'upload_bytes must be a non-negative number of bytes'
+                })
+            }
+        
+        # One GetItem, whatever the size of the library
+        with metrics.stage('lookup'):
+            summary = get_user_summary(user_id)
+        image_count = max(0, summary.get('image_count', 0))
+        original_bytes = max(0, summary.get('original_bytes', 0))
+        thumbnail_bytes = max(0, summary.get('thumbnail_bytes', 0))
+        result = {
+            'user_id': user_id,
+            'imageCount': image_count,
+            'originalBytes': original_bytes,
+            'thumbnailBytes': thumbnail_bytes,
+            'totalBytes': original_bytes + thumbnail_bytes,
+            'lastUploadTime': summary.get('last_upload_time')
+        }
+        
+        if USER_QUOTA_IMAGES or USER_QUOTA_BYTES:
+            # The byte quota applies to what the user uploaded, not to generated renditions
+            remaining_images = USER_QUOTA_IMAGES - image_count if USER_QUOTA_IMAGES else None
+            remaining_bytes = USER_QUOTA_BYTES - original_bytes if USER_QUOTA_BYTES else None
+            exceeded = (remaining_images is not None and remaining_images < 0) or \
+                (remaining_bytes is not None and remaining_bytes < 0)
+            result['quota'] = {
+                'maxImages': USER_QUOTA_IMAGES or None,
+                'maxBytes': USER_QUOTA_BYTES or None,
+                'remainingImages': None if remaining_images is None else max(0, remaining_images),
+                'remainingBytes': None if remaining_bytes is None else max(0, remaining_bytes),
+                'exceeded': exceeded,
+                # Whether one more upload of upload_bytes fits within both limits
+                'allowed': (remaining_images is None or remaining_images >= 1) and
+                           (remaining_bytes is None or remaining_bytes >= upload_bytes)
+            }
+        
+        return {
+            'statusCode': 200,
+            'headers': {**headers, 'Cache-Control': LISTING_CACHE_CONTROL},
+            'body': json.dumps(result, default=decimal_default)
+        }
+        
+    except Exception as e:
+        logger.exception("Error fetching stats for user %s: %s", user_id, e)
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Failed to fetch usage statistics',
+                'message': str(e),
+                'user_id': user_id
+            })
+        }
+
+def get_similar_images(user_id, image_id, query_params, headers, metrics):
+    """Images of the user whose perceptual hash is within max_distance of the given image's"""
     try:
-        print(f"Deleting image {image_id} for user {user_id}")
+        try:
+            max_distance = parse_max_distance(query_params.get('max_distance'))
+            limit = int(query_params.get('limit') or DEFAULT_SIMILAR_LIMIT)
+            if limit < 1:
+                raise ValueError('limit must be a positive integer')
+            limit = min(limit, MAX_PAGE_SIZE)
+        except ValueError as param_error:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Invalid similarity parameters',
+                    'message': str(param_error)
+                })
+            }
+        
+        with metrics.stage('lookup'):
+            image = get_owned_image(user_id, image_id) if image_id else None
+        if not image:
+            return {
+                'statusCode': 404,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Image not found',
+                    'message': f'Image {image_id} not found for user {user_id}'
+                })
+            }
+        if not image.get('phash'):
+            # Rows processed before perceptual hashes existed get one when reprocessed
+            return {
+                'statusCode': 409,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'No perceptual hash',
+                    'message': f'Image {image_id} has not been hashed yet; reprocess it to enable similarity search'
+                })
+            }
+        
+        with metrics.stage('index_read'):
+            matches = find_similar_ids(user_id, image['image_id'], image['phash'], max_distance)[:limit]
+        with metrics.stage('query'):
+            items = {
+                item['image_id']: item for item in batch_get_images([other_id for _, other_id in matches])
+                if item.get('user_id') == user_id and item.get('status') == 'processed' and item.get('thumbnail_key')
+            }
+        
+        url_base = thumbnail_url_base(os.environ.get('THUMBNAIL_BUCKET'), os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1'))
+        similar = []
+        for distance, other_id in matches:
+            if other_id in items:
+                formatted = format_image(items[other_id], url_base)
+                formatted['distance'] = distance
+                similar.append(formatted)
+        metrics.add('items_returned', len(similar), 'Count')
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'image_id': image['image_id'],
+                'max_distance': max_distance,
+                'images': similar,
+                'count': len(similar)
+            }, default=decimal_default)
+        }
         
-        # First, get the image metadata to find the thumbnail key
+    except Exception as e:
+        logger.exception("Error finding images similar to %s for user %s: %s", image_id, user_id, e)
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Failed to find similar images',
+                'message': str(e),
+                'user_id': user_id,
+                'image_id': image_id
+            })
+        }
+
+def parse_image_ids(value):
+    """Validate the ids query parameter: comma-separated image IDs, duplicates dropped"""
+    image_ids = []
+    for image_id in (value or '').split(','):
+        image_id = image_id.strip()
+        if image_id and image_id not in image_ids:
+            image_ids.append(image_id)
+    if not image_ids:
+        raise ValueError('ids must list at least one image ID')
+    if len(image_ids) > MAX_ORIGINAL_URLS:
+        raise ValueError(f'at most {MAX_ORIGINAL_URLS} image IDs can be requested at once')
+    return image_ids
+
+def sign_original_url(image, now):
+    """Presigned GET URL object for an image's original, valid from now"""
+    return {
+        'id': image['image_id'],
+        'url': presign_get_url(image['original_bucket'], image['original_key'], ORIGINAL_URL_EXPIRES_SECONDS, now),
+        'expiresAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now + ORIGINAL_URL_EXPIRES_SECONDS)),
+        'originalName': image.get('original_name', image['original_key']),
+        'contentType': image.get('content_type', 'image/jpeg'),
+        'size': image.get('original_size')
+    }
+
+def get_original_urls(user_id, query_params, headers, metrics):
+    """Presigned URLs for the originals of a page of the user's images
+
+    URLs are signed locally and kept by the warm container, so opening the same
+    photo again costs neither a signature nor a DynamoDB read.
+    """
+    try:
         try:
-            # Try to find the image by image_id first
-            response = table.scan(
-                FilterExpression='image_id = :image_id AND user_id = :user_id',
-                ExpressionAttributeValues={
-                    ':image_id': image_id,
-                    ':user_id': user_id
-                }
-            )
-            
-            items = response.get('Items', [])
-            if not items:
-                # If not found by image_id, try finding by original_key (for backward compatibility)
-                response = table.scan(
-                    FilterExpression='original_key = :original_key AND user_id = :user_id',
-                    ExpressionAttributeValues={
-                        ':original_key': image_id,  # image_id might actually be the original_key
-                        ':user_id': user_id
-                    }
-                )
-                items = response.get('Items', [])
-            
-            if not items:
-                print(f"Image not found: {image_id} for user {user_id}")
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'error': 'Image not found',
-                        'message': f'Image {image_id} not found for user {user_id}'
-                    })
-                }
-            
-            image_metadata = items[0]
-            print(f"Found image metadata: {image_metadata}")
-            
-            # Delete thumbnail from S3 if it exists
-            thumbnail_bucket = os.environ.get('THUMBNAIL_BUCKET')
-            thumbnail_key = image_metadata.get('thumbnail_key')
-            
-            if thumbnail_bucket and thumbnail_key:
-                try:
-                    s3.delete_object(Bucket=thumbnail_bucket, Key=thumbnail_key)
-                    print(f"Deleted thumbnail from S3: {thumbnail_key}")
-                except Exception as s3_error:
-                    print(f"Error deleting thumbnail from S3: {s3_error}")
-                    # Continue with metadata deletion even if S3 delete fails
-            
-            # Delete metadata from DynamoDB
+            image_ids = parse_image_ids(query_params.get('ids'))
+        except ValueError as param_error:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Invalid image IDs',
+                    'message': str(param_error)
+                })
+            }
+        
+        # Whole seconds, like the X-Amz-Date the URLs are signed with
+        now = int(time.time())
+        originals = {}
+        for image_id in image_ids:
+            original = original_url_cache.get(user_id, image_id, now)
+            if original is not None:
+                originals[image_id] = original
+        missing = [image_id for image_id in image_ids if image_id not in originals]
+        metrics.add('url_cache_hits', len(originals), 'Count')
+        metrics.add('url_cache_misses', len(missing), 'Count')
+        
+        if missing:
+            with metrics.stage('lookup'):
+                images = [
+                    image for image in batch_get_images(missing, ORIGINAL_URL_ATTRIBUTES)
+                    if image.get('user_id') == user_id and image.get('original_bucket') and image.get('original_key')
+                ]
+            with metrics.stage('sign'):
+                for image in images:
+                    original = sign_original_url(image, now)
+                    originals[image['image_id']] = original
+                    original_url_cache.put(user_id, image['image_id'], original, now + ORIGINAL_URL_EXPIRES_SECONDS)
+        
+        found = [originals[image_id] for image_id in image_ids if image_id in originals]
+        metrics.add('items_returned', len(found), 'Count')
+        
+        return {
+            'statusCode': 200,
+            'headers': {**headers, 'Cache-Control': 'private, no-store'},
+            'body': json.dumps({
+                'originals': found,
+                'count': len(found),
+                'not_found': [image_id for image_id in image_ids if image_id not in originals]
+            })
+        }
+        
+    except Exception as e:
+        logger.exception("Error signing original URLs for user %s: %s", user_id, e)
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Failed to sign original URLs',
+                'message': str(e),
+                'user_id': user_id
+            })
+        }
+
+def get_owned_image(user_id, image_id):
+    """Look up an image by its table key, falling back to its original_key"""
+    item = get_image(image_id)
+    if item:
+        return item if item.get('user_id') == user_id else None
+    
+    # Older clients pass the original S3 key instead of the image_id; the
+    # resizer's status row maps it straight to the image_id
+    status_row = get_status_row(user_id, image_id)
+    if status_row and status_row.get('target_image_id'):
+        item = get_image(status_row['target_image_id'])
+        if item and item.get('user_id') == user_id:
+            return item
+    
+    # Rows written before status rows existed: only the user's own partition
+    # of the GSI is read, never the whole table.
+    query_kwargs = {
+        'TableName': TABLE_NAME,
+        'IndexName': USER_ID_INDEX,
+        'KeyConditionExpression': 'user_id = :user_id',
+        'FilterExpression': 'original_key = :original_key',
+        'ExpressionAttributeValues': {':user_id': {'S': user_id}, ':original_key': {'S': image_id}}
+    }
+    while True:
+        response = get_client('dynamodb').query(**query_kwargs)
+        if response.get('Items'):
+            return deserialize_item(response['Items'][0])
+        if 'LastEvaluatedKey' not in response:
+            return None
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def shared_rendition_keys(images):
+    """Rendition keys of the given items that other rows still reference
+
+    Uploads with identical bytes share renditions through the content-hash
+    index, so those objects must survive until the last referencing row is gone.
+    """
+    deleting = {image['image_id'] for image in images}
+    shared = set()
+    for content_hash_key in {image['content_hash_key'] for image in images if image.get('content_hash_key')}:
+        query_kwargs = {
+            'TableName': TABLE_NAME,
+            'IndexName': CONTENT_HASH_INDEX,
+            'KeyConditionExpression': 'content_hash_key = :content_hash_key',
+            'ExpressionAttributeValues': {':content_hash_key': {'S': content_hash_key}}
+        }
+        while True:
+            response = get_client('dynamodb').query(**query_kwargs)
+            for item in map(deserialize_item, response.get('Items', [])):
+                if item['image_id'] not in deleting:
+                    shared.update(rendition_object_keys(item))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return shared
+
+def s3_keys_for_images(images, keep):
+    """Group the rendition and original S3 keys of the given items by bucket, except the keys to keep"""
+    thumbnail_bucket = os.environ.get('THUMBNAIL_BUCKET')
+    keys_by_bucket = {}
+    for image in images:
+        bucket = image.get('thumbnail_bucket') or thumbnail_bucket
+        thumbnail_keys = rendition_object_keys(image) - keep
+        if bucket and thumbnail_keys:
+            keys_by_bucket.setdefault(bucket, []).extend(sorted(thumbnail_keys))
+        if image.get('original_key') and image.get('original_bucket'):
+            keys_by_bucket.setdefault(image['original_bucket'], []).append(image['original_key'])
+    return keys_by_bucket
+
+def delete_s3_objects(keys_by_bucket):
+    """Delete objects with DeleteObjects, up to 1000 keys per call; returns per-key errors"""
+    errors = []
+    for bucket, keys in keys_by_bucket.items():
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            chunk = keys[start:start + S3_DELETE_BATCH_SIZE]
             try:
-                table.delete_item(
-                    Key={'image_id': image_metadata['image_id']}
+                response = get_client('s3').delete_objects(
+                    Bucket=bucket,
+                    Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
                 )
-                print(f"Deleted metadata from DynamoDB: {image_metadata['image_id']}")
-            except Exception as db_error:
-                print(f"Error deleting from DynamoDB: {db_error}")
-                return {
-                    'statusCode': 500,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'error': 'Failed to delete image metadata',
-                        'message': str(db_error)
-                    })
-                }
-            
+                for error in response.get('Errors', []):
+                    errors.append({'bucket': bucket, 'key': error.get('Key'), 'message': error.get('Message')})
+            except Exception as s3_error:
+                logger.error("Error deleting %d objects from %s: %s", len(chunk), bucket, s3_error)
+                errors.extend({'bucket': bucket, 'key': key, 'message': str(s3_error)} for key in chunk)
+    return errors
+
+def batch_get_images(image_ids, projection=None):
+    """Fetch items by image_id with BatchGetItem, retrying unprocessed keys"""
+    items = []
+    for start in range(0, len(image_ids), BATCH_GET_SIZE):
+        request = {TABLE_NAME: {'Keys': [image_key(image_id) for image_id in image_ids[start:start + BATCH_GET_SIZE]]}}
+        if projection:
+            request[TABLE_NAME]['ProjectionExpression'] = projection
+        while request:
+            response = get_client('dynamodb').batch_get_item(RequestItems=request)
+            items.extend(deserialize_item(item) for item in response.get('Responses', {}).get(TABLE_NAME, []))
+            request = response.get('UnprocessedKeys') or None
+    return items
+
+def batch_delete_items(image_ids):
+    """Delete rows with BatchWriteItem, 25 keys per call, retrying unprocessed items with backoff"""
+    requests = [{'DeleteRequest': {'Key': image_key(image_id)}} for image_id in image_ids]
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = {TABLE_NAME: requests[start:start + BATCH_WRITE_SIZE]}
+        delay = 0.05
+        while pending:
+            response = get_client('dynamodb').batch_write_item(RequestItems=pending)
+            pending = response.get('UnprocessedItems') or None
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+def unindex_phashes(user_id, images):
+    """Delete the near-duplicate index entries of deleted images"""
+    entry_ids = [
+        entry['image_id'] for image in images if image.get('phash')
+        for entry in phash_entries(user_id, image['image_id'], image['phash'])
+    ]
+    try:
+        batch_delete_items(entry_ids)
+    except Exception as index_error:
+        logger.error("Error deleting near-duplicate index entries of %s: %s", user_id, index_error)
+
+def delete_user_image(user_id, image_id, headers, metrics):
+    """Delete a specific image for a user"""
+    try:
+        logger.info("Deleting image %s for user %s", image_id, user_id)
+        
+        with metrics.stage('lookup'):
+            image_metadata = get_owned_image(user_id, image_id)
+            # Renditions shared with identical uploads stay stored and counted
+            shared_keys = shared_rendition_keys([image_metadata]) if image_metadata else set()
+        if not image_metadata:
+            logger.info("Image not found: %s for user %s", image_id, user_id)
             return {
-                'statusCode': 200,
+                'statusCode': 404,
                 'headers': headers,
                 'body': json.dumps({
-                    'message': 'Image deleted successfully',
-                    'deleted_image_id': image_metadata['image_id'],
-                    'deleted_thumbnail_key': thumbnail_key
+                    'error': 'Image not found',
+                    'message': f'Image {image_id} not found for user {user_id}'
                 })
             }
-            
-        except Exception as e:
-            print(f"Error in delete process: {str(e)}")
-            import traceback
-            print(f"Full traceback: {traceback.format_exc()}")
+        
+        # Delete metadata first, conditional on ownership, so a concurrent
+        # delete or a row belonging to another user can never be removed
+        try:
+            with metrics.stage('dynamodb_delete'):
+                get_client('dynamodb').delete_item(
+                    TableName=TABLE_NAME,
+                    Key=image_key(image_metadata['image_id']),
+                    ConditionExpression='user_id = :user_id',
+                    ExpressionAttributeValues={':user_id': {'S': user_id}}
+                )
+        except get_client('dynamodb').exceptions.ConditionalCheckFailedException:
+            return {
+                'statusCode': 404,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Image not found',
+                    'message': f'Image {image_id} not found for user {user_id}'
+                })
+            }
+        except Exception as db_error:
+            logger.error("Error deleting %s from DynamoDB: %s", image_metadata['image_id'], db_error)
             return {
                 'statusCode': 500,
                 'headers': headers,
                 'body': json.dumps({
-                    'error': 'Failed to delete image',
-                    'message': str(e)
+                    'error': 'Failed to delete image metadata',
+                    'message': str(db_error)
                 })
             }
-            
+        
+        bump_user_version(user_id, [image_metadata], shared_keys)
+        unindex_phashes(user_id, [image_metadata])
+        
+        # Drop the resizer's status row for this upload as well
+        try:
+            get_client('dynamodb').delete_item(
+                TableName=TABLE_NAME,
+                Key=image_key(status_row_id(user_id, image_metadata['original_key']))
+            )
+        except Exception as status_error:
+            logger.error("Error deleting status row of %s: %s", image_metadata['image_id'], status_error)
+        
+        # Remove both the thumbnail and the original; metadata is already gone,
+        # so S3 failures are reported but do not fail the request
+        with metrics.stage('s3_delete'):
+            s3_errors = delete_s3_objects(s3_keys_for_images([image_metadata], shared_keys))
+        if s3_errors:
+            logger.warning("Errors deleting objects from S3: %s", s3_errors)
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'message': 'Image deleted successfully',
+                'deleted_image_id': image_metadata['image_id'],
+                'deleted_thumbnail_key': image_metadata.get('thumbnail_key'),
+                'deleted_original_key': image_metadata.get('original_key'),
+                's3_errors': s3_errors
+            })
+        }
+        
     except Exception as e:
-        print(f"Error deleting image {image_id} for user {user_id}: {str(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error deleting image %s for user %s: %s", image_id, user_id, e)
         return {
             'statusCode': 500,
             'headers': headers,
@@ -298,4 +1477,68 @@ def delete_user_image(user_id, image_id, headers):
                 'user_id': user_id,
                 'image_id': image_id
             })
-        }
\ No newline at end of file
+        }
+
+def delete_user_images(user_id, image_ids, headers, metrics):
+    """Delete many images for a user with BatchWriteItem and S3 DeleteObjects"""
+    try:
+        # Preserve request order while dropping duplicates and non-string ids
+        image_ids = list(dict.fromkeys(str(image_id) for image_id in image_ids if image_id))
+        if len(image_ids) > MAX_BATCH_DELETE:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': 'Too many image_ids',
+                    'message': f'At most {MAX_BATCH_DELETE} images can be deleted per request'
+                })
+            }
+        
+        logger.info("Batch deleting %d images for user %s", len(image_ids), user_id)
+        
+        # Ownership is verified from the fetched items because BatchWriteItem
+        # does not support condition expressions
+        with metrics.stage('lookup'):
+            images = [item for item in batch_get_images(image_ids) if item.get('user_id') == user_id]
+            # Renditions shared with identical uploads stay stored and counted
+            shared_keys = shared_rendition_keys(images)
+        found_ids = {image['image_id'] for image in images}
+        not_found = [image_id for image_id in image_ids if image_id not in found_ids]
+        
+        with metrics.stage('dynamodb_delete'):
+            batch_delete_items(
+                [image['image_id'] for image in images]
+                + [status_row_id(user_id, image['original_key']) for image in images]
+            )
+        metrics.add('images_deleted', len(images), 'Count')
+        if images:
+            bump_user_version(user_id, images, shared_keys)
+            unindex_phashes(user_id, images)
+        
+        with metrics.stage('s3_delete'):
+            s3_errors = delete_s3_objects(s3_keys_for_images(images, shared_keys))
+        if s3_errors:
+            logger.warning("Errors deleting %d objects from S3", len(s3_errors))
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'message': f'Deleted {len(images)} images',
+                'deleted_image_ids': [image['image_id'] for image in images],
+                'not_found': not_found,
+                's3_errors': s3_errors
+            })
+        }
+        
+    except Exception as e:
+        logger.exception("Error batch deleting images for user %s: %s", user_id, e)
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({
+                'error': 'Failed to delete images',
+                'message': str(e),
+                'user_id': user_id
+            })
+        }
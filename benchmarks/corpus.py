@@ -0,0 +1,120 @@
+import io
+import math
+import uuid
+from datetime import datetime, timedelta
+
+from PIL import Image, ImageChops
+
+# Synthetic inputs for the benchmarks. Images mix smooth gradients with low-frequency
+# noise so that JPEG/PNG/WebP sizes and encode times resemble photos rather than
+# flat colour fields, and everything is deterministic for a given size and kind.
+
+# kind -> (Pillow save format, content type, image mode)
+IMAGE_KINDS = {
+    'jpeg': ('JPEG', 'image/jpeg', 'RGB'),
+    'png': ('PNG', 'image/png', 'RGB'),
+    'rgba': ('PNG', 'image/png', 'RGBA'),
+    'palette': ('PNG', 'image/png', 'P')
+}
+
+DEFAULT_MEGAPIXELS = [0.3, 2, 12, 24, 50]
+DEFAULT_LIBRARY_SIZES = [10, 100, 1000, 10000, 50000]
+
+def dimensions(megapixels, aspect=1.5):
+    """3:2 width and height whose product does not exceed the given megapixels"""
+    height = int(math.sqrt(megapixels * 1_000_000 / aspect))
+    width = int(megapixels * 1_000_000 // height)
+    return width, height
+
+def synthetic_image(width, height, mode='RGB', seed=0):
+    """A photo-like test image of the given size and mode"""
+    horizontal = Image.linear_gradient('L').resize((width, height))
+    vertical = Image.linear_gradient('L').rotate(90).resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    # Noise is generated small and scaled up, which keeps generation fast for
+    # 50 MP inputs and gives texture at several frequencies
+    noise = Image.effect_noise((max(1, width // 16), max(1, height // 16)), 48 + seed % 16).resize(
+        (width, height), Image.Resampling.BILINEAR)
+    image = Image.merge('RGB', (
+        ImageChops.add(horizontal, noise, scale=2),
+        ImageChops.add(vertical, noise, scale=2),
+        ImageChops.add(radial, noise, scale=2)
+    ))
+    if mode == 'RGBA':
+        image.putalpha(radial)
+    elif mode == 'P':
+        image = image.quantize(colors=256)
+    return image
+
+def encode_synthetic(kind, megapixels, seed=0):
+    """Encoded bytes, content type and dimensions of one synthetic upload"""
+    pil_format, content_type, mode = IMAGE_KINDS[kind]
+    width, height = dimensions(megapixels)
+    image = synthetic_image(width, height, mode, seed)
+    buffer = io.BytesIO()
+    if pil_format == 'JPEG':
+        image.save(buffer, pil_format, quality=88)
+    else:
+        # compress_level 1 keeps corpus generation quick; decode cost is unaffected
+        image.save(buffer, pil_format, compress_level=1)
+    image.close()
+    return buffer.getvalue(), content_type, (width, height)
+
+def library_items(user_id, count, thumbnail_bucket, images_bucket, rendition_sizes=(200, 400, 1080, 2048),
+                  output_formats=('webp', 'avif')):
+    """Metadata rows shaped like the resizer's output for a user with count images"""
+    started = datetime(2024, 1, 1)
+    for index in range(count):
+        original_key = f"{user_id}/{index:06d}.jpg"
+        renditions = []
+        for size in rendition_sizes:
+            key = f"thumb-{original_key}" if size == 400 else f"thumb-{size}-{original_key}"
+            width, height = size, size * 2 // 3
+            renditions.append({
+                'size': size,
+                'key': key,
+                'width': width,
+                'height': height,
+                'bytes': width * height // 8,
+                'content_type': 'image/jpeg',
+                'formats': [
+                    {
+                        'format': fmt,
+                        'key': f"{key}.{fmt}",
+                        'bytes': width * height // 12,
+                        'quality': 80,
+                        'content_type': f"image/{fmt}"
+                    }
+                    for fmt in output_formats
+                ]
+            })
+        upload_time = (started + timedelta(minutes=index)).isoformat()
+        yield {
+            'image_id': str(uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{images_bucket}/{original_key}")),
+            'user_id': user_id,
+            'original_key': original_key,
+            'thumbnail_key': f"thumb-{original_key}",
+            'original_bucket': images_bucket,
+            'thumbnail_bucket': thumbnail_bucket,
+            'original_name': f"IMG_{index:06d}.jpg",
+            'original_size': 3_500_000,
+            'thumbnail_size': 400 * 266 // 8,
+            'original_width': 6000,
+            'original_height': 4000,
+            'thumbnail_width': 400,
+            'thumbnail_height': 266,
+            'renditions': renditions,
+            'upload_time': upload_time,
+            'processed_time': upload_time,
+            'content_type': 'image/jpeg',
+            'thumbnail_content_type': 'image/jpeg',
+            'content_hash': f"{index:064x}",
+            'content_hash_key': f"{user_id}#{index:064x}",
+            'status': 'processed',
+            'thumbnail_quality': 'high',
+            # Same length as the resizer's 32px WebP data URI
+            'placeholder': 'data:image/webp;base64,' + 'A' * 200,
+            'dominant_color': '#5f8e72',
+            # Spread over the 64-bit space like dHashes of unrelated photos
+            'phash': f"{index * 0x9E3779B97F4A7C15 % 2 ** 64:016x}"
+        }
@@ -0,0 +1,553 @@
+import hashlib
+import io
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+from functools import lru_cache
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+# In-process stand-ins for the parts of S3 and DynamoDB the Lambda functions use.
+# They follow the service semantics that matter for performance (Limit applies
+# before FilterExpression, GSIs are sorted by their range key, pagination through
+# LastEvaluatedKey) but keep everything in memory, so a benchmark run measures the
+# handlers rather than the network.
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+class NoSuchKey(Exception):
+    pass
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    NoSuchKey = NoSuchKey
+
+class Latency:
+    """Optional simulated round-trip time added to every fake service call"""
+
+    def __init__(self, milliseconds=0.0):
+        self.seconds = milliseconds / 1000
+
+    def wait(self):
+        if self.seconds:
+            time.sleep(self.seconds)
+
+class FakeS3:
+    """Dictionary-backed S3 client that records how many bytes were written"""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.objects = {}
+        self.bytes_written = 0
+        self.put_count = 0
+        self.get_count = 0
+        self._lock = threading.Lock()
+
+    def add_object(self, bucket, key, body, content_type='image/jpeg', metadata=None):
+        """Seed an object without counting it as written by the code under test"""
+        etag = f'"{abs(hash((bucket, key, len(body)))):x}"'
+        self.objects[(bucket, key)] = {'Body': body, 'ContentType': content_type, 'Metadata': metadata or {}, 'ETag': etag}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.latency.wait()
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise NoSuchKey(f"{Bucket}/{Key}")
+        return {
+            'ContentLength': len(obj['Body']),
+            'ContentType': obj['ContentType'],
+            'Metadata': dict(obj['Metadata']),
+            'ETag': obj['ETag']
+        }
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.latency.wait()
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise NoSuchKey(f"{Bucket}/{Key}")
+        body = obj['Body']
+        if Range:
+            # Only the "bytes=<first>-<last>" form the resizer sends
+            first, last = (int(value) for value in Range[len('bytes='):].split('-'))
+            body = body[first:last + 1]
+        with self._lock:
+            self.get_count += 1
+        return {
+            'Body': io.BytesIO(body),
+            'ContentLength': len(body),
+            'ContentType': obj['ContentType'],
+            'Metadata': dict(obj['Metadata']),
+            'ETag': obj['ETag']
+        }
+
+    def put_object(self, Bucket, Key, Body, ContentType='binary/octet-stream', Metadata=None, **kwargs):
+        self.latency.wait()
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        with self._lock:
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            self.objects[(Bucket, Key)] = {'Body': data, 'ContentType': ContentType, 'Metadata': Metadata or {}, 'ETag': etag}
+            self.bytes_written += len(data)
+            self.put_count += 1
+        return {'ETag': etag}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.latency.wait()
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.latency.wait()
+        with self._lock:
+            for obj in Delete['Objects']:
+                self.objects.pop((Bucket, obj['Key']), None)
+        return {'Errors': []}
+
+    def reset_counters(self):
+        self.bytes_written = 0
+        self.put_count = 0
+        self.get_count = 0
+
+def to_dynamodb(value):
+    """Store numbers as Decimal, the way TypeDeserializer returns them"""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: to_dynamodb(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_dynamodb(item) for item in value]
+    return value
+
+def _compare(left, operator, right):
+    if left is None or right is None:
+        return False
+    try:
+        if operator == '=':
+            return left == right
+        if operator == '<>':
+            return left != right
+        if operator == '<':
+            return left < right
+        if operator == '<=':
+            return left <= right
+        if operator == '>':
+            return left > right
+        if operator == '>=':
+            return left >= right
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported operator {operator}")
+
+_TOKEN = re.compile(r'\s*(<>|<=|>=|=|<|>|\(|\)|,|[#:]?[A-Za-z_][A-Za-z0-9_.\-]*)')
+
+@lru_cache(maxsize=256)
+def _tokenize(expression):
+    return tuple(_TOKEN.findall(expression))
+
+class _StringExpression:
+    """Recursive-descent evaluator for the condition expression string syntax"""
+
+    def __init__(self, expression, names, values):
+        self.tokens = _tokenize(expression)
+        self.names = names or {}
+        self.values = {key: to_dynamodb(value) for key, value in (values or {}).items()}
+
+    def evaluate(self, item):
+        self.item = item
+        self.position = 0
+        result = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token {self.tokens[self.position]!r}")
+        return result
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _take(self, expected=None):
+        token = self._peek()
+        if expected and (token or '').upper() != expected:
+            raise ValueError(f"Expected {expected}, got {token!r}")
+        self.position += 1
+        return token
+
+    def _or(self):
+        result = self._and()
+        while (self._peek() or '').upper() == 'OR':
+            self._take()
+            right = self._and()
+            result = result or right
+        return result
+
+    def _and(self):
+        result = self._not()
+        while (self._peek() or '').upper() == 'AND':
+            self._take()
+            right = self._not()
+            result = result and right
+        return result
+
+    def _not(self):
+        if (self._peek() or '').upper() == 'NOT':
+            self._take()
+            return not self._not()
+        return self._comparison()
+
+    def _name(self, token):
+        return self.names.get(token, token)
+
+    def _operand(self):
+        token = self._take()
+        if token.startswith(':'):
+            return self.values[token]
+        return self.item.get(self._name(token))
+
+    def _comparison(self):
+        token = self._peek()
+        if token == '(':
+            self._take()
+            result = self._or()
+            self._take(')')
+            return result
+        function = token.lower()
+        if function in ('attribute_exists', 'attribute_not_exists', 'begins_with', 'contains'):
+            self._take()
+            self._take('(')
+            path = self._name(self._take())
+            argument = None
+            if self._peek() == ',':
+                self._take()
+                argument = self._operand()
+            self._take(')')
+            value = self.item.get(path)
+            if function == 'attribute_exists':
+                return path in self.item
+            if function == 'attribute_not_exists':
+                return path not in self.item
+            if function == 'begins_with':
+                return isinstance(value, str) and value.startswith(argument)
+            return value is not None and argument in value
+        left = self._operand()
+        operator = self._take()
+        if operator.upper() == 'BETWEEN':
+            low = self._operand()
+            self._take('AND')
+            high = self._operand()
+            return _compare(left, '>=', low) and _compare(left, '<=', high)
+        if operator.upper() == 'IN':
+            self._take('(')
+            options = [self._operand()]
+            while self._peek() == ',':
+                self._take()
+                options.append(self._operand())
+            self._take(')')
+            return left in options
+        return _compare(left, operator, self._operand())
+
+def _compile(condition, names=None, values=None):
+    """Predicate for an expression string or None"""
+    if condition is None:
+        return lambda item: True
+    return _StringExpression(condition, names, values).evaluate
+
+def _matches(condition, item, names=None, values=None):
+    return _compile(condition, names, values)(item)
+
+def _project(item, projection, names):
+    if not projection:
+        return dict(item)
+    fields = [names.get(field.strip(), field.strip()) if names else field.strip() for field in projection.split(',')]
+    return {field: item[field] for field in fields if field in item}
+
+class _Index:
+    """A GSI kept as sorted per-partition lists so queries stay O(log n + page)"""
+
+    def __init__(self, hash_key, range_key=None, projection=None):
+        self.hash_key = hash_key
+        self.range_key = range_key
+        # None projects every attribute; otherwise the keys plus these fields
+        self.projection = projection
+        self.partitions = {}
+        self.sorted = {}
+
+    def sort_key(self, item):
+        return (item.get(self.range_key, '') if self.range_key else '', item['image_id'])
+
+    def add(self, item):
+        if self.hash_key not in item:
+            return
+        partition = item[self.hash_key]
+        self.partitions.setdefault(partition, {})[item['image_id']] = item
+        self.sorted.pop(partition, None)
+
+    def remove(self, item):
+        if not item or self.hash_key not in item:
+            return
+        partition = item[self.hash_key]
+        self.partitions.get(partition, {}).pop(item['image_id'], None)
+        self.sorted.pop(partition, None)
+
+    def items(self, partition):
+        """(sort keys, items) of a partition in ascending range key order"""
+        ordered = self.sorted.get(partition)
+        if ordered is None:
+            members = sorted(self.partitions.get(partition, {}).values(), key=self.sort_key)
+            ordered = ([self.sort_key(item) for item in members], members)
+            self.sorted[partition] = ordered
+        return ordered
+
+    def view(self, item):
+        if self.projection is None:
+            return item
+        keep = {'image_id', self.hash_key, self.range_key} | set(self.projection)
+        return {key: value for key, value in item.items() if key in keep}
+
+class FakeTable:
+    """Dictionary-backed DynamoDB table with the project's GSIs"""
+
+    def __init__(self, name='image-metadata', latency=None, indexes=None):
+        self.name = name
+        self.latency = latency or Latency()
+        self.items = {}
+        self.indexes = indexes if indexes is not None else {
+            # Left in place for the deploy; nothing queries it
+            'user-id-index': _Index('user_id'),
+            'user-upload-time-index': _Index('user_id', 'upload_time'),
+            # Same INCLUDE list as terraform: no user_id or status
+            'content-hash-index': _Index('content_hash_key', projection=[
+                'thumbnail_key', 'thumbnail_bucket', 'thumbnail_size', 'thumbnail_width',
+                'thumbnail_height', 'thumbnail_content_type', 'thumbnail_quality', 'renditions',
+                'original_width', 'original_height', 'placeholder', 'dominant_color', 'phash'
+            ]),
+            'phash-band-index': _Index('phash_band', projection=['target_image_id', 'phash'])
+        }
+        self.calls = {}
+        self._lock = threading.RLock()
+
+    def _count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.latency.wait()
+
+    def _store(self, item):
+        previous = self.items.get(item['image_id'])
+        for index in self.indexes.values():
+            index.remove(previous)
+            index.add(item)
+        self.items[item['image_id']] = item
+
+    def load(self, items):
+        """Bulk-load items without going through put_item (corpus setup)"""
+        with self._lock:
+            for item in items:
+                self._store(to_dynamodb(item))
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self._count('get_item')
+        item = self.items.get(Key['image_id'])
+        if item is None:
+            return {}
+        return {'Item': _project(item, ProjectionExpression, ExpressionAttributeNames)}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self._count('put_item')
+        with self._lock:
+            existing = self.items.get(Item['image_id'], {})
+            if not _matches(ConditionExpression, existing, ExpressionAttributeNames, ExpressionAttributeValues):
+                raise ConditionalCheckFailedException('The conditional request failed')
+            self._store(to_dynamodb(Item))
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ConditionExpression=None, ReturnValues=None, **kwargs):
+        self._count('update_item')
+        names = ExpressionAttributeNames or {}
+        values = {key: to_dynamodb(value) for key, value in (ExpressionAttributeValues or {}).items()}
+        with self._lock:
+            existing = self.items.get(Key['image_id'])
+            if not _matches(ConditionExpression, existing or {}, names, values):
+                raise ConditionalCheckFailedException('The conditional request failed')
+            item = dict(existing or Key)
+            # Supports the "SET a = :x, b = :y ADD c :z DELETE s :t REMOVE d" subset used by the functions
+            for action, body in re.findall(r'(SET|ADD|DELETE|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|DELETE|REMOVE)\s+|$)',
+                                           UpdateExpression.strip()):
+                for clause in [part.strip() for part in body.split(',') if part.strip()]:
+                    if action == 'SET':
+                        target, expression = [side.strip() for side in clause.split('=', 1)]
+                        target = names.get(target, target)
+                        match = re.match(r'if_not_exists\(\s*([#\w]+)\s*,\s*(:\w+)\s*\)$', expression)
+                        if match:
+                            item[target] = item.get(names.get(match.group(1), match.group(1)), values[match.group(2)])
+                        else:
+                            item[target] = values[expression]
+                    elif action == 'ADD':
+                        target, operand = clause.split()
+                        target = names.get(target, target)
+                        if isinstance(values[operand], set):
+                            item[target] = item.get(target, set()) | values[operand]
+                        else:
+                            item[target] = item.get(target, 0) + values[operand]
+                    elif action == 'DELETE':
+                        target, operand = clause.split()
+                        target = names.get(target, target)
+                        # DynamoDB drops a set attribute once its last element is deleted
+                        remaining = item.get(target, set()) - values[operand]
+                        if remaining:
+                            item[target] = remaining
+                        else:
+                            item.pop(target, None)
+                    else:
+                        item.pop(names.get(clause, clause), None)
+            self._store(item)
+        if ReturnValues in ('ALL_NEW', 'UPDATED_NEW'):
+            return {'Attributes': dict(item)}
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        self._count('delete_item')
+        with self._lock:
+            existing = self.items.get(Key['image_id'])
+            if ConditionExpression is not None and not _matches(
+                    ConditionExpression, existing or {}, ExpressionAttributeNames, ExpressionAttributeValues):
+                raise ConditionalCheckFailedException('The conditional request failed')
+            if existing:
+                for index in self.indexes.values():
+                    index.remove(existing)
+                del self.items[Key['image_id']]
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, Limit=None,
+              ScanIndexForward=True, ExclusiveStartKey=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, ProjectionExpression=None, **kwargs):
+        self._count('query')
+        index = self.indexes[IndexName]
+        partition = _partition_value(KeyConditionExpression, index.hash_key,
+                                     ExpressionAttributeNames, ExpressionAttributeValues)
+        with self._lock:
+            keys, ordered = index.items(partition)
+            if ScanIndexForward:
+                start = bisect_right(keys, index.sort_key(ExclusiveStartKey)) if ExclusiveStartKey else 0
+                positions = range(start, len(ordered))
+            else:
+                end = bisect_left(keys, index.sort_key(ExclusiveStartKey)) if ExclusiveStartKey else len(ordered)
+                positions = range(end - 1, -1, -1)
+            # The partition is already selected; only a range key condition needs checking
+            has_range = re.search(r'\sAND\s', KeyConditionExpression, re.IGNORECASE) is not None
+            key_matches = _compile(KeyConditionExpression if has_range else None,
+                                   ExpressionAttributeNames, ExpressionAttributeValues)
+            filter_matches = _compile(FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            evaluated = []
+            more = False
+            for position in positions:
+                item = ordered[position]
+                if not key_matches(item):
+                    continue
+                if Limit is not None and len(evaluated) >= Limit:
+                    more = True
+                    break
+                evaluated.append(item)
+            matched = [
+                _project(index.view(item), ProjectionExpression, ExpressionAttributeNames)
+                for item in evaluated
+                if filter_matches(item)
+            ]
+        response = {'Items': matched, 'Count': len(matched), 'ScannedCount': len(evaluated)}
+        if more:
+            last = evaluated[-1]
+            response['LastEvaluatedKey'] = {
+                key: last[key] for key in ('image_id', index.hash_key, index.range_key) if key and key in last
+            }
+        return response
+
+def _partition_value(condition, hash_key, names=None, values=None):
+    """Pull the hash key equality value out of a KeyConditionExpression"""
+    for name, placeholder in re.findall(r'([#\w]+)\s*=\s*(:\w+)', condition):
+        if (names or {}).get(name, name) == hash_key:
+            return values[placeholder]
+    return None
+
+class FakeDynamoDBClient:
+    """The low-level boto3 DynamoDB client over a FakeTable, converting attribute values both ways"""
+
+    exceptions = _Exceptions
+
+    def __init__(self, table):
+        self.table = table
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+        # Wire form of stored items, so converting the fake's own rows on
+        # every read does not swamp the handler time being measured
+        self._wire_cache = {}
+
+    def _plain(self, item):
+        return {key: self._deserializer.deserialize(value) for key, value in item.items()} if item else item
+
+    def _wire(self, item):
+        stored = self.table.items.get(item.get('image_id'))
+        if stored is None:
+            return {key: self._serializer.serialize(value) for key, value in item.items()}
+        # Keyed by the projected attribute names as well as the row
+        cache_key = (item['image_id'], tuple(item))
+        cached = self._wire_cache.get(cache_key)
+        if cached is None or cached[0] is not stored:
+            cached = (stored, {key: self._serializer.serialize(value) for key, value in item.items()})
+            self._wire_cache[cache_key] = cached
+        return cached[1]
+
+    def _arguments(self, kwargs):
+        kwargs.pop('TableName', None)
+        for name in ('Key', 'Item', 'ExpressionAttributeValues', 'ExclusiveStartKey'):
+            if kwargs.get(name):
+                kwargs[name] = self._plain(kwargs[name])
+        return kwargs
+
+    def _response(self, response):
+        response = dict(response)
+        for name in ('Item', 'Attributes', 'LastEvaluatedKey'):
+            if name in response:
+                response[name] = self._wire(response[name])
+        if 'Items' in response:
+            response['Items'] = [self._wire(item) for item in response['Items']]
+        return response
+
+    def get_item(self, **kwargs):
+        return self._response(self.table.get_item(**self._arguments(kwargs)))
+
+    def put_item(self, **kwargs):
+        return self._response(self.table.put_item(**self._arguments(kwargs)))
+
+    def update_item(self, **kwargs):
+        return self._response(self.table.update_item(**self._arguments(kwargs)))
+
+    def delete_item(self, **kwargs):
+        return self._response(self.table.delete_item(**self._arguments(kwargs)))
+
+    def query(self, **kwargs):
+        return self._response(self.table.query(**self._arguments(kwargs)))
+
+    def batch_get_item(self, RequestItems):
+        self.table._count('batch_get_item')
+        responses = {}
+        for name, request in RequestItems.items():
+            keys = [self._plain(key)['image_id'] for key in request['Keys']]
+            responses[name] = [
+                self._wire(_project(self.table.items[key], request.get('ProjectionExpression'),
+                                    request.get('ExpressionAttributeNames')))
+                for key in keys if key in self.table.items
+            ]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        self.table._count('batch_write_item')
+        for requests in RequestItems.values():
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.table.put_item(Item=self._plain(request['PutRequest']['Item']))
+                else:
+                    self.table.delete_item(Key=self._plain(request['DeleteRequest']['Key']))
+        return {'UnprocessedItems': {}}
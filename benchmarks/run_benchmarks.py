@@ -0,0 +1,353 @@
+"""Offline benchmarks for the image resizer and API Lambda handlers.
+
+Both handlers run in-process against the fakes in fakes.py, so no AWS account or
+network access is needed. Results are written as JSON; pass --compare with an
+earlier results file to flag regressions.
+
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+import argparse
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+
+THUMBNAIL_BUCKET = 'bench-thumbnails'
+IMAGES_BUCKET = 'bench-images'
+METADATA_TABLE = 'bench-metadata'
+
+# The handlers read their configuration at import time
+os.environ.setdefault('THUMBNAIL_BUCKET', THUMBNAIL_BUCKET)
+os.environ.setdefault('METADATA_TABLE', METADATA_TABLE)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+# Keep metric lines and info logs out of the timings
+os.environ.setdefault('METRICS_SAMPLE_RATE', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.join(REPO_ROOT, 'shared'))
+
+from corpus import DEFAULT_LIBRARY_SIZES, DEFAULT_MEGAPIXELS, IMAGE_KINDS, encode_synthetic, library_items
+from fakes import FakeDynamoDBClient, FakeS3, FakeTable, Latency
+from metadata_table import user_summary_id
+
+# Metrics compared by --compare; True means larger is better
+COMPARED_METRICS = {
+    'resizer': {
+        'latency_ms.p50': False,
+        'latency_ms.p99': False,
+        'throughput_images_per_s': True,
+        'peak_rss_mb': False,
+        'bytes_written_per_image': False
+    },
+    'api': {
+        'first_page_ms.p50': False,
+        'first_page_ms.p99': False,
+        'page_500_ms.p50': False,
+        'not_modified_ms.p50': False,
+        'cached_page_ms.p50': False,
+        'full_walk_ms': False,
+        'first_page_bytes': False
+    }
+}
+
+def load_handler(name, relative_path):
+    """Import a lambda_function.py under a unique module name"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentiles(samples):
+    """Nearest-rank summary of a list of millisecond samples"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def rank(fraction):
+        return round(ordered[max(0, math.ceil(fraction * len(ordered)) - 1)], 3)
+
+    return {
+        'p50': rank(0.50),
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+        'mean': round(sum(ordered) / len(ordered), 3),
+        'min': round(ordered[0], 3),
+        'max': round(ordered[-1], 3),
+        'samples': len(ordered)
+    }
+
+def peak_rss_mb():
+    """High-water mark of this process's resident set size in MB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+def s3_record(bucket, key):
+    return {'s3': {'bucket': {'name': bucket}, 'object': {'key': key}}}
+
+def run_resizer_case(kind, megapixels, payload, content_type, iterations, batch_size, latency_ms):
+    """Benchmark one corpus entry; runs in a fresh process so peak RSS is per case"""
+    resizer = load_handler('image_resizer', 'lambda/lambda_function.py')
+    latency = Latency(latency_ms)
+    s3 = FakeS3(latency)
+    table = FakeTable(METADATA_TABLE, latency)
+    resizer.s3 = s3
+    resizer.dynamodb = FakeDynamoDBClient(table)
+
+    def seed(prefix, count):
+        keys = []
+        for index in range(count):
+            key = f"{prefix}-{index}.{'jpg' if kind == 'jpeg' else 'png'}"
+            # A user per upload keeps content-hash deduplication from skipping the work
+            s3.add_object(IMAGES_BUCKET, key, payload, content_type, {'user-id': f"{prefix}-user-{index}"})
+            keys.append(key)
+        return keys
+
+    baseline_rss_mb = peak_rss_mb()
+    failures = 0
+    samples = []
+    for key in seed('single', iterations):
+        started = time.perf_counter()
+        response = resizer.lambda_handler({'Records': [s3_record(IMAGES_BUCKET, key)]}, None)
+        samples.append((time.perf_counter() - started) * 1000)
+        failures += json.loads(response['body']).get('failed_count', 0) if response['statusCode'] != 500 else 1
+    single_peak_rss_mb = peak_rss_mb()
+    bytes_written = s3.bytes_written
+    objects_written = s3.put_count
+
+    # Throughput: one event carrying a batch of records, as S3 delivers them
+    records = [s3_record(IMAGES_BUCKET, key) for key in seed('batch', batch_size)]
+    started = time.perf_counter()
+    response = resizer.lambda_handler({'Records': records}, None)
+    elapsed = time.perf_counter() - started
+    failures += json.loads(response['body']).get('failed_count', 0) if response['statusCode'] != 500 else batch_size
+
+    return {
+        'kind': kind,
+        'megapixels': megapixels,
+        'input_bytes': len(payload),
+        'iterations': iterations,
+        'latency_ms': percentiles(samples),
+        'batch_size': batch_size,
+        'throughput_images_per_s': round(batch_size / elapsed, 3),
+        'baseline_rss_mb': round(baseline_rss_mb, 1),
+        'peak_rss_mb': round(single_peak_rss_mb, 1),
+        'batch_peak_rss_mb': round(peak_rss_mb(), 1),
+        'bytes_written_per_image': bytes_written // max(1, iterations),
+        'objects_written_per_image': objects_written // max(1, iterations),
+        'failures': failures
+    }
+
+def listing_event(user_id, query=None, headers=None):
+    return {
+        'httpMethod': 'GET',
+        'resource': '/api/user/{user_id}/images',
+        'pathParameters': {'user_id': user_id},
+        'queryStringParameters': query,
+        'headers': headers or {}
+    }
+
+def run_api_case(library_size, iterations, latency_ms):
+    """Benchmark listing latency for a user with library_size images"""
+    api = load_handler('image_api', 'api_lambda/lambda_function.py')
+    latency = Latency(latency_ms)
+    table = FakeTable(METADATA_TABLE, latency)
+    api._clients['dynamodb'] = FakeDynamoDBClient(table)
+    api._clients['s3'] = FakeS3(latency)
+
+    user_id = f"user-{library_size}"
+    table.load(library_items(user_id, library_size, THUMBNAIL_BUCKET, IMAGES_BUCKET))
+    table.load([{'image_id': user_summary_id(user_id), 'version': 1}])
+
+    def timed(event):
+        started = time.perf_counter()
+        response = api.lambda_handler(event, None)
+        return (time.perf_counter() - started) * 1000, response
+
+    first_page, page_500, not_modified, cached_page = [], [], [], []
+    first_page_bytes = 0
+    etag = None
+    for _ in range(iterations):
+        # Uncached timings start from an empty warm-container listing cache
+        api.listing_cache.invalidate(user_id)
+        elapsed, response = timed(listing_event(user_id))
+        first_page.append(elapsed)
+        first_page_bytes = len(response['body'])
+        etag = response['headers'].get('ETag')
+        elapsed, _ = timed(listing_event(user_id, {'limit': '500'}))
+        page_500.append(elapsed)
+        elapsed, response = timed(listing_event(user_id, headers={'If-None-Match': etag}))
+        not_modified.append(elapsed)
+        if response['statusCode'] != 304:
+            raise RuntimeError(f"Expected 304 for a matching ETag, got {response['statusCode']}")
+        elapsed, _ = timed(listing_event(user_id))
+        cached_page.append(elapsed)
+    api.listing_cache.invalidate(user_id)
+
+    # Walk the whole library the way the frontend does
+    pages = 0
+    cursor = None
+    started = time.perf_counter()
+    while True:
+        query = {'limit': '500'}
+        if cursor:
+            query['cursor'] = cursor
+        response = api.lambda_handler(listing_event(user_id, query), None)
+        body = json.loads(response['body'])
+        pages += 1
+        cursor = body.get('next_cursor')
+        if not cursor:
+            break
+    full_walk_ms = (time.perf_counter() - started) * 1000
+
+    return {
+        'library_size': library_size,
+        'first_page_ms': percentiles(first_page),
+        'page_500_ms': percentiles(page_500),
+        'not_modified_ms': percentiles(not_modified),
+        'cached_page_ms': percentiles(cached_page),
+        'full_walk_ms': round(full_walk_ms, 3),
+        'full_walk_pages': pages,
+        'first_page_bytes': first_page_bytes,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+def run_isolated(function, *args):
+    """Run a benchmark case in a fresh interpreter"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(function, *args).result()
+
+def lookup(result, dotted):
+    value = result
+    for part in dotted.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def compare(results, baseline, threshold, noise_floor_ms):
+    """Print relative changes against a baseline run; returns the regressions found"""
+    regressions = []
+    for section, metrics in COMPARED_METRICS.items():
+        identity = (lambda r: (r['kind'], r['megapixels'])) if section == 'resizer' else (lambda r: r['library_size'])
+        previous = {identity(entry): entry for entry in baseline.get(section, [])}
+        for entry in results.get(section, []):
+            old = previous.get(identity(entry))
+            if not old:
+                continue
+            for metric, higher_is_better in metrics.items():
+                before, after = lookup(old, metric), lookup(entry, metric)
+                if not before or after is None:
+                    continue
+                change = (after - before) / before
+                worse = -change if higher_is_better else change
+                # Sub-millisecond timings jitter by more than any sensible threshold
+                is_timing = metric.endswith('_ms') or '_ms.' in metric
+                flag = 'REGRESSION' if worse > threshold and not (is_timing and abs(after - before) < noise_floor_ms) else ''
+                print(f"  {section:8} {str(identity(entry)):>16} {metric:28} {before:>12.3f} -> {after:>12.3f} "
+                      f"({change:+.1%}) {flag}")
+                if flag:
+                    regressions.append({'section': section, 'case': str(identity(entry)), 'metric': metric,
+                                        'before': before, 'after': after, 'change': round(change, 4)})
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON results file to write')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown reported as a regression (default 0.10)')
+    parser.add_argument('--noise-floor-ms', type=float, default=1.0,
+                        help='timing changes smaller than this are never reported as regressions')
+    parser.add_argument('--megapixels', type=float, nargs='+', default=DEFAULT_MEGAPIXELS)
+    parser.add_argument('--kinds', nargs='+', choices=sorted(IMAGE_KINDS), default=list(IMAGE_KINDS))
+    parser.add_argument('--iterations', type=int, default=3, help='single-image invocations per corpus entry')
+    parser.add_argument('--batch-size', type=int, default=8, help='records per event in the throughput run')
+    parser.add_argument('--library-sizes', type=int, nargs='+', default=DEFAULT_LIBRARY_SIZES)
+    parser.add_argument('--list-iterations', type=int, default=20, help='listing requests per library size')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='simulated round-trip time added to every S3/DynamoDB call')
+    parser.add_argument('--skip-resizer', action='store_true')
+    parser.add_argument('--skip-api', action='store_true')
+    parser.add_argument('--quick', action='store_true',
+                        help='small corpus (0.3 and 2 MP, up to 1000 images) for a fast smoke run')
+    args = parser.parse_args()
+    if args.quick:
+        args.megapixels = [0.3, 2]
+        args.library_sizes = [10, 100, 1000]
+        args.iterations = 2
+        args.batch_size = 4
+        args.list_iterations = 5
+    return args
+
+def main():
+    args = parse_args()
+    import PIL
+    results = {
+        'schema_version': 1,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'resizer': [],
+        'api': []
+    }
+
+    if not args.skip_resizer:
+        print('Resizer (per-image latency, batch throughput, peak RSS, bytes written):')
+        for megapixels in args.megapixels:
+            for kind in args.kinds:
+                payload, content_type, (width, height) = encode_synthetic(kind, megapixels)
+                result = run_isolated(run_resizer_case, kind, megapixels, payload, content_type,
+                                      args.iterations, args.batch_size, args.latency_ms)
+                result.update({'width': width, 'height': height})
+                results['resizer'].append(result)
+                print(f"  {kind:8} {megapixels:>5g} MP  p50 {result['latency_ms']['p50']:>9.1f} ms  "
+                      f"p99 {result['latency_ms']['p99']:>9.1f} ms  {result['throughput_images_per_s']:>7.2f} img/s  "
+                      f"peak {result['peak_rss_mb']:>7.1f} MB  {result['bytes_written_per_image']:>9} B out"
+                      + (f"  {result['failures']} FAILED" if result['failures'] else ''))
+
+    if not args.skip_api:
+        print('API listing latency by library size:')
+        for library_size in args.library_sizes:
+            result = run_isolated(run_api_case, library_size, args.list_iterations, args.latency_ms)
+            results['api'].append(result)
+            print(f"  {library_size:>7} images  first page p50 {result['first_page_ms']['p50']:>8.2f} ms  "
+                  f"limit=500 p50 {result['page_500_ms']['p50']:>8.2f} ms  304 p50 {result['not_modified_ms']['p50']:>6.2f} ms  "
+                  f"cached p50 {result['cached_page_ms']['p50']:>6.2f} ms  "
+                  f"full walk {result['full_walk_ms']:>9.1f} ms ({result['full_walk_pages']} pages)")
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"Comparison against {args.compare}:")
+        results['regressions'] = compare(results, baseline, args.threshold, args.noise_floor_ms)
+        exit_code = 1 if results['regressions'] else 0
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -40,6 +40,9 @@ Amplify.configure({
   },
 });
 
+// Listing fields the gallery and the image modal use
+const LISTING_FIELDS = 'originalKey,thumbnailUrl,originalName,uploadTime,size,originalWidth,originalHeight,placeholder,dominantColor';
+
 function App() {
   return (
     <Authenticator>
@@ -51,7 +54,46 @@ function App() {
 }
 
 // Image Modal Component
-function ImageModal({ image, onClose }) {
+function ImageModal({ image, user, onClose }) {
+  const [originalImageUrl, setOriginalImageUrl] = useState(null);
+
+  const imageId = image?.id;
+  const originalKey = image?.originalKey;
+  // An upload is listed under its file name until the resizer has written its
+  // row; that placeholder ID is unknown to the API
+  const rowLoaded = Boolean(image) && !image.processing && image.id !== image.originalKey;
+  const username = user?.username;
+
+  // Originals are private; the API hands out a presigned URL. The thumbnail
+  // is shown until it arrives.
+  useEffect(() => {
+    setOriginalImageUrl(null);
+    if (!imageId) return undefined;
+    const publicUrl = `https://${process.env.REACT_APP_IMAGES_BUCKET}.s3.${process.env.REACT_APP_AWS_REGION}.amazonaws.com/${originalKey}`;
+    const apiUrl = process.env.REACT_APP_API_GATEWAY_URL;
+    if (!apiUrl || !username) {
+      setOriginalImageUrl(publicUrl);
+      return undefined;
+    }
+    // Runs again with the real ID once the row has loaded
+    if (!rowLoaded) return undefined;
+
+    let cancelled = false;
+    fetch(`${apiUrl}/api/user/${encodeURIComponent(username)}/originals?ids=${encodeURIComponent(imageId)}`)
+      .then((response) => (response.ok ? response.json() : null))
+      .then((data) => {
+        const original = data?.originals?.[0];
+        if (!cancelled) setOriginalImageUrl(original ? original.url : publicUrl);
+      })
+      .catch((error) => {
+        console.error('Failed to get original image URL:', error);
+        if (!cancelled) setOriginalImageUrl(publicUrl);
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [imageId, originalKey, rowLoaded, username]);
+
   if (!image) return null;
 
   const handleBackdropClick = (e) => {
@@ -60,8 +102,6 @@ function ImageModal({ image, onClose }) {
     }
   };
 
-  const originalImageUrl = `https://${process.env.REACT_APP_IMAGES_BUCKET}.s3.${process.env.REACT_APP_AWS_REGION}.amazonaws.com/${image.originalKey}`;
-
   return (
     <div className="modal-backdrop" onClick={handleBackdropClick}>
       <div className="modal-content">
@@ -72,7 +112,7 @@ function ImageModal({ image, onClose }) {
         </button>
         <div className="modal-image-container">
           <img
-            src={originalImageUrl}
+            src={originalImageUrl || image.thumbnailUrl}
             alt={image.originalName}
             className="modal-image"
             onError={(e) => {
@@ -142,24 +182,49 @@ function PhotoSharingApp({ user, signOut }) {
       const apiUrl = process.env.REACT_APP_API_GATEWAY_URL;
       if (apiUrl && user?.username) {
         try {
-          console.log('Fetching images from API:', `${apiUrl}/api/user/${encodeURIComponent(user.username)}/images`);
-          const response = await fetch(`${apiUrl}/api/user/${encodeURIComponent(user.username)}/images`, {
-            method: 'GET',
-            headers: {
-              'Content-Type': 'application/json',
-            },
-          });
-          
-          if (response.ok) {
+          const listUrl = `${apiUrl}/api/user/${encodeURIComponent(user.username)}/images`;
+          console.log('Fetching images from API:', listUrl);
+
+          // The API returns one page at a time; follow next_cursor until done.
+          // Only the fields the gallery and modal show are requested, in the
+          // compact shape whose URLs are relative to data.urlBase.
+          const allImages = [];
+          let cursor = null;
+          let failed = false;
+          do {
+            const params = new URLSearchParams({ format: 'compact', fields: LISTING_FIELDS });
+            if (cursor) params.set('cursor', cursor);
+            const pageUrl = `${listUrl}?${params}`;
+            const response = await fetch(pageUrl, {
+              method: 'GET',
+              headers: {
+                'Content-Type': 'application/json',
+              },
+            });
+
+            if (!response.ok) {
+              console.warn('API request failed:', response.status, response.statusText);
+              failed = true;
+              break;
+            }
+
             const data = await response.json();
             console.log('API Response:', data);
-            if (data.images && Array.isArray(data.images)) {
-              setImages(data.images);
-              if (showLoading) setLoading(false);
-              return;
+            if (!data.images || !Array.isArray(data.images)) {
+              failed = true;
+              break;
             }
-          } else {
-            console.warn('API request failed:', response.status, response.statusText);
+            allImages.push(...data.images.map((image) => ({
+              ...image,
+              thumbnailUrl: data.urlBase + image.thumbnailUrl
+            })));
+            cursor = data.next_cursor;
+          } while (cursor);
+
+          if (!failed) {
+            setImages(allImages);
+            if (showLoading) setLoading(false);
+            return;
           }
         } catch (error) {
           console.error('Error fetching from API:', error);
@@ -181,17 +246,24 @@ function PhotoSharingApp({ user, signOut }) {
   const handleFileUpload = async (file) => {
     if (!file) return;
 
+    // ZIP archives are imported server-side, one image at a time
+    const isArchive = file.name.toLowerCase().endsWith('.zip');
+
     // Validate file type
-    if (!file.type.startsWith('image/')) {
-      showMessage('Please select an image file', 'error');
+    if (!file.type.startsWith('image/') && !isArchive) {
+      showMessage('Please select an image file or a ZIP archive', 'error');
       return;
     }
 
-    // Validate file size (max 10MB)
-    if (file.size > 10 * 1024 * 1024) {
+    // Validate file size (max 10MB per image, 500MB per archive)
+    if (!isArchive && file.size > 10 * 1024 * 1024) {
       showMessage('File size must be less than 10MB', 'error');
       return;
     }
+    if (isArchive && file.size > 500 * 1024 * 1024) {
+      showMessage('Archive size must be less than 500MB', 'error');
+      return;
+    }
 
     // Check if environment variables are set
     if (!process.env.REACT_APP_IMAGES_BUCKET) {
@@ -226,7 +298,7 @@ function PhotoSharingApp({ user, signOut }) {
         key: fileName,
         data: file,
         options: {
-          contentType: file.type,
+          contentType: file.type || (isArchive ? 'application/zip' : undefined),
           metadata: {
             'user-id': user.username,
             'upload-time': new Date().toISOString(),
@@ -244,6 +316,13 @@ function PhotoSharingApp({ user, signOut }) {
       console.log('Upload result:', result);
       
       setUploadProgress(100);
+
+      if (isArchive) {
+        showMessage('Archive uploaded! Importing images...', 'info');
+        followArchiveImport(fileName);
+        return;
+      }
+
       showMessage('Image uploaded successfully! Processing thumbnail...', 'success');
       
       // Add image to state immediately for better UX
@@ -264,36 +343,45 @@ function PhotoSharingApp({ user, signOut }) {
       const updatedImages = [newImage, ...images];
       localStorage.setItem(`user_images_${user.username}`, JSON.stringify(updatedImages));
       
-      // Check for thumbnail processing - reduced frequency to avoid constant refreshing
+      // Long-poll the single-upload status endpoint; the API holds each request
+      // until the resizer has finished, so no fixed polling interval is needed
       let attempts = 0;
-      const maxAttempts = 6; // Reduced from 10
+      const maxAttempts = 3;
       const checkThumbnail = async () => {
         attempts++;
-        
+
         try {
           const apiUrl = process.env.REACT_APP_API_GATEWAY_URL;
           if (apiUrl) {
-            const response = await fetch(`${apiUrl}/api/user/${encodeURIComponent(user.username)}/images`);
+            const response = await fetch(`${apiUrl}/api/user/${encodeURIComponent(user.username)}/status?original_key=${encodeURIComponent(fileName)}&wait=20`);
             if (response.ok) {
               const data = await response.json();
-              const processedImage = data.images?.find(img => img.originalKey === fileName);
-              
-              if (processedImage && !processedImage.processing) {
+
+              if (data.status === 'processed' && data.image) {
                 console.log('Thumbnail processed successfully');
-                setImages(prev => prev.map(img => 
-                  img.id === fileName ? { ...processedImage, processing: false, realUpload: true } : img
-                ));
+                const loadedImage = { ...data.image, processing: false, realUpload: true };
+                setImages(prev => prev.map(img => (img.id === fileName ? loadedImage : img)));
+                // A modal opened on the placeholder switches to the real row
+                setSelectedImage(selected => (selected?.id === fileName ? loadedImage : selected));
                 showMessage('Thumbnail processed successfully!', 'success');
                 return;
               }
+
+              if (data.status === 'error') {
+                setImages(prev => prev.map(img =>
+                  img.id === fileName ? { ...img, processing: false, error: 'Processing failed' } : img
+                ));
+                showMessage('Image uploaded but thumbnail processing failed', 'error');
+                return;
+              }
             }
           }
         } catch (error) {
           console.log('API check failed, continuing to wait...');
         }
-        
+
         if (attempts < maxAttempts) {
-          setTimeout(checkThumbnail, 5000); // Increased interval to 5 seconds
+          setTimeout(checkThumbnail, 1000);
         } else {
           console.warn('Thumbnail processing timed out');
           setImages(prev => prev.map(img => 
@@ -305,8 +393,8 @@ function PhotoSharingApp({ user, signOut }) {
         }
       };
       
-      // Start checking for thumbnail after 8 seconds (increased delay)
-      setTimeout(checkThumbnail, 8000);
+      // Start waiting for the thumbnail right away; the request blocks server-side
+      checkThumbnail();
       
     } catch (error) {
       console.error('Upload error:', error);
@@ -317,6 +405,51 @@ function PhotoSharingApp({ user, signOut }) {
     }
   };
 
+  // Follow a ZIP import through the status endpoint; the job reports per-image results
+  const followArchiveImport = async (fileName) => {
+    const apiUrl = process.env.REACT_APP_API_GATEWAY_URL;
+    if (!apiUrl) return;
+
+    // Large archives are imported over several resizer invocations
+    const maxAttempts = 45;
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+      try {
+        const response = await fetch(`${apiUrl}/api/user/${encodeURIComponent(user.username)}/status?original_key=${encodeURIComponent(fileName)}&wait=20`);
+        if (response.ok) {
+          const data = await response.json();
+          const job = data.import;
+
+          if (data.status === 'processed' && job) {
+            loadImages(false);
+            const imported = job.processed + job.deduplicated;
+            if (job.failed > 0) {
+              showMessage(`Imported ${imported} of ${job.total} images; ${job.failed} could not be processed`, 'warning');
+            } else {
+              showMessage(`Imported ${imported} images from the archive`, 'success');
+            }
+            return;
+          }
+
+          if (data.status === 'error') {
+            showMessage(`Archive import failed: ${data.error_message || 'unknown error'}`, 'error');
+            loadImages(false);
+            return;
+          }
+
+          if (job && job.total) {
+            showMessage(`Importing images... ${job.completed} of ${job.total}`, 'info');
+          }
+        }
+      } catch (error) {
+        console.log('API check failed, continuing to wait...');
+        await new Promise(resolve => setTimeout(resolve, 1000));
+      }
+    }
+
+    showMessage('The archive is still being imported; refresh later to see every image', 'warning');
+    loadImages(false);
+  };
+
   const deleteImage = async (imageId, originalKey) => {
     if (!window.confirm('Are you sure you want to delete this image? This action cannot be undone.')) {
       return;
@@ -497,7 +630,7 @@ function PhotoSharingApp({ user, signOut }) {
           >
             <input
               type="file"
-              accept="image/*"
+              accept="image/*,.zip"
               onChange={handleFileInputChange}
               disabled={uploading}
               className="file-input"
@@ -528,7 +661,7 @@ function PhotoSharingApp({ user, signOut }) {
                   </div>
                   <div className="upload-text">
                     <span className="upload-primary">Choose files or drag here</span>
-                    <span className="upload-secondary">Supports: JPG, PNG, GIF (Max: 10MB)</span>
+                    <span className="upload-secondary">Supports: JPG, PNG, GIF (Max: 10MB) or a ZIP of images</span>
                   </div>
                 </div>
               )}
@@ -575,7 +708,16 @@ function PhotoSharingApp({ user, signOut }) {
             <div className="gallery">
               {images.map((image) => (
                 <div key={image.id} className="gallery-item">
-                  <div className="image-container" onClick={() => handleImageClick(image)}>
+                  <div
+                    className="image-container"
+                    onClick={() => handleImageClick(image)}
+                    style={image.placeholder ? {
+                      backgroundColor: image.dominantColor,
+                      backgroundImage: `url(${image.placeholder})`,
+                      backgroundSize: 'cover',
+                      backgroundPosition: 'center'
+                    } : undefined}
+                  >
                     {image.processing ? (
                       <div className="image-placeholder processing">
                         <div className="spinner"></div>
@@ -667,7 +809,7 @@ function PhotoSharingApp({ user, signOut }) {
       </main>
       
       {/* Image Modal */}
-      <ImageModal image={selectedImage} onClose={handleCloseModal} />
+      <ImageModal image={selectedImage} user={user} onClose={handleCloseModal} />
       
       <DebugInfo />
     </div>
@@ -0,0 +1,94 @@
+"""Recompute the per-user usage totals from the metadata table.
+
+The resizer and the delete endpoints keep image_count, original_bytes,
+thumbnail_bytes and last_upload_time on each user's summary row up to date with
+atomic ADD updates, but rows written before those totals existed are not
+counted. This command scans the table once and overwrites every user's totals
+with the real values. Run it once after deploying, preferably while uploads are
+quiet: a write landing between the scan and the update is not reflected.
+
+    python lambda/backfill_usage.py --table my-table
+    python lambda/backfill_usage.py --table my-table --dry-run
+"""
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+LAMBDA_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_DIR = os.path.join(os.path.dirname(LAMBDA_DIR), 'shared')
+# The summary row layout and the byte accounting the Lambdas use
+sys.path.insert(0, SHARED_DIR)
+from metadata_table import rendition_object_bytes, user_summary_id
+
+def scan_totals(table):
+    """Usage totals per user over every processed row
+
+    Identical uploads share rendition objects, so thumbnail bytes are summed over
+    each user's distinct object keys rather than per row.
+    """
+    totals = {}
+    thumbnails = {}
+    kwargs = {
+        'FilterExpression': Attr('status').eq('processed') & Attr('user_id').exists(),
+        'ProjectionExpression': 'user_id, original_size, thumbnail_key, thumbnail_size, renditions, upload_time'
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for row in response.get('Items', []):
+            usage = totals.setdefault(row['user_id'], {
+                'image_count': 0, 'original_bytes': 0, 'thumbnail_bytes': 0, 'last_upload_time': None
+            })
+            usage['image_count'] += 1
+            usage['original_bytes'] += row.get('original_size', 0)
+            thumbnails.setdefault(row['user_id'], {}).update(rendition_object_bytes(row))
+            if row.get('upload_time') and (usage['last_upload_time'] or '') < row['upload_time']:
+                usage['last_upload_time'] = row['upload_time']
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    for user_id, usage in totals.items():
+        usage['thumbnail_bytes'] = sum(thumbnails[user_id].values())
+    return totals
+
+def write_totals(table, user_id, usage):
+    """Overwrite one user's totals; the version bump makes cached listings revalidate"""
+    update = 'SET image_count = :images, original_bytes = :original, thumbnail_bytes = :thumbnail'
+    values = {
+        ':images': usage['image_count'],
+        ':original': usage['original_bytes'],
+        ':thumbnail': usage['thumbnail_bytes'],
+        ':one': 1
+    }
+    if usage['last_upload_time']:
+        update += ', last_upload_time = :upload_time'
+        values[':upload_time'] = usage['last_upload_time']
+    table.update_item(
+        Key={'image_id': user_summary_id(user_id)},
+        UpdateExpression=f"{update} ADD #version :one",
+        ExpressionAttributeNames={'#version': 'version'},
+        ExpressionAttributeValues=values
+    )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--table', required=True, help='metadata DynamoDB table')
+    parser.add_argument('--dry-run', action='store_true', help='print the totals without writing them')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    table = boto3.resource('dynamodb').Table(args.table)
+    totals = scan_totals(table)
+    for user_id, usage in sorted(totals.items()):
+        print(f"{user_id}: {usage['image_count']} images, {usage['original_bytes']} original bytes, "
+              f"{usage['thumbnail_bytes']} thumbnail bytes, last upload {usage['last_upload_time']}")
+        if not args.dry_run:
+            write_totals(table, user_id, usage)
+    print(f"{'Would update' if args.dry_run else 'Updated'} {len(totals)} users")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,234 +1,1351 @@
 import json
-import boto3
 import os
 import uuid
+import hashlib
+import resource
+import time
+import tempfile
+import importlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image
+import math
 import io
+import base64
+import mimetypes
+import zipfile
+import zlib
 from urllib.parse import unquote_plus
+from instrumentation import Metrics, StartupProfile, get_logger, mark_invocation
+from metadata_table import (
+    CONTENT_HASH_INDEX, PRIMARY_THUMBNAIL_SIZE, USER_ID_INDEX, counted_thumbnail_bytes, deserialize_item,
+    get_rendition_key, image_key, phash_entries, rendition_object_keys, serialize_item, status_row_id,
+    user_summary_id
+)
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
+# STARTUP_PROFILE=true prints how long each of these phases took on a cold start
+startup = StartupProfile('image-resizer')
+with startup.phase('import_boto3'):
+    import boto3
+    from botocore.config import Config
+# Only the core of Pillow is imported here; format plugins are loaded on demand,
+# by Image.open for inputs and by get_output_formats for the modern outputs
+with startup.phase('import_pillow'):
+    from PIL import Image
+
+logger = get_logger('image-resizer')
 
 # Environment variables
 THUMBNAIL_BUCKET = os.environ['THUMBNAIL_BUCKET']
 METADATA_TABLE = os.environ['METADATA_TABLE']
+# Memory the function is configured with (set by the Lambda runtime)
+MEMORY_SIZE_MB = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '2048'))
+# Configured memory per default worker; each one holds a decoded image at a time
+MEMORY_PER_WORKER_MB = 512
+# Number of records processed concurrently per invocation (1 = sequential); by
+# default one per MEMORY_PER_WORKER_MB of configured memory, at most 4
+MAX_WORKERS = max(1, int(os.environ.get('RESIZER_MAX_WORKERS') or min(4, MEMORY_SIZE_MB // MEMORY_PER_WORKER_MB)))
+# Longest-side pixel sizes of the renditions generated for every image
+RENDITION_SIZES = sorted(
+    {int(size) for size in os.environ.get('RENDITION_SIZES', '200,400,1080,2048').split(',') if size.strip()}
+    | {PRIMARY_THUMBNAIL_SIZE},
+    reverse=True
+)
+# Interpreter, boto3 and Pillow before any image is decoded
+RUNTIME_BASELINE_MB = 100
+# Working set per decoded pixel: the RGB(A) bitmap plus the first resize or mode conversion
+BYTES_PER_DECODED_PIXEL = 8
+# Decoded pixel budget; JPEGs are DCT-downscaled to fit it, anything else above it is
+# rejected. By default the memory left over the baseline is split between the workers
+MAX_IMAGE_MEGAPIXELS = float(os.environ.get('MAX_IMAGE_MEGAPIXELS') or min(
+    50, max(1, (MEMORY_SIZE_MB - RUNTIME_BASELINE_MB) / MAX_WORKERS / BYTES_PER_DECODED_PIXEL)))
+# Images whose header claims more than this are refused outright as decompression bombs
+DECOMPRESSION_BOMB_MEGAPIXELS = float(os.environ.get('DECOMPRESSION_BOMB_MEGAPIXELS', '200'))
+# Downloads up to this size stay in memory, larger ones are spooled to /tmp
+INGEST_SPOOL_MAX_BYTES = int(os.environ.get('INGEST_SPOOL_MAX_BYTES', str(16 * 1024 * 1024)))
+INGEST_CHUNK_SIZE = 1024 * 1024
 
-table = dynamodb.Table(METADATA_TABLE)
+# One pooled, keep-alive S3 client and one DynamoDB client shared by all worker
+# threads and reused across warm invocations; the pools cover every worker's
+# concurrent requests. Low-level clients are thread-safe, unlike the boto3
+# resource layer, and rows are converted with the metadata_table helpers.
+client_config = Config(max_pool_connections=max(10, MAX_WORKERS * 2), tcp_keepalive=True)
+with startup.phase('s3_client'):
+    s3 = boto3.client('s3', config=client_config)
+with startup.phase('dynamodb_client'):
+    dynamodb = boto3.client('dynamodb', config=client_config)
 
-def lambda_handler(event, context):
+# Modern formats stored next to the JPEG/PNG fallback; unsupported ones are skipped.
+# AVIF is opt-in: with every rendition size it costs several times the WebP encode
+OUTPUT_FORMATS = [fmt.strip().lower() for fmt in os.environ.get('OUTPUT_FORMATS', 'webp').split(',') if fmt.strip()]
+# 'all' stores every format; 'smallest' stores only the smallest one that meets TARGET_PSNR
+FORMAT_SELECTION = os.environ.get('FORMAT_SELECTION', 'all').lower()
+TARGET_PSNR = float(os.environ.get('TARGET_PSNR', '38'))
+QUALITY_LADDER = [40, 50, 60, 70, 80, 90]
+
+# Pillow save settings for every format the resizer knows how to emit; 'plugins'
+# are tried in order and the first module that imports registers the encoder
+FORMAT_SETTINGS = {
+    'webp': {'pil_format': 'WEBP', 'content_type': 'image/webp', 'quality': 80, 'params': {'method': 4},
+             'plugins': ['PIL.WebPImagePlugin']},
+    'avif': {'pil_format': 'AVIF', 'content_type': 'image/avif', 'quality': 60, 'params': {'speed': 6},
+             'plugins': ['PIL.AvifImagePlugin', 'pillow_avif']}
+}
+
+# Longest side of the inline preview stored with each row (0 disables it)
+PLACEHOLDER_SIZE = int(os.environ.get('PLACEHOLDER_SIZE', '32'))
+PLACEHOLDER_QUALITY = 40
+
+# Uploads ending in .zip are imported member by member as one job. Member originals
+# are copied under ARCHIVE_MEMBER_PREFIX in the images bucket, outside the prefix
+# the bucket notification fires for; events that reach the function anyway are skipped
+ARCHIVE_SUFFIX = '.zip'
+ARCHIVE_MEMBER_PREFIX = 'archive-members/'
+ARCHIVE_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+ARCHIVE_MAX_MEMBERS = int(os.environ.get('ARCHIVE_MAX_MEMBERS', '2000'))
+# Uncompressed size limit per member; reading stops there, whatever the header claims
+ARCHIVE_MAX_MEMBER_BYTES = int(os.environ.get('ARCHIVE_MAX_MEMBER_BYTES', str(50 * 1024 * 1024)))
+# Bytes fetched per ranged GET while streaming an archive from S3
+ARCHIVE_READ_SIZE = 8 * 1024 * 1024
+# Members whose rows are written per job checkpoint
+ARCHIVE_BATCH_SIZE = 25
+# Per-member results kept on the job row, well inside the 400 KB item limit
+ARCHIVE_MAX_RESULTS = 1000
+# Write requests per BatchWriteItem call (the DynamoDB limit)
+BATCH_WRITE_SIZE = 25
+# Remaining time at which an import stops and hands the rest to a new invocation
+ARCHIVE_TIME_RESERVE_MS = int(os.environ.get('ARCHIVE_TIME_RESERVE_MS', '60000'))
+
+# Fields copied from an existing row when identical bytes are uploaded again
+SHARED_RENDITION_FIELDS = (
+    'thumbnail_key', 'thumbnail_bucket', 'thumbnail_size', 'thumbnail_width', 'thumbnail_height',
+    'thumbnail_content_type', 'thumbnail_quality', 'renditions', 'original_width', 'original_height',
+    'placeholder', 'dominant_color', 'phash'
+)
+
+# Let Pillow enforce the same bomb limit for any code path that opens images
+Image.MAX_IMAGE_PIXELS = int(DECOMPRESSION_BOMB_MEGAPIXELS * 1_000_000)
+
+_executor = None
+_archive_executor = None
+_lambda_client = None
+_output_formats = None
+
+def get_executor():
+    """Return the worker pool, kept alive across warm invocations"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='resizer')
+    return _executor
+
+def get_archive_executor():
+    """Return the pool that renders archive members, separate so archive jobs never wait on themselves"""
+    global _archive_executor
+    if _archive_executor is None:
+        _archive_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='archive')
+    return _archive_executor
+
+def fit_size(width, height, max_side):
+    """Dimensions of width x height scaled down to fit a max_side box"""
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def plan_rendition_sizes(width, height):
+    """Rendition sizes worth producing, largest first; never upscales past the original"""
+    longest = max(width, height)
+    return [size for size in RENDITION_SIZES if size < longest or size == PRIMARY_THUMBNAIL_SIZE]
+
+def make_image_id(bucket, key, etag):
+    """Deterministic image ID for one version of an S3 object, so redeliveries map to the same row"""
+    etag = etag.strip('"')
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{bucket}/{key}#{etag}"))
+
+def download_to_spool(bucket, key):
+    """Stream an S3 object into a single spooled buffer; returns (response, spool, size, sha256)"""
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+    spool = tempfile.SpooledTemporaryFile(max_size=INGEST_SPOOL_MAX_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: body.read(INGEST_CHUNK_SIZE), b''):
+        spool.write(chunk)
+        digest.update(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return response, spool, size, digest.hexdigest()
+
+def get_row(image_id):
+    """The row stored under image_id, or None"""
+    return deserialize_item(dynamodb.get_item(TableName=METADATA_TABLE, Key=image_key(image_id)).get('Item'))
+
+def find_processed_image(image_id):
+    """Return the row for image_id if it was already processed successfully"""
+    item = get_row(image_id)
+    return item if item and item.get('status') == 'processed' else None
+
+def find_content_duplicate(content_hash_key):
+    """Return a processed row of the same user with identical bytes, if any"""
+    response = dynamodb.query(
+        TableName=METADATA_TABLE,
+        IndexName=CONTENT_HASH_INDEX,
+        KeyConditionExpression='content_hash_key = :hash',
+        ExpressionAttributeValues=serialize_item({':hash': content_hash_key}),
+        Limit=1
+    )
+    items = response.get('Items', [])
+    return deserialize_item(items[0]) if items else None
+
+def find_row_by_original(user_id, source_bucket, source_key):
+    """Row of an original stored under another image_id, preferring a processed one
+
+    Uploads processed before image IDs were derived from the S3 ETag have random
+    IDs, so reprocessing them must find the row by user and original key instead.
+    The upload's status row points at it directly; older rows are searched for in
+    the user's listing partition.
+    """
+    status = get_row(status_row_id(user_id, source_key))
+    if status and status.get('target_image_id'):
+        item = get_row(status['target_image_id'])
+        if item and item.get('original_key') == source_key:
+            return item
+
+    query_kwargs = {
+        'TableName': METADATA_TABLE,
+        'IndexName': USER_ID_INDEX,
+        'KeyConditionExpression': 'user_id = :user_id',
+        'FilterExpression': 'original_key = :key AND (original_bucket = :bucket OR attribute_not_exists(original_bucket))',
+        'ExpressionAttributeValues': serialize_item({':user_id': user_id, ':key': source_key, ':bucket': source_bucket})
+    }
+    found = None
+    while True:
+        response = dynamodb.query(**query_kwargs)
+        for item in map(deserialize_item, response.get('Items', [])):
+            if item.get('status') == 'processed':
+                return item
+            found = found or item
+        if 'LastEvaluatedKey' not in response:
+            return found
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def put_image_item(item):
+    """Write an item unless a processed row already exists; returns False on a lost race"""
     try:
-        # Get S3 event details
-        for record in event['Records']:
-            source_bucket = record['s3']['bucket']['name']
-            source_key = unquote_plus(record['s3']['object']['key'])
-            
-            # Skip if it's already a thumbnail
-            if source_key.startswith('thumb-'):
-                continue
-            
-            print(f"Processing: {source_key} from bucket: {source_bucket}")
-            
-            # Generate unique image ID
-            image_id = str(uuid.uuid4())
-            
-            # Define target key for thumbnail
-            target_key = f"thumb-{source_key}"
-            
+        # Error rows may be overwritten so that retries can repair them
+        dynamodb.put_item(
+            TableName=METADATA_TABLE,
+            Item=serialize_item(item),
+            ConditionExpression='attribute_not_exists(image_id) OR #status = :error',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues=serialize_item({':error': 'error'})
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def prepare_decode(image, sizes):
+    """Pick the decode size from the header and enforce the pixel budgets before decoding"""
+    width, height = image.size
+    if width * height > DECOMPRESSION_BOMB_MEGAPIXELS * 1_000_000:
+        raise ValueError(
+            f"Image is {width}x{height} ({width * height / 1_000_000:.1f} MP), above the "
+            f"{DECOMPRESSION_BOMB_MEGAPIXELS:g} MP decompression bomb limit"
+        )
+
+    # JPEG can decode directly at 1/2, 1/4 or 1/8 scale in the DCT domain, so a
+    # 24 MP photo is never expanded to full resolution just to make a 2048px copy.
+    # The scale is also raised until the decoded bitmap fits the pixel budget.
+    if image.format == 'JPEG':
+        request = fit_size(width, height, sizes[0]) if sizes else (width, height)
+        for scale in (1, 2, 4, 8):
+            if -(-width // scale) * -(-height // scale) <= MAX_IMAGE_MEGAPIXELS * 1_000_000:
+                break
+        request = (min(request[0], max(1, width // scale)), min(request[1], max(1, height // scale)))
+        image.draft(None, request)
+
+    # image.size now reflects what will actually be decoded
+    decoded_width, decoded_height = image.size
+    if decoded_width * decoded_height > MAX_IMAGE_MEGAPIXELS * 1_000_000:
+        raise ValueError(
+            f"Image decodes to {decoded_width}x{decoded_height}, above the "
+            f"{MAX_IMAGE_MEGAPIXELS:g} MP pixel budget"
+        )
+    return decoded_width, decoded_height
+
+def render_renditions(image, sizes, metrics):
+    """Yield (size, image) for each size in descending order from a single decode"""
+    # Palette images cannot be resampled with LANCZOS, so they are converted up
+    # front; RGBA is converted after the first downscale to avoid a full-size copy
+    if image.mode == 'P':
+        with metrics.stage('resize'):
+            image = image.convert('RGB')
+
+    current = image
+    for size in sizes:
+        with metrics.stage('resize'):
+            if max(current.size) > size:
+                current = current.resize(fit_size(current.width, current.height, size), Image.Resampling.LANCZOS)
+                # Free the full-resolution bitmap as soon as the first rendition exists
+                if image is not None:
+                    image.close()
+                    image = None
+            # Convert to RGB if necessary (for JPEG)
+            if current.mode == 'RGBA':
+                current = current.convert('RGB')
+        yield size, current
+
+def load_plugin(settings):
+    """Import the Pillow plugin for one output format instead of all of them via Image.init()"""
+    for module in settings['plugins']:
+        if settings['pil_format'] in Image.SAVE:
+            break
+        try:
+            with startup.phase(f"plugin_{settings['pil_format'].lower()}"):
+                importlib.import_module(module)
+        except ImportError:
+            continue
+    return settings['pil_format'] in Image.SAVE
+
+def get_output_formats():
+    """Configured modern formats this Pillow build can actually encode"""
+    global _output_formats
+    if _output_formats is None:
+        supported = []
+        for fmt in OUTPUT_FORMATS:
+            settings = FORMAT_SETTINGS.get(fmt)
+            if settings and load_plugin(settings):
+                supported.append(fmt)
+            else:
+                logger.warning("Output format '%s' is not supported by this Pillow build, skipping", fmt)
+        _output_formats = supported
+    return _output_formats
+
+def encode_variant(image, fmt, quality):
+    """Encode a rendition in one of FORMAT_SETTINGS at the given quality"""
+    settings = FORMAT_SETTINGS[fmt]
+    buffer = io.BytesIO()
+    image.save(buffer, settings['pil_format'], quality=quality, **settings['params'])
+    buffer.seek(0)
+    return buffer
+
+def measure_psnr(reference, buffer):
+    """Peak signal-to-noise ratio in dB of an encoded buffer against its source"""
+    # Only FORMAT_SELECTION=smallest needs these, so they stay out of the cold start
+    from PIL import ImageChops, ImageStat
+    with Image.open(buffer) as decoded:
+        difference = ImageChops.difference(reference, decoded.convert('RGB'))
+    buffer.seek(0)
+    mse = sum(rms ** 2 for rms in ImageStat.Stat(difference).rms) / 3
+    return math.inf if mse == 0 else 20 * math.log10(255 / math.sqrt(mse))
+
+def encode_for_target(image, fmt):
+    """Lowest-quality encoding of a format whose PSNR meets TARGET_PSNR (binary search)"""
+    reference = image.convert('RGB') if image.mode != 'RGB' else image
+    low, high = 0, len(QUALITY_LADDER) - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        buffer = encode_variant(image, fmt, QUALITY_LADDER[middle])
+        if measure_psnr(reference, buffer) >= TARGET_PSNR:
+            best = (buffer, QUALITY_LADDER[middle])
+            high = middle - 1
+        else:
+            low = middle + 1
+    # Nothing on the ladder reaches the target; fall back to the highest quality
+    return best or (encode_variant(image, fmt, QUALITY_LADDER[-1]), QUALITY_LADDER[-1])
+
+def encode_modern_formats(image, fallback_bytes):
+    """Encode the rendition in the configured formats; returns [(format, buffer, quality)]"""
+    formats = get_output_formats()
+    if FORMAT_SELECTION != 'smallest':
+        return [(fmt, encode_variant(image, fmt, FORMAT_SETTINGS[fmt]['quality']), FORMAT_SETTINGS[fmt]['quality'])
+                for fmt in formats]
+
+    # Size-aware mode: keep only the smallest candidate, and only if it beats the fallback
+    candidates = [(fmt,) + encode_for_target(image, fmt) for fmt in formats]
+    candidates = [c for c in candidates if c[1].getbuffer().nbytes < fallback_bytes]
+    if not candidates:
+        return []
+    return [min(candidates, key=lambda c: c[1].getbuffer().nbytes)]
+
+def make_placeholder(image):
+    """Tiny base64 data URI preview and dominant colour of an already decoded rendition"""
+    preview = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+    preview.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BILINEAR)
+
+    # The most common colour of a small median-cut palette, as a CSS hex colour
+    palette_image = preview.quantize(colors=8, method=Image.Quantize.MEDIANCUT)
+    _, index = max(palette_image.getcolors())
+    red, green, blue = palette_image.getpalette()[index * 3:index * 3 + 3]
+
+    # WebP previews are a few hundred bytes; JPEG headers alone are larger
+    buffer = io.BytesIO()
+    if load_plugin(FORMAT_SETTINGS['webp']):
+        preview.save(buffer, 'WEBP', quality=PLACEHOLDER_QUALITY)
+        mime_type = 'image/webp'
+    else:
+        preview.save(buffer, 'JPEG', quality=PLACEHOLDER_QUALITY)
+        mime_type = 'image/jpeg'
+    data = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return f"data:{mime_type};base64,{data}", f"#{red:02x}{green:02x}{blue:02x}"
+
+def make_phash(image):
+    """64-bit difference hash (dHash) of an already decoded rendition, as 16 hex digits"""
+    # 9x8 greyscale, one byte per pixel; each bit says whether a pixel is brighter
+    # than its right neighbour
+    pixels = image.convert('L').resize((9, 8), Image.Resampling.BOX).tobytes()
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return f"{bits:016x}"
+
+def batch_write(requests):
+    """Send write requests with BatchWriteItem, 25 per call, retrying unprocessed items with backoff"""
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = {METADATA_TABLE: requests[start:start + BATCH_WRITE_SIZE]}
+        delay = 0.05
+        while pending:
+            response = dynamodb.batch_write_item(RequestItems=pending)
+            pending = response.get('UnprocessedItems') or None
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+def index_phashes(user_id, added=(), removed=()):
+    """Write and delete the near-duplicate index entries of (image_id, phash) pairs
+
+    Entries are small items sent with BatchWriteItem, 25 per request. If the
+    index cannot be updated, the added images' rows get phash_index_status
+    'error', which reprocess.py --source errors picks up.
+    """
+    entries = {entry['image_id']: entry for image_id, phash in added for entry in phash_entries(user_id, image_id, phash)}
+    # Bands whose value did not change keep their entry
+    stale = {entry['image_id'] for image_id, phash in removed
+             for entry in phash_entries(user_id, image_id, phash)} - set(entries)
+    if not entries and not stale:
+        return
+    try:
+        batch_write(
+            [{'PutRequest': {'Item': serialize_item(entry)}} for entry in entries.values()]
+            + [{'DeleteRequest': {'Key': image_key(key)}} for key in sorted(stale)]
+        )
+    except Exception as index_error:
+        logger.error("Failed to update the near-duplicate index of %s: %s", user_id, index_error)
+        for image_id, _ in added:
             try:
-                # Download image from S3
-                response = s3.get_object(Bucket=source_bucket, Key=source_key)
-                image_content = response['Body'].read()
-                
-                # Get metadata from S3 object
-                s3_metadata = response.get('Metadata', {})
-                content_type = response.get('ContentType', 'image/jpeg')
-                
-                print(f"Downloaded image: {len(image_content)} bytes")
-                print(f"S3 Metadata received: {s3_metadata}")
-                
-                # Extract user ID from metadata with various possible keys
-                user_id = None
-                possible_user_keys = ['user-id', 'userid', 'user_id', 'User-Id', 'UserId']
-                for key in possible_user_keys:
-                    if key in s3_metadata:
-                        user_id = s3_metadata[key]
-                        print(f"Found user_id '{user_id}' with key '{key}'")
-                        break
-                
-                # If no user_id found in metadata, try to extract from object key or use unknown
-                if not user_id:
-                    print("No user_id found in metadata, using 'unknown'")
-                    user_id = 'unknown'
-                
-                # Extract other metadata
-                original_name = None
-                upload_time = None
-                
-                # Try different possible keys for original name
-                possible_name_keys = ['original-name', 'originalname', 'original_name', 'Original-Name', 'OriginalName']
-                for key in possible_name_keys:
-                    if key in s3_metadata:
-                        original_name = s3_metadata[key]
-                        break
-                
-                if not original_name:
-                    original_name = source_key
-                
-                # Try different possible keys for upload time
-                possible_time_keys = ['upload-time', 'uploadtime', 'upload_time', 'Upload-Time', 'UploadTime']
-                for key in possible_time_keys:
-                    if key in s3_metadata:
-                        upload_time = s3_metadata[key]
-                        break
-                
-                if not upload_time:
-                    upload_time = datetime.utcnow().isoformat()
-                
-                # Open and process image
-                image = Image.open(io.BytesIO(image_content))
-                
-                # Convert to RGB if necessary (for JPEG)
-                if image.mode in ('RGBA', 'P'):
-                    image = image.convert('RGB')
-                
-                # Get original dimensions
-                original_width, original_height = image.size
-                print(f"Original dimensions: {original_width}x{original_height}")
-                
-                # Create higher quality thumbnail (400x400 max, preserving aspect ratio)
-                # This will provide much clearer images compared to 150x150
-                max_thumbnail_size = 400
-                image.thumbnail((max_thumbnail_size, max_thumbnail_size), Image.Resampling.LANCZOS)
-                thumbnail_width, thumbnail_height = image.size
-                
-                print(f"Thumbnail dimensions: {thumbnail_width}x{thumbnail_height}")
-                
-                # Save thumbnail to bytes with higher quality
-                buffer = io.BytesIO()
-                
-                # Use higher quality settings for better image clarity
-                if content_type in ['image/png', 'image/PNG']:
-                    # For PNG, use PNG format to maintain transparency and quality
-                    image.save(buffer, "PNG", optimize=True)
-                    thumbnail_content_type = "image/png"
-                else:
-                    # For JPEG and other formats, use JPEG with high quality
-                    image.save(buffer, "JPEG", quality=90, optimize=True, progressive=True)
-                    thumbnail_content_type = "image/jpeg"
-                
-                buffer.seek(0)
-                
-                # Upload thumbnail to S3
+                dynamodb.update_item(
+                    TableName=METADATA_TABLE,
+                    Key=image_key(image_id),
+                    UpdateExpression='SET phash_index_status = :error, phash_index_error = :message',
+                    ConditionExpression='attribute_exists(image_id)',
+                    ExpressionAttributeValues=serialize_item({':error': 'error', ':message': str(index_error)})
+                )
+            except Exception as flag_error:
+                logger.error("Failed to flag the unindexed row %s: %s", image_id, flag_error)
+
+def get_container_peak_rss_mb():
+    """High-water mark of the container's resident set size in MB
+
+    ru_maxrss covers the whole process and never decreases, so it describes the
+    container so far (every worker thread and earlier invocation), not one image.
+    """
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def encode_image(image, content_type):
+    """Encode a rendition with the repo's quality settings; returns (buffer, content type)"""
+    buffer = io.BytesIO()
+
+    # Use higher quality settings for better image clarity
+    if content_type in ['image/png', 'image/PNG']:
+        # For PNG, use PNG format to maintain transparency and quality; optimize=True
+        # would retry at maximum compression, seconds per large rendition for a few %
+        image.save(buffer, "PNG")
+        output_content_type = "image/png"
+    else:
+        # For JPEG and other formats, use JPEG with high quality
+        image.save(buffer, "JPEG", quality=90, optimize=True, progressive=True)
+        output_content_type = "image/jpeg"
+
+    buffer.seek(0)
+    return buffer, output_content_type
+
+def update_user_summary(user_id, images=0, original_bytes=0, thumbnail_bytes=0, upload_time=None):
+    """Bump the user's listing version and adjust their usage totals in one atomic update
+
+    The version change makes the API stop answering 304. last_upload_time only
+    moves forward, so late or redelivered events never roll it back.
+    """
+    update = 'ADD #version :one, image_count :images, original_bytes :original, thumbnail_bytes :thumbnail'
+    values = {':one': 1, ':images': images, ':original': original_bytes, ':thumbnail': thumbnail_bytes}
+    kwargs = {
+        'TableName': METADATA_TABLE,
+        'Key': image_key(user_summary_id(user_id)),
+        'ExpressionAttributeNames': {'#version': 'version'}
+    }
+    try:
+        if upload_time:
+            try:
+                dynamodb.update_item(
+                    UpdateExpression=f"{update} SET last_upload_time = :upload_time",
+                    ConditionExpression='attribute_not_exists(last_upload_time) OR last_upload_time < :upload_time',
+                    ExpressionAttributeValues=serialize_item({**values, ':upload_time': upload_time}),
+                    **kwargs
+                )
+                return
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                # A newer upload is already recorded; only the counters change
+                pass
+        dynamodb.update_item(UpdateExpression=update, ExpressionAttributeValues=serialize_item(values), **kwargs)
+    except Exception as summary_error:
+        logger.error("Failed to update the summary row of %s: %s", user_id, summary_error)
+
+def write_status_row(user_id, source_key, image_id, status, error_message=None):
+    """Record the processing outcome of an upload under key#<user_id>#<original_key>"""
+    item = {
+        'image_id': status_row_id(user_id, source_key),
+        'target_image_id': image_id,
+        'status': status,
+        'updated_time': datetime.utcnow().isoformat()
+    }
+    if error_message:
+        item['error_message'] = error_message
+    try:
+        if status == 'error':
+            # A failed retry must not hide an upload that already succeeded
+            dynamodb.put_item(
+                TableName=METADATA_TABLE,
+                Item=serialize_item(item),
+                ConditionExpression='attribute_not_exists(#status) OR #status <> :processed',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues=serialize_item({':processed': 'processed'})
+            )
+        else:
+            dynamodb.put_item(TableName=METADATA_TABLE, Item=serialize_item(item))
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as status_error:
+        logger.error("Failed to write status row for %s: %s", source_key, status_error)
+
+def delete_stale_renditions(previous, item):
+    """Delete objects of a reprocessed row that its new renditions no longer use"""
+    stale = rendition_object_keys(previous) - rendition_object_keys(item)
+    if not stale:
+        return
+    try:
+        # Uploads deduplicated against this row still point at its objects
+        if previous.get('content_hash_key'):
+            query_kwargs = {
+                'TableName': METADATA_TABLE,
+                'IndexName': CONTENT_HASH_INDEX,
+                'KeyConditionExpression': 'content_hash_key = :hash',
+                'ExpressionAttributeValues': serialize_item({':hash': previous['content_hash_key']})
+            }
+            while stale:
+                response = dynamodb.query(**query_kwargs)
+                for other in map(deserialize_item, response.get('Items', [])):
+                    if other['image_id'] != item['image_id']:
+                        stale -= rendition_object_keys(other)
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if stale:
+            s3.delete_objects(
+                Bucket=previous.get('thumbnail_bucket') or THUMBNAIL_BUCKET,
+                Delete={'Objects': [{'Key': key} for key in sorted(stale)], 'Quiet': True}
+            )
+            logger.info("Deleted %d stale renditions of %s", len(stale), item['image_id'])
+    except Exception as cleanup_error:
+        logger.error("Failed to delete stale renditions of %s: %s", item['image_id'], cleanup_error)
+
+def read_upload_metadata(s3_metadata, source_key):
+    """User ID, original name and upload time from an upload's S3 metadata; upload time may be None"""
+    user_id = None
+    # Extract user ID from metadata with various possible keys
+    possible_user_keys = ['user-id', 'userid', 'user_id', 'User-Id', 'UserId']
+    for key in possible_user_keys:
+        if key in s3_metadata:
+            user_id = s3_metadata[key]
+            break
+
+    # If no user_id found in metadata, try to extract from object key or use unknown
+    if not user_id:
+        logger.warning("No user_id found in metadata of %s, using 'unknown'", source_key)
+        user_id = 'unknown'
+
+    # Extract other metadata
+    original_name = None
+
+    # Try different possible keys for original name
+    possible_name_keys = ['original-name', 'originalname', 'original_name', 'Original-Name', 'OriginalName']
+    for key in possible_name_keys:
+        if key in s3_metadata:
+            original_name = s3_metadata[key]
+            break
+
+    if not original_name:
+        original_name = source_key
+
+    upload_time = None
+    # Try different possible keys for upload time
+    possible_time_keys = ['upload-time', 'uploadtime', 'upload_time', 'Upload-Time', 'UploadTime']
+    for key in possible_time_keys:
+        if key in s3_metadata:
+            upload_time = s3_metadata[key]
+            break
+
+    return user_id, original_name, upload_time
+
+def image_item(image_id, user_id, source_bucket, source_key, original_name, original_size,
+               upload_time, content_type, content_hash):
+    """The metadata row of one original, without its rendition fields"""
+    return {
+        'image_id': image_id,
+        'user_id': user_id,
+        'original_key': source_key,
+        'original_bucket': source_bucket,
+        'original_name': original_name,
+        'original_size': original_size,
+        'upload_time': upload_time,
+        'processed_time': datetime.utcnow().isoformat(),
+        'content_type': content_type,
+        'content_hash': content_hash,
+        'content_hash_key': f"{user_id}#{content_hash}",
+        'status': 'processed'
+    }
+
+def reused_renditions(existing):
+    """Rendition fields of a row whose bytes are identical to the new upload"""
+    fields = {key: value for key, value in existing.items() if key in SHARED_RENDITION_FIELDS}
+    fields['deduplicated_from'] = existing['image_id']
+    return fields
+
+def render_image(spool, source_bucket, source_key, user_id, content_type, metrics):
+    """Decode one original, upload its renditions and return the row's rendition fields"""
+    with metrics.stage('decode'):
+        # Open the image; only the header is parsed at this point
+        image = Image.open(spool)
+
+        # Get original dimensions before draft() changes the decoded size
+        original_width, original_height = image.size
+
+        # Reject or downscale oversized images before anything is decoded
+        sizes = plan_rendition_sizes(original_width, original_height)
+        decoded_width, decoded_height = prepare_decode(image, sizes)
+        # Decode explicitly so the decode stage is not billed to the first resize
+        image.load()
+    logger.debug("Decoded %s (%dx%d) at %dx%d", source_key, original_width, original_height,
+                 decoded_width, decoded_height)
+
+    # Decode once and derive every rendition from the previous, larger one
+    renditions = []
+    for size, rendition in render_renditions(image, sizes, metrics):
+        rendition_key = get_rendition_key(source_key, size)
+        with metrics.stage('encode'):
+            buffer, rendition_content_type = encode_image(rendition, content_type)
+        rendition_bytes = buffer.getbuffer().nbytes
+        width, height = rendition.size
+        object_metadata = {
+            'original-key': source_key,
+            'original-bucket': source_bucket,
+            'processed-time': datetime.utcnow().isoformat(),
+            'user-id': user_id,
+            'thumbnail-size': f"{width}x{height}",
+            'original-size': f"{original_width}x{original_height}"
+        }
+
+        # Upload rendition to S3
+        with metrics.stage('s3_put'):
+            s3.put_object(
+                Bucket=THUMBNAIL_BUCKET,
+                Key=rendition_key,
+                Body=buffer,
+                ContentType=rendition_content_type,
+                CacheControl="max-age=31536000",  # 1 year cache
+                Metadata=object_metadata
+            )
+        metrics.add('rendition_bytes', rendition_bytes, 'Bytes')
+
+        # Modern formats live next to the fallback as <rendition key>.<format>
+        formats = []
+        with metrics.stage('encode'):
+            variants = encode_modern_formats(rendition, rendition_bytes)
+        for fmt, variant, quality in variants:
+            variant_key = f"{rendition_key}.{fmt}"
+            variant_bytes = variant.getbuffer().nbytes
+            with metrics.stage('s3_put'):
                 s3.put_object(
                     Bucket=THUMBNAIL_BUCKET,
-                    Key=target_key,
-                    Body=buffer,
-                    ContentType=thumbnail_content_type,
+                    Key=variant_key,
+                    Body=variant,
+                    ContentType=FORMAT_SETTINGS[fmt]['content_type'],
                     CacheControl="max-age=31536000",  # 1 year cache
-                    Metadata={
-                        'original-key': source_key,
-                        'original-bucket': source_bucket,
-                        'processed-time': datetime.utcnow().isoformat(),
-                        'user-id': user_id,
-                        'thumbnail-size': f"{thumbnail_width}x{thumbnail_height}",
-                        'original-size': f"{original_width}x{original_height}"
-                    }
+                    Metadata=object_metadata
                 )
-                
-                print(f"Uploaded thumbnail: {target_key}")
-                
-                # Calculate file sizes
-                original_size = len(image_content)
-                thumbnail_size = len(buffer.getvalue())
-                
-                print(f"File sizes - Original: {original_size} bytes, Thumbnail: {thumbnail_size} bytes")
-                
-                # Store metadata in DynamoDB
-                dynamodb_item = {
-                    'image_id': image_id,
-                    'user_id': user_id,
-                    'original_key': source_key,
-                    'thumbnail_key': target_key,
-                    'original_bucket': source_bucket,
-                    'thumbnail_bucket': THUMBNAIL_BUCKET,
-                    'original_name': original_name,
-                    'original_size': original_size,
-                    'thumbnail_size': thumbnail_size,
-                    'original_width': original_width,
-                    'original_height': original_height,
-                    'thumbnail_width': thumbnail_width,
-                    'thumbnail_height': thumbnail_height,
-                    'upload_time': upload_time,
-                    'processed_time': datetime.utcnow().isoformat(),
-                    'content_type': content_type,
-                    'thumbnail_content_type': thumbnail_content_type,
-                    'status': 'processed',
-                    'thumbnail_quality': 'high'  # Mark as high quality thumbnail
-                }
-                
-                print(f"Storing DynamoDB item: {dynamodb_item}")
-                
-                table.put_item(Item=dynamodb_item)
-                
-                print(f"Stored metadata for image: {image_id}")
-                
-                # Create public URL for thumbnail
-                # AWS_DEFAULT_REGION is automatically available in Lambda context
-                region = os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1')
-                thumbnail_url = f"https://{THUMBNAIL_BUCKET}.s3.{region}.amazonaws.com/{target_key}"
-                
-                print(f"Successfully processed {source_key} -> {target_key}")
-                print(f"Thumbnail URL: {thumbnail_url}")
-                print(f"User ID: {user_id}")
-                print(f"Quality: High ({thumbnail_width}x{thumbnail_height})")
-                
-            except Exception as e:
-                print(f"Error processing {source_key}: {str(e)}")
-                import traceback
-                print(f"Full traceback: {traceback.format_exc()}")
-                
-                # Store error metadata
-                try:
-                    error_user_id = user_id if 'user_id' in locals() else 'unknown'
-                    error_upload_time = upload_time if 'upload_time' in locals() else datetime.utcnow().isoformat()
-                    
-                    table.put_item(
-                        Item={
-                            'image_id': str(uuid.uuid4()),
-                            'user_id': error_user_id,
-                            'original_key': source_key,
-                            'original_bucket': source_bucket,
-                            'upload_time': error_upload_time,
-                            'processed_time': datetime.utcnow().isoformat(),
-                            'status': 'error',
-                            'error_message': str(e)
-                        }
-                    )
-                    print(f"Stored error metadata for failed processing")
-                except Exception as db_error:
-                    print(f"Failed to store error metadata: {db_error}")
-                
-                continue
-        
+            metrics.add('rendition_bytes', variant_bytes, 'Bytes')
+            formats.append({
+                'format': fmt,
+                'key': variant_key,
+                'bytes': variant_bytes,
+                'quality': quality,
+                'content_type': FORMAT_SETTINGS[fmt]['content_type']
+            })
+
+        renditions.append({
+            'size': size,
+            'key': rendition_key,
+            'width': width,
+            'height': height,
+            'bytes': rendition_bytes,
+            'content_type': rendition_content_type,
+            'formats': formats
+        })
+
+    # Renditions come largest first, so the last one is the cheapest source
+    placeholder = dominant_color = None
+    if PLACEHOLDER_SIZE > 0:
+        with metrics.stage('placeholder'):
+            placeholder, dominant_color = make_placeholder(rendition)
+    with metrics.stage('phash'):
+        phash = make_phash(rendition)
+
+    # The primary rendition keeps the legacy thumb-<key> name and fields
+    primary = next(r for r in renditions if r['size'] == PRIMARY_THUMBNAIL_SIZE)
+    target_key = primary['key']
+    thumbnail_width, thumbnail_height = primary['width'], primary['height']
+    thumbnail_content_type = primary['content_type']
+
+    # The decode above may have been DCT-downscaled to fit the pixel budget
+    metrics.add('decoded_megapixels', decoded_width * decoded_height / 1_000_000)
+
+    fields = {
+        'thumbnail_key': target_key,
+        'thumbnail_bucket': THUMBNAIL_BUCKET,
+        'thumbnail_size': primary['bytes'],
+        'original_width': original_width,
+        'original_height': original_height,
+        'thumbnail_width': thumbnail_width,
+        'thumbnail_height': thumbnail_height,
+        'renditions': renditions,
+        'thumbnail_content_type': thumbnail_content_type,
+        'thumbnail_quality': 'high',  # Mark as high quality thumbnail
+        'phash': phash
+    }
+    if placeholder:
+        # Inline preview and background colour the gallery paints before any thumbnail loads
+        fields['placeholder'] = placeholder
+        fields['dominant_color'] = dominant_color
+    return fields
+
+def lambda_handler(event, context):
+    cold_start = mark_invocation()
+    try:
+        records = event['Records']
+        logger.debug("Received event: %s", event)
+
+        # Overlap the S3/DynamoDB round trips of different records; every record
+        # is isolated in process_record, so one failure never aborts the batch
+        if MAX_WORKERS > 1 and len(records) > 1:
+            results = list(get_executor().map(lambda record: handle_record(record, cold_start, context), records))
+        else:
+            results = [handle_record(record, cold_start, context) for record in records]
+        # Printed once per container, after the first batch has loaded its plugins and clients
+        startup.report()
+
+        # Reported once per invocation: it is the container's peak, comparable to its memory size
+        peak_rss_mb = get_container_peak_rss_mb()
+        invocation_metrics = Metrics('image-resizer', cold_start)
+        invocation_metrics.set_property('Kind', 'invocation')
+        invocation_metrics.add('records', len(records))
+        invocation_metrics.add('container_peak_rss_mb', peak_rss_mb, 'Megabytes')
+        invocation_metrics.flush()
+        logger.info("Container peak RSS %.1f MB of %d MB after %d records", peak_rss_mb, MEMORY_SIZE_MB, len(records))
+
+        processed = [result for result in results if result['status'] in ('processed', 'deduplicated')]
+        failed = [result for result in results if result['status'] == 'error']
+        dedup_hits = sum(1 for result in results if result['status'] == 'deduplicated')
+        duplicate_deliveries = sum(1 for result in results if result['status'] == 'duplicate')
+
         return {
-            'statusCode': 200,
+            'statusCode': 207 if failed else 200,
+            # Partial-batch-failure style report of the keys that need a retry
+            'batchItemFailures': [{'itemIdentifier': result['key']} for result in failed],
             'body': json.dumps({
-                'message': 'Images processed successfully',
-                'processed_count': len(event['Records']),
+                'message': 'Images processed successfully' if not failed else 'Some images failed to process',
+                'processed_count': len(processed),
+                'skipped_count': len(results) - len(processed) - len(failed),
+                'failed_count': len(failed),
+                'failed_keys': [result['key'] for result in failed],
+                # Uploads whose bytes matched an existing image and skipped the resize
+                'dedup_hits': dedup_hits,
+                # Redelivered events whose row already existed
+                'duplicate_deliveries': duplicate_deliveries,
+                'container_peak_rss_mb': round(peak_rss_mb, 1),
                 'thumbnail_quality': 'high',
-                'max_thumbnail_size': 400
+                'max_thumbnail_size': PRIMARY_THUMBNAIL_SIZE,
+                'rendition_sizes': RENDITION_SIZES,
+                'output_formats': get_output_formats()
             })
         }
-        
+
     except Exception as e:
-        print(f"Error in lambda_handler: {str(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error in lambda_handler: %s", e)
         return {
             'statusCode': 500,
             'body': json.dumps({
                 'error': 'Error processing images',
                 'message': str(e)
             })
-        }
\ No newline at end of file
+        }
+
+def handle_record(record, cold_start=False, context=None):
+    """Route one S3 event record to the archive import or the single-image path"""
+    if is_archive(unquote_plus(record['s3']['object']['key'])):
+        return process_archive(record, cold_start, context)
+    return process_record(record, cold_start)
+
+def process_record(record, cold_start=False, reprocess=False):
+    """Create the thumbnail and metadata for one S3 event record
+
+    With reprocess=True (used by reprocess.py) the renditions are regenerated and
+    the row is overwritten even if the object was already processed.
+    """
+    source_bucket = record['s3']['bucket']['name']
+    source_key = unquote_plus(record['s3']['object']['key'])
+
+    # Skip if it's already a thumbnail
+    if source_key.startswith('thumb-'):
+        return {'key': source_key, 'status': 'skipped'}
+    # Archives go through process_archive, which also writes their members' rows
+    if is_archive(source_key) or (source_key.startswith(ARCHIVE_MEMBER_PREFIX) and not reprocess):
+        return {'key': source_key, 'status': 'skipped'}
+
+    logger.info("Processing %s from bucket %s", source_key, source_bucket)
+
+    # One metrics line per image; sampling is decided per image, not per batch
+    metrics = Metrics('image-resizer', cold_start)
+    metrics.set_property('Outcome', 'error')
+
+    image_id = None
+    user_id = None
+    upload_time = None
+    spool = None
+    previous = None
+
+    try:
+        # S3 delivers events at least once; the ID derived from bucket/key/ETag
+        # lets a redelivery find the row written by the first delivery
+        event_etag = record['s3']['object'].get('eTag')
+        if event_etag:
+            image_id = make_image_id(source_bucket, source_key, event_etag)
+            with metrics.stage('dynamodb_get'):
+                already_processed = not reprocess and find_processed_image(image_id)
+            if already_processed:
+                logger.info("Already processed %s as %s, skipping redelivery", source_key, image_id)
+                metrics.set_property('Outcome', 'duplicate')
+                return {'key': source_key, 'status': 'duplicate', 'image_id': image_id}
+
+        # Download image from S3 into one buffer that spills to /tmp when large
+        with metrics.stage('s3_get'):
+            response, spool, original_size, content_hash = download_to_spool(source_bucket, source_key)
+        metrics.add('original_bytes', original_size, 'Bytes')
+
+        if not image_id:
+            image_id = make_image_id(source_bucket, source_key, response.get('ETag', ''))
+            with metrics.stage('dynamodb_get'):
+                already_processed = not reprocess and find_processed_image(image_id)
+            if already_processed:
+                logger.info("Already processed %s as %s, skipping redelivery", source_key, image_id)
+                metrics.set_property('Outcome', 'duplicate')
+                return {'key': source_key, 'status': 'duplicate', 'image_id': image_id}
+
+        # Get metadata from S3 object
+        s3_metadata = response.get('Metadata', {})
+        content_type = response.get('ContentType', 'image/jpeg')
+
+        logger.debug("Downloaded %s: %d bytes (sha256 %s), metadata %s", source_key, original_size, content_hash, s3_metadata)
+
+        user_id, original_name, upload_time = read_upload_metadata(s3_metadata, source_key)
+
+        if reprocess:
+            # The row being replaced keeps its place in the listing and tells
+            # which renditions become stale
+            with metrics.stage('dynamodb_get'):
+                previous = get_row(image_id)
+                if previous is None:
+                    previous = find_row_by_original(user_id, source_bucket, source_key)
+            if previous:
+                # Rows with a random ID are rewritten under that ID, never duplicated
+                image_id = previous['image_id']
+        if not upload_time:
+            upload_time = (previous or {}).get('upload_time') or datetime.utcnow().isoformat()
+
+        dynamodb_item = image_item(
+            image_id, user_id, source_bucket, source_key, original_name, original_size,
+            upload_time, content_type, content_hash
+        )
+
+        # Identical bytes already uploaded by this user: point the new row at the
+        # existing renditions and skip decode, encode and upload entirely
+        existing = None
+        if not reprocess:
+            with metrics.stage('dynamodb_query'):
+                existing = find_content_duplicate(dynamodb_item['content_hash_key'])
+        if existing:
+            dynamodb_item.update(reused_renditions(existing))
+        else:
+            dynamodb_item.update(render_image(spool, source_bucket, source_key, user_id, content_type, metrics))
+
+        logger.debug("Storing DynamoDB item: %s", dynamodb_item)
+
+        with metrics.stage('dynamodb_put'):
+            if reprocess:
+                # Reprocessing replaces the row in place, whatever its status
+                dynamodb.put_item(TableName=METADATA_TABLE, Item=serialize_item(dynamodb_item))
+                stored = True
+            else:
+                stored = put_image_item(dynamodb_item)
+            if stored:
+                # A reprocessed row replaces one that is already counted
+                counted = previous if (previous or {}).get('status') == 'processed' else {}
+                update_user_summary(
+                    user_id,
+                    images=0 if counted else 1,
+                    original_bytes=original_size - counted.get('original_size', 0),
+                    thumbnail_bytes=counted_thumbnail_bytes(dynamodb_item) - (counted_thumbnail_bytes(counted) if counted else 0),
+                    upload_time=None if reprocess else upload_time
+                )
+                write_status_row(user_id, source_key, image_id, 'processed')
+                # Rows deduplicated from a pre-phash image have none until reprocessed;
+                # reprocessing always rewrites the entries, which repairs a failed index
+                if reprocess or dynamodb_item.get('phash') != (previous or {}).get('phash'):
+                    index_phashes(
+                        user_id,
+                        added=[(image_id, dynamodb_item['phash'])] if dynamodb_item.get('phash') else [],
+                        removed=[(image_id, previous['phash'])] if (previous or {}).get('phash') else []
+                    )
+        if previous:
+            delete_stale_renditions(previous, dynamodb_item)
+        if not stored:
+            logger.info("Row %s was written by a concurrent delivery, nothing to do", image_id)
+            metrics.set_property('Outcome', 'duplicate')
+            return {'key': source_key, 'status': 'duplicate', 'image_id': image_id}
+
+        if existing:
+            logger.info("Reused renditions of %s for identical upload %s", existing['image_id'], source_key)
+            metrics.set_property('Outcome', 'deduplicated')
+            return {'key': source_key, 'status': 'deduplicated', 'image_id': image_id}
+
+        metrics.set_property('Outcome', 'processed')
+        logger.info("Processed %s -> %s (%dx%d, %d renditions)", source_key, dynamodb_item['thumbnail_key'],
+                    dynamodb_item['thumbnail_width'], dynamodb_item['thumbnail_height'],
+                    len(dynamodb_item['renditions']))
+
+        return {'key': source_key, 'status': 'processed', 'image_id': image_id}
+
+    except Exception as e:
+        logger.exception("Error processing %s: %s", source_key, e)
+
+        # Store error metadata; never overwrites a row that was processed successfully
+        try:
+            image_id = image_id or str(uuid.uuid4())
+            put_image_item(
+                {
+                    'image_id': image_id,
+                    'user_id': user_id or 'unknown',
+                    'original_key': source_key,
+                    'original_bucket': source_bucket,
+                    'upload_time': upload_time or datetime.utcnow().isoformat(),
+                    'processed_time': datetime.utcnow().isoformat(),
+                    'status': 'error',
+                    'error_message': str(e)
+                }
+            )
+            write_status_row(user_id or 'unknown', source_key, image_id, 'error', str(e))
+        except Exception as db_error:
+            logger.error("Failed to store error metadata for %s: %s", source_key, db_error)
+
+        return {'key': source_key, 'status': 'error', 'error': str(e)}
+
+    finally:
+        if spool is not None:
+            spool.close()
+        metrics.flush()
+
+def is_archive(key):
+    """True for uploads that are imported as ZIP archives"""
+    return key.lower().endswith(ARCHIVE_SUFFIX)
+
+def is_image_member(info):
+    """True for archive entries worth importing; folders, macOS metadata and dotfiles are ignored"""
+    name = info.filename
+    if info.is_dir() or name.startswith('__MACOSX/') or os.path.basename(name).startswith('.'):
+        return False
+    return os.path.splitext(name)[1].lower() in ARCHIVE_IMAGE_EXTENSIONS
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable read-only view of one S3 object version, fetched with ranged GETs
+
+    zipfile only needs the central directory at the end and then each member in
+    turn, so wrapped in a large BufferedReader the archive is streamed rather than
+    downloaded to memory or /tmp first.
+    """
+
+    def __init__(self, bucket, key, size, etag):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.position = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(f"Negative seek position {offset}")
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        # IfMatch makes an archive overwritten mid-import fail instead of mixing versions
+        response = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end}",
+                                 IfMatch=self.etag)
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self.requests += 1
+        return len(data)
+
+def read_member(archive, info):
+    """Stream one archive member into a spooled buffer; returns (spool, size, sha256)"""
+    if info.file_size > ARCHIVE_MAX_MEMBER_BYTES:
+        raise ValueError(f"Member is larger than {ARCHIVE_MAX_MEMBER_BYTES} bytes")
+    spool = tempfile.SpooledTemporaryFile(max_size=INGEST_SPOOL_MAX_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with archive.open(info) as member:
+            for chunk in iter(lambda: member.read(INGEST_CHUNK_SIZE), b''):
+                size += len(chunk)
+                # The header's size can lie; the limit holds for what is actually inflated
+                if size > ARCHIVE_MAX_MEMBER_BYTES:
+                    raise ValueError(f"Member is larger than {ARCHIVE_MAX_MEMBER_BYTES} bytes")
+                spool.write(chunk)
+                digest.update(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, size, digest.hexdigest()
+
+def import_member(job, user_id, index, name, spool, original_size, content_hash, cold_start, duplicate_of=None):
+    """Store and render one archive member; returns (result, row or None)
+
+    Runs on the archive pool. The member's row is not written here: the job
+    collects rows and writes them in batches. duplicate_of is the unwritten row
+    of an earlier member of this import with the same bytes, if any.
+    """
+    metrics = Metrics('image-resizer', cold_start)
+    metrics.set_property('Outcome', 'error')
+    metrics.set_property('Archive', job['original_key'])
+    source_bucket = job['original_bucket']
+    member_key = f"{ARCHIVE_MEMBER_PREFIX}{job['original_key']}/{index}-{os.path.basename(name)}"
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    result = {'name': name}
+    # Set once the copy is known not to belong to a row from an earlier attempt
+    orphan_key = None
+    try:
+        metrics.add('original_bytes', original_size, 'Bytes')
+        # The member becomes an ordinary original, so delete, download and
+        # reprocess.py work on it like on any single upload
+        with metrics.stage('s3_put'):
+            response = s3.put_object(
+                Bucket=source_bucket,
+                Key=member_key,
+                Body=spool,
+                ContentType=content_type,
+                Metadata={
+                    'user-id': user_id,
+                    'upload-time': job['upload_time'],
+                    'original-name': os.path.basename(name),
+                    'archive-key': job['original_key']
+                }
+            )
+        spool.seek(0)
+        # Same ID scheme as an S3 event for the member, so a retried import finds its rows
+        image_id = make_image_id(source_bucket, member_key, response.get('ETag', ''))
+        result['image_id'] = image_id
+        with metrics.stage('dynamodb_get'):
+            already_processed = find_processed_image(image_id)
+        if already_processed:
+            metrics.set_property('Outcome', 'duplicate')
+            result['status'] = 'duplicate'
+            return result, None
+        orphan_key = member_key
+
+        item = image_item(image_id, user_id, source_bucket, member_key, os.path.basename(name),
+                          original_size, job['upload_time'], content_type, content_hash)
+        existing = duplicate_of
+        if existing is None:
+            with metrics.stage('dynamodb_query'):
+                existing = find_content_duplicate(item['content_hash_key'])
+        if existing:
+            item.update(reused_renditions(existing))
+            result['status'] = 'deduplicated'
+        else:
+            item.update(render_image(spool, source_bucket, member_key, user_id, content_type, metrics))
+            result['status'] = 'processed'
+        metrics.set_property('Outcome', result['status'])
+        return result, item
+    except Exception as e:
+        logger.exception("Error importing %s from %s: %s", name, job['original_key'], e)
+        result['status'] = 'error'
+        result['error'] = str(e)
+        if orphan_key:
+            # No row will point at the copy, so it would never be deleted
+            try:
+                s3.delete_object(Bucket=source_bucket, Key=orphan_key)
+            except Exception as cleanup_error:
+                logger.error("Failed to delete the copy of failed member %s: %s", orphan_key, cleanup_error)
+        return result, None
+    finally:
+        spool.close()
+        metrics.flush()
+
+def checkpoint_archive(job, user_id, rows, results, saved_cursor):
+    """Write the rows of finished members, count them, then save the job's progress
+
+    Rows are put conditionally like single uploads, and only the ones actually
+    written are counted, so a retried or overlapping invocation never counts a
+    member twice. The job is saved only if its next_member is still saved_cursor
+    (None for a job not saved yet); otherwise another invocation owns the import
+    and ConditionalCheckFailedException is raised. Returns the new cursor.
+    """
+    stored = [row for row in rows if put_image_item(row)]
+    if len(stored) < len(rows):
+        written_elsewhere = {row['image_id'] for row in rows} - {row['image_id'] for row in stored}
+        for result in results:
+            if result.get('image_id') in written_elsewhere:
+                result['status'] = 'duplicate'
+    if stored:
+        update_user_summary(
+            user_id,
+            images=len(stored),
+            original_bytes=sum(row['original_size'] for row in stored),
+            thumbnail_bytes=sum(counted_thumbnail_bytes(row) for row in stored),
+            upload_time=job['upload_time']
+        )
+        index_phashes(user_id, added=[(row['image_id'], row['phash']) for row in stored if row.get('phash')])
+    for result in results:
+        job[f"{result['status']}_count"] += 1
+        if len(job['results']) < ARCHIVE_MAX_RESULTS:
+            job['results'].append(result)
+        else:
+            job['results_truncated'] = True
+    job['updated_time'] = datetime.utcnow().isoformat()
+    dynamodb.put_item(TableName=METADATA_TABLE, Item=serialize_item(job), **job_cursor_condition(job, saved_cursor))
+    rows.clear()
+    results.clear()
+    return job['next_member']
+
+def job_cursor_condition(job, saved_cursor):
+    """PutItem condition under which this invocation may still write the archive's job row"""
+    if saved_cursor is None:
+        # A new job replaces nothing but the job of an earlier version of the archive
+        return {
+            'ConditionExpression': 'attribute_not_exists(archive_etag) OR archive_etag <> :etag',
+            'ExpressionAttributeValues': serialize_item({':etag': job['archive_etag']})
+        }
+    return {
+        'ConditionExpression': 'archive_etag = :etag AND next_member = :cursor',
+        'ExpressionAttributeValues': serialize_item({':etag': job['archive_etag'], ':cursor': saved_cursor})
+    }
+
+def continue_archive(record, context):
+    """Hand the rest of an archive to a new asynchronous invocation of this function"""
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = boto3.client('lambda')
+    # The new invocation finds the job row and resumes at its next_member
+    _lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'Records': [record]})
+    )
+
+def process_archive(record, cold_start=False, context=None):
+    """Import every image of an uploaded ZIP archive as one job
+
+    The job lives on the archive's status row (key#<user_id>#<archive key>), so the
+    status endpoint reports its progress and per-member results. Members are read
+    one after another from a ranged-GET stream and rendered on the archive pool;
+    their rows are written in batches at each checkpoint. When the invocation runs
+    short of time the job is checkpointed and continued by a new invocation.
+    """
+    source_bucket = record['s3']['bucket']['name']
+    source_key = unquote_plus(record['s3']['object']['key'])
+    logger.info("Importing archive %s from bucket %s", source_key, source_bucket)
+
+    metrics = Metrics('image-resizer', cold_start)
+    metrics.set_property('Outcome', 'error')
+    metrics.set_property('Kind', 'archive')
+    job = None
+    reader = None
+    # next_member as last saved by this invocation; None until the job row exists
+    saved_cursor = None
+
+    try:
+        with metrics.stage('s3_head'):
+            head = s3.head_object(Bucket=source_bucket, Key=source_key)
+        user_id, original_name, upload_time = read_upload_metadata(head.get('Metadata', {}), source_key)
+        job_id = status_row_id(user_id, source_key)
+        with metrics.stage('dynamodb_get'):
+            job = get_row(job_id)
+        if job and job.get('archive_etag') == head['ETag']:
+            if job['status'] != 'importing':
+                logger.info("Archive %s was already imported, skipping redelivery", source_key)
+                metrics.set_property('Outcome', 'duplicate')
+                return {'key': source_key, 'status': 'duplicate'}
+            logger.info("Resuming import of %s at member %s", source_key, job['next_member'])
+            saved_cursor = job['next_member']
+        else:
+            # Like every status row it has no user_id, which keeps it out of the listing index
+            job = {
+                'image_id': job_id,
+                'kind': 'archive',
+                'status': 'importing',
+                'original_key': source_key,
+                'original_bucket': source_bucket,
+                'original_name': original_name,
+                'archive_etag': head['ETag'],
+                'upload_time': upload_time or datetime.utcnow().isoformat(),
+                'started_time': datetime.utcnow().isoformat(),
+                'next_member': 0,
+                'total_members': 0,
+                'processed_count': 0,
+                'deduplicated_count': 0,
+                'duplicate_count': 0,
+                'error_count': 0,
+                'skipped_count': 0,
+                'results': [],
+                'results_truncated': False
+            }
+
+        reader = S3RangeReader(source_bucket, source_key, head['ContentLength'], head['ETag'])
+        with zipfile.ZipFile(io.BufferedReader(reader, buffer_size=ARCHIVE_READ_SIZE)) as archive:
+            entries = [info for info in archive.infolist() if not info.is_dir()]
+            members = [info for info in entries if is_image_member(info)]
+            if len(members) > ARCHIVE_MAX_MEMBERS:
+                raise ValueError(f"Archive has {len(members)} images, more than {ARCHIVE_MAX_MEMBERS}")
+            job['total_members'] = len(members)
+            job['skipped_count'] = len(entries) - len(members)
+
+            # Members finish in order, so next_member always marks a clean resume point
+            first = int(job['next_member'])
+            in_flight = []
+            rows = []
+            results = []
+            # Content hash -> future of the first member with those bytes, so
+            # identical members deduplicate before their rows are written
+            first_with_hash = {}
+
+            def collect():
+                nonlocal saved_cursor
+                result, row = in_flight.pop(0).result()
+                results.append(result)
+                if row:
+                    rows.append(row)
+                job['next_member'] += 1
+                if len(results) >= ARCHIVE_BATCH_SIZE:
+                    with metrics.stage('checkpoint'):
+                        saved_cursor = checkpoint_archive(job, user_id, rows, results, saved_cursor)
+
+            for index in range(first, len(members)):
+                # Always make progress, then stop early enough to checkpoint
+                if (index > first and context is not None
+                        and context.get_remaining_time_in_millis() < ARCHIVE_TIME_RESERVE_MS):
+                    break
+                info = members[index]
+                with metrics.stage('s3_get'):
+                    try:
+                        spool, size, content_hash = read_member(archive, info)
+                    except (ValueError, RuntimeError, NotImplementedError, zipfile.BadZipFile, zlib.error) as member_error:
+                        # Oversized, corrupt, encrypted or unsupported compression: report it and go on
+                        spool = None
+                        failed = {'name': info.filename, 'status': 'error', 'error': str(member_error)}
+                if spool is None:
+                    future = Future()
+                    future.set_result((failed, None))
+                else:
+                    # Waits for the earlier member only in the rare case of repeated bytes
+                    earlier = first_with_hash.get(content_hash)
+                    duplicate_of = earlier.result()[1] if earlier else None
+                    future = get_archive_executor().submit(
+                        import_member, job, user_id, index, info.filename, spool, size, content_hash, cold_start,
+                        duplicate_of)
+                    if duplicate_of is None:
+                        first_with_hash[content_hash] = future
+                in_flight.append(future)
+                # Bounds both the spooled members waiting and the images being decoded
+                while len(in_flight) >= MAX_WORKERS:
+                    collect()
+            while in_flight:
+                collect()
+
+        finished = job['next_member'] >= len(members)
+        if finished:
+            job['status'] = 'processed'
+            job['finished_time'] = datetime.utcnow().isoformat()
+        with metrics.stage('checkpoint'):
+            saved_cursor = checkpoint_archive(job, user_id, rows, results, saved_cursor)
+        metrics.add('archive_members', job['next_member'] - first)
+        metrics.add('archive_range_gets', reader.requests)
+        if not finished:
+            continue_archive(record, context)
+            logger.info("Imported members %d-%d of %s, continuing in a new invocation",
+                        first, job['next_member'] - 1, source_key)
+            metrics.set_property('Outcome', 'continued')
+            return {'key': source_key, 'status': 'continued'}
+
+        metrics.set_property('Outcome', 'processed')
+        logger.info("Imported %s: %d processed, %d deduplicated, %d failed, %d skipped", source_key,
+                    job['processed_count'], job['deduplicated_count'], job['error_count'], job['skipped_count'])
+        return {'key': source_key, 'status': 'processed', 'members': len(members)}
+
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # Its rows were put conditionally, so nothing this invocation wrote is counted twice
+        logger.warning("Archive %s is being imported by another invocation, stopping", source_key)
+        metrics.set_property('Outcome', 'duplicate')
+        return {'key': source_key, 'status': 'duplicate'}
+
+    except Exception as e:
+        logger.exception("Error importing archive %s: %s", source_key, e)
+        if job is not None:
+            try:
+                job.update({
+                    'status': 'error',
+                    'error_message': str(e),
+                    'updated_time': datetime.utcnow().isoformat()
+                })
+                dynamodb.put_item(TableName=METADATA_TABLE, Item=serialize_item(job),
+                                  **job_cursor_condition(job, saved_cursor))
+            except Exception as db_error:
+                logger.error("Failed to store the error of archive %s: %s", source_key, db_error)
+        return {'key': source_key, 'status': 'error', 'error': str(e)}
+
+    finally:
+        metrics.flush()
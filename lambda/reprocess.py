@@ -0,0 +1,352 @@
+"""Regenerate renditions and metadata for images that are already in the bucket.
+
+The resizer only runs on s3:ObjectCreated events, so changing rendition sizes,
+quality or output formats, or repairing rows with status 'error', needs a batch
+run. This command feeds existing objects through the resizer's process_record in
+reprocess mode, fanned out over a process pool, and overwrites each row in place.
+
+    python lambda/reprocess.py --images-bucket my-images --thumbnail-bucket my-thumbs --table my-table
+    python lambda/reprocess.py ... --source errors
+    python lambda/reprocess.py ... --dry-run
+
+Progress is checkpointed to a JSON file; running the same command again after an
+interruption resumes where it stopped.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from urllib.parse import quote_plus
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+LAMBDA_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_DIR = os.path.join(os.path.dirname(LAMBDA_DIR), 'shared')
+
+# Set in each worker process by init_worker
+_resizer = None
+
+def init_worker(environment):
+    """Import the resizer once per worker with the run's configuration"""
+    global _resizer
+    os.environ.update(environment)
+    sys.path[:0] = [LAMBDA_DIR, SHARED_DIR]
+    import lambda_function
+    _resizer = lambda_function
+
+def reprocess_one(bucket, key, etag):
+    """Run one object through the resizer; returns (key, result, seconds)"""
+    record = {'s3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key), 'eTag': etag}}}
+    started = time.perf_counter()
+    result = _resizer.process_record(record, reprocess=True)
+    return key, result, time.perf_counter() - started
+
+def list_bucket(s3, bucket, prefix, start_after):
+    """Yield pages of (key, etag, size, resume marker) from the images bucket in key order"""
+    kwargs = {'Bucket': bucket, 'Prefix': prefix or ''}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    for page in s3.get_paginator('list_objects_v2').paginate(**kwargs):
+        entries = [
+            (obj['Key'], obj['ETag'], obj['Size'])
+            for obj in page.get('Contents', []) if not obj['Key'].startswith('thumb-')
+        ]
+        contents = page.get('Contents', [])
+        # Resuming after the last listed key skips this whole page
+        marker = contents[-1]['Key'] if contents else start_after
+        yield entries, marker
+
+def scan_error_rows(s3, table, images_bucket, exclusive_start_key):
+    """Yield pages of (key, etag, size, resume marker) for rows with status 'error' or a failed index update"""
+    kwargs = {
+        'FilterExpression': (Attr('status').eq('error') | Attr('phash_index_status').eq('error'))
+                            & Attr('original_key').exists(),
+        'ProjectionExpression': 'image_id, original_key, original_bucket'
+    }
+    if exclusive_start_key:
+        kwargs['ExclusiveStartKey'] = exclusive_start_key
+    while True:
+        response = table.scan(**kwargs)
+        entries = []
+        for row in response.get('Items', []):
+            bucket = row.get('original_bucket') or images_bucket
+            if bucket != images_bucket:
+                continue
+            try:
+                head = s3.head_object(Bucket=bucket, Key=row['original_key'])
+            except s3.exceptions.ClientError:
+                # The original is gone; nothing can be regenerated
+                print(f"Skipping {row['original_key']}: original no longer exists", file=sys.stderr)
+                continue
+            entries.append((row['original_key'], head['ETag'], head['ContentLength'], row['image_id']))
+        last_key = response.get('LastEvaluatedKey')
+        yield entries, last_key
+        if not last_key:
+            return
+        kwargs['ExclusiveStartKey'] = last_key
+
+class Checkpoint:
+    """Resume state: a marker below which everything is done, plus keys completed past it"""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.marker = None
+        self.completed = set()
+        self.failed = {}
+        self.stats = {'processed': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0}
+        self.finished = False
+
+    def load(self, restart):
+        if restart or not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if state.get('source') != self.source:
+            raise SystemExit(f"Checkpoint {self.path} belongs to a different run ({state.get('source')}); "
+                             f"use --restart or another --checkpoint file")
+        self.marker = state.get('marker')
+        self.completed = set(state.get('completed', []))
+        self.failed = state.get('failed', {})
+        self.stats.update(state.get('stats', {}))
+        self.finished = state.get('finished', False)
+        return True
+
+    def save(self, finished=False):
+        if not self.path:
+            return
+        state = {
+            'source': self.source,
+            'marker': self.marker,
+            'completed': sorted(self.completed),
+            'failed': self.failed,
+            'stats': self.stats,
+            'finished': finished,
+            'saved_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        # Write-then-rename so an interruption never leaves a truncated checkpoint
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file, indent=2, default=str)
+        os.replace(temporary_path, self.path)
+
+class PageTracker:
+    """Advance the checkpoint marker only past pages whose every key has finished"""
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.pages = []
+
+    def add_page(self, keys, marker):
+        self.pages.append((set(keys), marker))
+        self.advance()
+
+    def done(self, key):
+        self.checkpoint.completed.add(key)
+        self.advance()
+
+    def advance(self):
+        while self.pages and self.pages[0][0] <= self.checkpoint.completed:
+            keys, marker = self.pages.pop(0)
+            self.checkpoint.marker = marker
+            self.checkpoint.completed -= keys
+
+def estimate_seconds_per_image(entries, environment, sample_size):
+    """Decode, resize and encode a few objects locally without writing anything"""
+    init_worker(environment)
+    from PIL import Image
+
+    timings = []
+    for key, _, _ in entries[:sample_size]:
+        started = time.perf_counter()
+        response, spool, _, _ = _resizer.download_to_spool(environment['IMAGES_BUCKET'], key)
+        try:
+            content_type = response.get('ContentType', 'image/jpeg')
+            image = Image.open(spool)
+            sizes = _resizer.plan_rendition_sizes(*image.size)
+            _resizer.prepare_decode(image, sizes)
+            metrics = _resizer.Metrics('image-reprocess', False, sample_rate=0)
+            for _, rendition in _resizer.render_renditions(image, sizes, metrics):
+                buffer, _ = _resizer.encode_image(rendition, content_type)
+                _resizer.encode_modern_formats(rendition, buffer.getbuffer().nbytes)
+        except Exception as sample_error:
+            print(f"Could not sample {key}: {sample_error}", file=sys.stderr)
+            continue
+        finally:
+            spool.close()
+        timings.append(time.perf_counter() - started)
+    return sum(timings) / len(timings) if timings else None
+
+def format_duration(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--images-bucket', required=True, help='bucket holding the original uploads')
+    parser.add_argument('--thumbnail-bucket', required=True, help='bucket the renditions are written to')
+    parser.add_argument('--table', required=True, help='metadata DynamoDB table')
+    parser.add_argument('--source', choices=['bucket', 'errors'], default='bucket',
+                        help="'bucket' reprocesses every original, 'errors' only rows with status 'error' "
+                             "or a failed near-duplicate index update")
+    parser.add_argument('--prefix', default='', help="only reprocess keys with this prefix (source 'bucket')")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--max-per-second', type=float, default=0,
+                        help='upper bound on images started per second, 0 for no limit')
+    parser.add_argument('--max-in-flight', type=int, default=0,
+                        help='images queued or running at once (default: 2 x workers)')
+    parser.add_argument('--limit', type=int, default=0, help='stop after this many images, 0 for all')
+    parser.add_argument('--checkpoint', default='reprocess-checkpoint.json',
+                        help="progress file used to resume an interrupted run ('' to disable)")
+    parser.add_argument('--checkpoint-interval', type=float, default=10.0,
+                        help='seconds between checkpoint writes')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list what would be reprocessed and estimate the runtime without writing')
+    parser.add_argument('--sample', type=int, default=3,
+                        help='images decoded and encoded locally to estimate the runtime in --dry-run')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the resizer in the workers')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    workers = max(1, args.workers)
+    max_in_flight = args.max_in_flight or workers * 2
+    environment = {
+        'THUMBNAIL_BUCKET': args.thumbnail_bucket,
+        'METADATA_TABLE': args.table,
+        'IMAGES_BUCKET': args.images_bucket,
+        'LOG_LEVEL': args.log_level,
+        # Stage metrics belong to the Lambda; a batch run would only flood stdout
+        'METRICS_SAMPLE_RATE': '0'
+    }
+
+    s3 = boto3.client('s3')
+    table = boto3.resource('dynamodb').Table(args.table)
+
+    source = {'source': args.source, 'images_bucket': args.images_bucket, 'prefix': args.prefix, 'table': args.table}
+    checkpoint = Checkpoint(None if args.dry_run else args.checkpoint, source)
+    if checkpoint.load(args.restart):
+        if checkpoint.finished:
+            print(f"{args.checkpoint} records a finished run; use --restart to reprocess again")
+            return 0
+        print(f"Resuming from {args.checkpoint}: {checkpoint.stats['processed']} done, "
+              f"{checkpoint.stats['failed']} failed so far")
+
+    if args.source == 'bucket':
+        pages = list_bucket(s3, args.images_bucket, args.prefix, checkpoint.marker)
+    else:
+        pages = scan_error_rows(s3, table, args.images_bucket, checkpoint.marker)
+
+    if args.dry_run:
+        entries = []
+        for page, _ in pages:
+            entries.extend(entry[:3] for entry in page if entry[0] not in checkpoint.completed)
+            if args.limit and len(entries) >= args.limit:
+                entries = entries[:args.limit]
+                break
+        total_bytes = sum(size for _, _, size in entries)
+        described = 'rows with errors' if args.source == 'errors' else f"s3://{args.images_bucket}/{args.prefix}"
+        print(f"Would reprocess {len(entries)} images ({total_bytes / 1_000_000:.1f} MB) from {described}")
+        per_image = estimate_seconds_per_image(entries, environment, args.sample) if entries else None
+        if per_image is not None:
+            # CPU-bound work spreads over the workers; a rate limit caps it from above
+            estimate = len(entries) * per_image / workers
+            if args.max_per_second:
+                estimate = max(estimate, len(entries) / args.max_per_second)
+            print(f"Measured {per_image:.2f} s per image over {min(args.sample, len(entries))} samples; "
+                  f"estimated runtime with {workers} workers: {format_duration(estimate)} "
+                  f"(excludes S3 upload and DynamoDB time)")
+        return 0
+
+    tracker = PageTracker(checkpoint)
+    interval = 1 / args.max_per_second if args.max_per_second else 0
+    started = time.monotonic()
+    last_submit = 0.0
+    last_save = time.monotonic()
+    submitted = 0
+    error_row_ids = {}
+    in_flight = {}
+
+    def collect(done_futures):
+        for future in done_futures:
+            key = in_flight.pop(future)
+            try:
+                _, result, seconds = future.result()
+            except Exception as worker_error:
+                result, seconds = {'status': 'error', 'error': str(worker_error)}, 0.0
+            checkpoint.stats['seconds'] += seconds
+            if result['status'] == 'error':
+                checkpoint.stats['failed'] += 1
+                checkpoint.failed[key] = result.get('error')
+                print(f"FAILED {key}: {result.get('error')}", file=sys.stderr)
+            else:
+                checkpoint.stats['processed'] += 1
+                checkpoint.failed.pop(key, None)
+                # Error rows written before the object's ETag was known have a random ID
+                stale_row = error_row_ids.pop(key, None)
+                if stale_row and stale_row != result.get('image_id'):
+                    try:
+                        table.delete_item(Key={'image_id': stale_row}, ConditionExpression=Attr('status').eq('error'))
+                    except Exception as delete_error:
+                        print(f"Could not delete old error row {stale_row}: {delete_error}", file=sys.stderr)
+            tracker.done(key)
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(environment,)) as pool:
+        try:
+            for page, marker in pages:
+                page = [entry for entry in page if entry[0] not in checkpoint.completed]
+                if args.limit and len(page) > args.limit - submitted:
+                    page = page[:args.limit - submitted]
+                    if args.source == 'bucket':
+                        # Keys are listed in order, so the last submitted one is a valid resume point
+                        tracker.add_page([entry[0] for entry in page], page[-1][0] if page else checkpoint.marker)
+                    # A truncated scan page has no resume point; its finished keys stay in
+                    # the checkpoint's completed list and are skipped on the next run
+                else:
+                    tracker.add_page([entry[0] for entry in page], marker)
+                for entry in page:
+                    key, etag, size = entry[:3]
+                    if len(entry) > 3:
+                        error_row_ids[key] = entry[3]
+                    while len(in_flight) >= max_in_flight:
+                        collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                    if interval:
+                        time.sleep(max(0.0, last_submit + interval - time.monotonic()))
+                        last_submit = time.monotonic()
+                    in_flight[pool.submit(reprocess_one, args.images_bucket, key, etag)] = key
+                    checkpoint.stats['bytes'] += size
+                    submitted += 1
+                    if time.monotonic() - last_save >= args.checkpoint_interval:
+                        checkpoint.save()
+                        last_save = time.monotonic()
+                        elapsed = time.monotonic() - started
+                        print(f"{checkpoint.stats['processed']} processed, {checkpoint.stats['failed']} failed, "
+                              f"{submitted / elapsed:.1f} images/s")
+                if args.limit and submitted >= args.limit:
+                    break
+            while in_flight:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        except KeyboardInterrupt:
+            print('Interrupted; saving checkpoint (rerun the same command to resume)', file=sys.stderr)
+            pool.shutdown(wait=False, cancel_futures=True)
+            checkpoint.save()
+            return 130
+
+    # A run cut short by --limit resumes later; only a full pass marks the file finished
+    checkpoint.save(finished=not (args.limit and submitted >= args.limit))
+    elapsed = time.monotonic() - started
+    print(f"Done: {checkpoint.stats['processed']} processed, {checkpoint.stats['failed']} failed "
+          f"in {format_duration(elapsed)}")
+    return 1 if checkpoint.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
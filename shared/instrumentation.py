@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+# Instrumentation settings shared by both Lambda functions
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'PhotoSharingApp')
+# Fraction of invocations (or images) whose stage timings are emitted, 0.0 - 1.0
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1.0'))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Print an import-time/init-time breakdown on cold starts
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE', 'false').lower() == 'true'
+
+# The first invocation in a container is the cold start; every later one is warm
+_cold_start = True
+
+def get_logger(name):
+    """Logger honouring LOG_LEVEL; the Lambda runtime already attaches a handler"""
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+    if not logging.getLogger().handlers:
+        # Outside Lambda (local runs, benchmarks) there is no handler yet
+        logging.basicConfig(format='%(levelname)s %(name)s %(message)s')
+    return logger
+
+def mark_invocation():
+    """Return True for the first invocation of this container and False afterwards"""
+    global _cold_start
+    cold_start = _cold_start
+    _cold_start = False
+    return cold_start
+
+class Metrics:
+    """Per-stage timings for one unit of work, flushed as an Embedded Metric Format line"""
+
+    def __init__(self, service, cold_start, sample_rate=None):
+        self.service = service
+        self.cold_start = cold_start
+        rate = METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.sampled = random.random() < rate
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block; repeated stages with the same name accumulate"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_ms", (time.perf_counter() - started) * 1000, 'Milliseconds')
+
+    def add(self, name, value, unit='None'):
+        """Add to a metric, creating it on first use"""
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+    def set_property(self, name, value):
+        """Attach a searchable, non-metric field to the log line"""
+        self.properties[name] = value
+
+    def flush(self):
+        """Print the EMF document if this unit of work was sampled"""
+        if not self.sampled or not self.values:
+            return
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    # Per-stage p50/p99 can be charted overall and split by cold/warm
+                    'Dimensions': [['Service'], ['Service', 'ColdStart']],
+                    'Metrics': [{'Name': name, 'Unit': self.units[name]} for name in self.values]
+                }]
+            },
+            'Service': self.service,
+            'ColdStart': 'cold' if self.cold_start else 'warm',
+            **self.properties,
+            **{name: round(value, 3) for name, value in self.values.items()}
+        }
+        print(json.dumps(document, default=str))
+
+class StartupProfile:
+    """Import and initialisation timings for a container, reported once on its first invocation"""
+
+    def __init__(self, service):
+        self.service = service
+        self.phases = {}
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name):
+        """Time one import or client construction"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + (time.perf_counter() - started) * 1000
+
+    @property
+    def init_ms(self):
+        """Total time spent in the recorded phases"""
+        return sum(self.phases.values())
+
+    def report(self):
+        """Print the breakdown once, when STARTUP_PROFILE is enabled"""
+        if self.reported or not STARTUP_PROFILE:
+            return
+        self.reported = True
+        print(json.dumps({
+            'startup_profile': self.service,
+            'init_ms': round(self.init_ms, 3),
+            'phases': {name: round(value, 3) for name, value in self.phases.items()}
+        }))
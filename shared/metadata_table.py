@@ -0,0 +1,154 @@
+# Layout of the DynamoDB metadata table shared by the resizer, the API and the
+# maintenance scripts. Besides one row per image (keyed by image_id) the table
+# holds bookkeeping rows without a user_id, which keeps them out of the listing.
+from decimal import Decimal
+
+# The listing GSI, keyed by user_id and sorted by upload_time
+USER_ID_INDEX = 'user-upload-time-index'
+# Sparse GSI keyed by "<user_id>#<sha256>" used to reuse renditions of identical uploads
+CONTENT_HASH_INDEX = 'content-hash-index'
+# Sparse GSI keyed by phash_band, holding the near-duplicate index entries
+PHASH_BAND_INDEX = 'phash-band-index'
+
+# Per-user summary row: the version counter that invalidates cached listings in the
+# API, plus the usage totals (image_count, original_bytes, thumbnail_bytes, last_upload_time)
+USER_SUMMARY_PREFIX = 'user#'
+# Per-upload status row the API reads to answer "is this upload done yet?"; for
+# ZIP archives it also holds the import job
+ORIGINAL_KEY_PREFIX = 'key#'
+# Near-duplicate index: the 64-bit dHash of each image is split into PHASH_BANDS
+# bands of 8 bits. Every image has one small entry row per band, keyed
+# phash#<user_id>#<band>#<band value>#<image_id> and carrying phash_band
+# ("<user_id>#<band>#<band value>"), target_image_id and phash. Two hashes fewer
+# than PHASH_BANDS bits apart agree on at least one band, so a lookup queries
+# PHASH_BAND_INDEX for 8 band values instead of comparing against the whole
+# library. A band value is shared by many images, but no single item grows with it.
+PHASH_PREFIX = 'phash#'
+PHASH_BANDS = 8
+
+# The rendition keeping the original thumb-<key> name and the row's thumbnail_* fields
+PRIMARY_THUMBNAIL_SIZE = 400
+
+def user_summary_id(user_id):
+    """image_id of a user's summary row"""
+    return f"{USER_SUMMARY_PREFIX}{user_id}"
+
+def status_row_id(user_id, original_key):
+    """image_id of the status row of one upload"""
+    return f"{ORIGINAL_KEY_PREFIX}{user_id}#{original_key}"
+
+def get_rendition_key(source_key, size):
+    """S3 key of a rendition; the primary size keeps the original thumb-<key> name"""
+    if size == PRIMARY_THUMBNAIL_SIZE:
+        return f"thumb-{source_key}"
+    return f"thumb-{size}-{source_key}"
+
+def rendition_object_keys(item):
+    """Every thumbnail bucket key (renditions and format variants) referenced by a row"""
+    keys = set()
+    for rendition in item.get('renditions', []):
+        keys.add(rendition['key'])
+        keys.update(variant['key'] for variant in rendition.get('formats', []))
+    if item.get('thumbnail_key'):
+        keys.add(item['thumbnail_key'])
+    return keys
+
+def stored_thumbnail_bytes(item):
+    """Bytes of every rendition and format variant of a row (legacy rows: the single thumbnail)"""
+    if not item.get('renditions'):
+        return item.get('thumbnail_size', 0)
+    return sum(
+        rendition['bytes'] + sum(variant['bytes'] for variant in rendition.get('formats', []))
+        for rendition in item['renditions']
+    )
+
+def counted_thumbnail_bytes(item):
+    """Thumbnail bytes a row adds to its user's usage
+
+    A row deduplicated from another reuses that row's objects, which are counted
+    once, with the row that stored them.
+    """
+    return 0 if item.get('deduplicated_from') else stored_thumbnail_bytes(item)
+
+def rendition_object_bytes(item):
+    """Size of every thumbnail bucket object referenced by a row, by key"""
+    if not item.get('renditions'):
+        return {item['thumbnail_key']: item.get('thumbnail_size', 0)} if item.get('thumbnail_key') else {}
+    sizes = {}
+    for rendition in item['renditions']:
+        sizes[rendition['key']] = rendition['bytes']
+        sizes.update((variant['key'], variant['bytes']) for variant in rendition.get('formats', []))
+    return sizes
+
+def phash_bands(phash):
+    """The PHASH_BANDS equal slices of a hex perceptual hash"""
+    width = len(phash) // PHASH_BANDS
+    return [phash[band * width:(band + 1) * width] for band in range(PHASH_BANDS)]
+
+def phash_band_keys(user_id, phash):
+    """phash_band values of the index partitions an image with this hash belongs to, one per band"""
+    return [f"{user_id}#{band}#{value}" for band, value in enumerate(phash_bands(phash))]
+
+def phash_entries(user_id, image_id, phash):
+    """The near-duplicate index rows of one image, one per band"""
+    return [
+        {'image_id': f"{PHASH_PREFIX}{band_key}#{image_id}", 'phash_band': band_key,
+         'target_image_id': image_id, 'phash': phash}
+        for band_key in phash_band_keys(user_id, phash)
+    ]
+
+# Both Lambdas talk to the table through thread-safe low-level clients, which take
+# and return attribute values ({'S': ...}); rows are converted by hand, without
+# building the boto3 resource layer.
+
+def serialize(value):
+    """Python value -> DynamoDB attribute value"""
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, (int, float, Decimal)):
+        return {'N': str(value)}
+    if isinstance(value, dict):
+        return {'M': {key: serialize(item) for key, item in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [serialize(item) for item in value]}
+    if isinstance(value, bytes):
+        return {'B': value}
+    raise TypeError(f"Cannot store {type(value).__name__} in DynamoDB")
+
+def deserialize(attribute):
+    """DynamoDB attribute value -> Python value; numbers become int or float, ready for json"""
+    # An attribute value has exactly one type key; the common ones are tested first
+    for kind, value in attribute.items():
+        if kind == 'S':
+            return value
+        if kind == 'N':
+            return int(value) if value.lstrip('-').isdigit() else float(value)
+        if kind == 'M':
+            return {key: deserialize(item) for key, item in value.items()}
+        if kind == 'L':
+            return [deserialize(item) for item in value]
+        if kind == 'NULL':
+            return None
+        if kind == 'NS':
+            return [deserialize({'N': item}) for item in value]
+        if kind in ('SS', 'BS'):
+            return list(value)
+        return value
+
+def serialize_item(item):
+    """Plain dict -> DynamoDB item or key"""
+    return {key: serialize(value) for key, value in item.items()}
+
+def deserialize_item(item):
+    """DynamoDB item -> plain dict (None stays None)"""
+    if item is None:
+        return None
+    return {key: deserialize(value) for key, value in item.items()}
+
+def image_key(image_id):
+    """Table key of a row, in attribute value form"""
+    return {'image_id': {'S': image_id}}
@@ -39,6 +39,24 @@ variable "app_name" {
   default     = "photo-sharing-app"
 }
 
+variable "resizer_memory_mb" {
+  description = "Memory of the image resizer; its worker count and pixel budget are derived from it"
+  type        = number
+  default     = 2048
+}
+
+variable "api_memory_mb" {
+  description = "Memory of the API function"
+  type        = number
+  default     = 512
+}
+
+variable "upload_prefix" {
+  description = "Key prefix of browser uploads in the images bucket (Amplify's guest access level)"
+  type        = string
+  default     = "public/"
+}
+
 # Random suffix for unique resource names
 resource "random_string" "suffix" {
   length  = 8
@@ -54,11 +72,12 @@ resource "aws_s3_bucket" "images" {
 resource "aws_s3_bucket_cors_configuration" "images_cors" {
   bucket = aws_s3_bucket.images.id
 
+  # Ranged reads through presigned URLs need the range and length headers
   cors_rule {
     allowed_headers = ["*"]
-    allowed_methods = ["GET", "POST", "PUT", "DELETE"]
+    allowed_methods = ["GET", "HEAD", "POST", "PUT", "DELETE"]
     allowed_origins = ["*"]
-    expose_headers  = ["ETag"]
+    expose_headers  = ["ETag", "Accept-Ranges", "Content-Range", "Content-Length"]
     max_age_seconds = 3000
   }
 
@@ -68,9 +87,12 @@ resource "aws_s3_bucket_cors_configuration" "images_cors" {
 resource "aws_s3_bucket_notification" "images_notification" {
   bucket = aws_s3_bucket.images.id
 
+  # Only browser uploads trigger the resizer; the copies it writes itself under
+  # archive-members/ while importing a ZIP archive must not start invocations
   lambda_function {
     lambda_function_arn = aws_lambda_function.image_resizer.arn
     events              = ["s3:ObjectCreated:*"]
+    filter_prefix       = var.upload_prefix
   }
 
   depends_on = [aws_lambda_permission.allow_s3]
@@ -196,11 +218,68 @@ resource "aws_dynamodb_table" "image_metadata" {
     type = "S"
   }
 
+  attribute {
+    name = "upload_time"
+    type = "S"
+  }
+
+  attribute {
+    name = "content_hash_key"
+    type = "S"
+  }
+
+  attribute {
+    name = "phash_band"
+    type = "S"
+  }
+
+  # The original per-user index, no longer queried. Changing its key schema in
+  # place would delete and rebuild it, failing every listing until the rebuild
+  # finished, so it stays until a later change drops it
   global_secondary_index {
     name            = "user-id-index"
     hash_key        = "user_id"
     projection_type = "ALL"
   }
+
+  # Sorted by upload_time so the API can page newest-first straight from DynamoDB.
+  # terraform apply waits for it to become active before the Lambdas are updated
+  global_secondary_index {
+    name            = "user-upload-time-index"
+    hash_key        = "user_id"
+    range_key       = "upload_time"
+    projection_type = "ALL"
+  }
+
+  # Sparse index on "<user_id>#<sha256>" so re-uploads of identical bytes reuse renditions
+  global_secondary_index {
+    name            = "content-hash-index"
+    hash_key        = "content_hash_key"
+    projection_type = "INCLUDE"
+    non_key_attributes = [
+      "thumbnail_key",
+      "thumbnail_bucket",
+      "thumbnail_size",
+      "thumbnail_width",
+      "thumbnail_height",
+      "thumbnail_content_type",
+      "thumbnail_quality",
+      "renditions",
+      "original_width",
+      "original_height",
+      "placeholder",
+      "dominant_color",
+      "phash"
+    ]
+  }
+
+  # Sparse index of the near-duplicate entries, one item per image and hash band
+  global_secondary_index {
+    name               = "phash-band-index"
+    hash_key           = "phash_band"
+    projection_type    = "INCLUDE"
+    non_key_attributes = ["target_image_id", "phash"]
+  }
 }
 
 # Cognito User Pool
@@ -437,13 +516,33 @@ resource "aws_iam_role_policy" "lambda_s3_policy" {
           "${aws_s3_bucket.thumbnails.arn}/*"
         ]
       },
+      {
+        # Archive imports delete the copy of a member that failed to import.
+        # Stale renditions are only deleted by reprocess.py, which runs with the
+        # operator's credentials, so the thumbnails bucket stays write-only
+        Effect   = "Allow"
+        Action   = "s3:DeleteObject"
+        Resource = "${aws_s3_bucket.images.arn}/archive-members/*"
+      },
       {
         Effect = "Allow"
         Action = [
           "dynamodb:PutItem",
-          "dynamodb:UpdateItem"
+          "dynamodb:UpdateItem",
+          "dynamodb:GetItem",
+          "dynamodb:Query",
+          "dynamodb:BatchWriteItem"
         ]
-        Resource = aws_dynamodb_table.image_metadata.arn
+        Resource = [
+          aws_dynamodb_table.image_metadata.arn,
+          "${aws_dynamodb_table.image_metadata.arn}/index/*"
+        ]
+      },
+      {
+        # Archive imports that run out of time continue in a new invocation
+        Effect   = "Allow"
+        Action   = "lambda:InvokeFunction"
+        Resource = aws_lambda_function.image_resizer.arn
       }
     ]
   })
@@ -502,14 +601,24 @@ resource "aws_lambda_function" "image_resizer" {
   role          = aws_iam_role.lambda_role.arn
   handler       = "lambda_function.lambda_handler"
   runtime       = "python3.9"
-  timeout       = 30
+  timeout       = 300
+  # A 12 MP image peaks around 170 MB RSS with one worker; the default 128 MB fails.
+  # The worker count and pixel budget are derived from it
+  memory_size = var.resizer_memory_mb
 
   source_code_hash = data.archive_file.lambda_zip.output_base64sha256
 
   environment {
     variables = {
-      THUMBNAIL_BUCKET = aws_s3_bucket.thumbnails.bucket
-      METADATA_TABLE   = aws_dynamodb_table.image_metadata.name
+      THUMBNAIL_BUCKET     = aws_s3_bucket.thumbnails.bucket
+      METADATA_TABLE       = aws_dynamodb_table.image_metadata.name
+      RENDITION_SIZES      = "200,400,1080,2048"
+      OUTPUT_FORMATS       = "webp"
+      FORMAT_SELECTION     = "all"
+      METRICS_SAMPLE_RATE  = "1.0"
+      LOG_LEVEL            = "INFO"
+      STARTUP_PROFILE      = "false"
+      ARCHIVE_MAX_MEMBERS  = "2000"
     }
   }
 }
@@ -522,13 +631,20 @@ resource "aws_lambda_function" "api_lambda" {
   handler       = "lambda_function.lambda_handler"
   runtime       = "python3.9"
   timeout       = 30
+  memory_size   = var.api_memory_mb
 
   source_code_hash = data.archive_file.api_lambda_zip.output_base64sha256
 
   environment {
     variables = {
-      METADATA_TABLE   = aws_dynamodb_table.image_metadata.name
-      THUMBNAIL_BUCKET = aws_s3_bucket.thumbnails.bucket
+      METADATA_TABLE               = aws_dynamodb_table.image_metadata.name
+      THUMBNAIL_BUCKET             = aws_s3_bucket.thumbnails.bucket
+      METRICS_SAMPLE_RATE          = "1.0"
+      LOG_LEVEL                    = "INFO"
+      STARTUP_PROFILE              = "false"
+      USER_QUOTA_IMAGES            = "0"
+      USER_QUOTA_BYTES             = "0"
+      ORIGINAL_URL_EXPIRES_SECONDS = "3600"
     }
   }
 }
@@ -565,7 +681,10 @@ resource "aws_iam_role_policy" "api_lambda_policy" {
           "dynamodb:Query",
           "dynamodb:GetItem",
           "dynamodb:Scan",
-          "dynamodb:DeleteItem"
+          "dynamodb:DeleteItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:BatchGetItem",
+          "dynamodb:BatchWriteItem"
         ]
         Resource = [
           aws_dynamodb_table.image_metadata.arn,
@@ -578,7 +697,18 @@ resource "aws_iam_role_policy" "api_lambda_policy" {
           "s3:DeleteObject"
         ]
         Resource = [
-          "${aws_s3_bucket.thumbnails.arn}/*"
+          "${aws_s3_bucket.thumbnails.arn}/*",
+          "${aws_s3_bucket.images.arn}/*"
+        ]
+      },
+      {
+        # Presigned URLs for originals carry the API role's permissions
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.images.arn}/*"
         ]
       }
     ]
@@ -638,6 +768,10 @@ resource "aws_iam_role_policy" "api_gateway_s3_policy" {
 resource "aws_api_gateway_rest_api" "api" {
   name = "${var.app_name}-api"
 
+  # Lets the API Lambda return compressed (base64-encoded) listing bodies. Request
+  # bodies then reach the Lambda base64-encoded too, and the CORS mocks convert to text.
+  binary_media_types = ["*/*"]
+
   endpoint_configuration {
     types = ["REGIONAL"]
   }
@@ -714,6 +848,34 @@ resource "aws_api_gateway_resource" "user_image_endpoint" {
   path_part   = "{image_id}"
 }
 
+# Resource for single-upload processing status (long-poll)
+resource "aws_api_gateway_resource" "user_status_endpoint" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  parent_id   = aws_api_gateway_resource.user_id_resource.id
+  path_part   = "status"
+}
+
+# Resource for per-user usage totals and quota
+resource "aws_api_gateway_resource" "user_stats_endpoint" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  parent_id   = aws_api_gateway_resource.user_id_resource.id
+  path_part   = "stats"
+}
+
+# Resource for presigned access to originals
+resource "aws_api_gateway_resource" "user_originals_endpoint" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  parent_id   = aws_api_gateway_resource.user_id_resource.id
+  path_part   = "originals"
+}
+
+# Resource for near-duplicates of one image
+resource "aws_api_gateway_resource" "user_image_similar_endpoint" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  parent_id   = aws_api_gateway_resource.user_image_endpoint.id
+  path_part   = "similar"
+}
+
 # GET method for fetching user images
 resource "aws_api_gateway_method" "get_user_images" {
   rest_api_id   = aws_api_gateway_rest_api.api.id
@@ -759,6 +921,308 @@ resource "aws_api_gateway_integration" "delete_user_image_integration" {
   uri                     = aws_lambda_function.api_lambda.invoke_arn
 }
 
+# DELETE method for batch deleting images listed in the request body
+resource "aws_api_gateway_method" "delete_user_images" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_images_endpoint.id
+  http_method   = "DELETE"
+  authorization = "NONE"
+
+  request_parameters = {
+    "method.request.path.user_id" = true
+  }
+}
+
+resource "aws_api_gateway_integration" "delete_user_images_integration" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_images_endpoint.id
+  http_method = aws_api_gateway_method.delete_user_images.http_method
+
+  integration_http_method = "POST"
+  type                    = "AWS_PROXY"
+  uri                     = aws_lambda_function.api_lambda.invoke_arn
+}
+
+# GET method for checking whether one upload has been processed
+resource "aws_api_gateway_method" "get_user_status" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_status_endpoint.id
+  http_method   = "GET"
+  authorization = "NONE"
+
+  request_parameters = {
+    "method.request.path.user_id"             = true
+    "method.request.querystring.original_key" = true
+    "method.request.querystring.wait"         = false
+  }
+}
+
+resource "aws_api_gateway_integration" "get_user_status_integration" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_status_endpoint.id
+  http_method = aws_api_gateway_method.get_user_status.http_method
+
+  integration_http_method = "POST"
+  type                    = "AWS_PROXY"
+  uri                     = aws_lambda_function.api_lambda.invoke_arn
+  timeout_milliseconds    = 29000
+}
+
+# OPTIONS method for CORS on status endpoint
+resource "aws_api_gateway_method" "options_user_status" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_status_endpoint.id
+  http_method   = "OPTIONS"
+  authorization = "NONE"
+}
+
+resource "aws_api_gateway_integration" "options_user_status_integration" {
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.user_status_endpoint.id
+  http_method      = aws_api_gateway_method.options_user_status.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
+
+  request_templates = {
+    "application/json" = "{\"statusCode\": 200}"
+  }
+}
+
+resource "aws_api_gateway_method_response" "options_user_status_200" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_status_endpoint.id
+  http_method = aws_api_gateway_method.options_user_status.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = true
+    "method.response.header.Access-Control-Allow-Methods" = true
+    "method.response.header.Access-Control-Allow-Origin"  = true
+  }
+}
+
+resource "aws_api_gateway_integration_response" "options_user_status_integration_response" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_status_endpoint.id
+  http_method = aws_api_gateway_method.options_user_status.http_method
+  status_code = aws_api_gateway_method_response.options_user_status_200.status_code
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'"
+    "method.response.header.Access-Control-Allow-Methods" = "'GET,OPTIONS'"
+    "method.response.header.Access-Control-Allow-Origin"  = "'*'"
+  }
+}
+
+# GET method for a user's usage totals
+resource "aws_api_gateway_method" "get_user_stats" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_stats_endpoint.id
+  http_method   = "GET"
+  authorization = "NONE"
+
+  request_parameters = {
+    "method.request.path.user_id"             = true
+    "method.request.querystring.upload_bytes" = false
+  }
+}
+
+resource "aws_api_gateway_integration" "get_user_stats_integration" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_stats_endpoint.id
+  http_method = aws_api_gateway_method.get_user_stats.http_method
+
+  integration_http_method = "POST"
+  type                    = "AWS_PROXY"
+  uri                     = aws_lambda_function.api_lambda.invoke_arn
+}
+
+# OPTIONS method for CORS on stats endpoint
+resource "aws_api_gateway_method" "options_user_stats" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_stats_endpoint.id
+  http_method   = "OPTIONS"
+  authorization = "NONE"
+}
+
+resource "aws_api_gateway_integration" "options_user_stats_integration" {
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.user_stats_endpoint.id
+  http_method      = aws_api_gateway_method.options_user_stats.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
+
+  request_templates = {
+    "application/json" = "{\"statusCode\": 200}"
+  }
+}
+
+resource "aws_api_gateway_method_response" "options_user_stats_200" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_stats_endpoint.id
+  http_method = aws_api_gateway_method.options_user_stats.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = true
+    "method.response.header.Access-Control-Allow-Methods" = true
+    "method.response.header.Access-Control-Allow-Origin"  = true
+  }
+}
+
+resource "aws_api_gateway_integration_response" "options_user_stats_integration_response" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_stats_endpoint.id
+  http_method = aws_api_gateway_method.options_user_stats.http_method
+  status_code = aws_api_gateway_method_response.options_user_stats_200.status_code
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'"
+    "method.response.header.Access-Control-Allow-Methods" = "'GET,OPTIONS'"
+    "method.response.header.Access-Control-Allow-Origin"  = "'*'"
+  }
+}
+
+# GET method for presigned URLs of a page of originals
+resource "aws_api_gateway_method" "get_user_originals" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_originals_endpoint.id
+  http_method   = "GET"
+  authorization = "NONE"
+
+  request_parameters = {
+    "method.request.path.user_id"    = true
+    "method.request.querystring.ids" = true
+  }
+}
+
+resource "aws_api_gateway_integration" "get_user_originals_integration" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_originals_endpoint.id
+  http_method = aws_api_gateway_method.get_user_originals.http_method
+
+  integration_http_method = "POST"
+  type                    = "AWS_PROXY"
+  uri                     = aws_lambda_function.api_lambda.invoke_arn
+}
+
+# OPTIONS method for CORS on originals endpoint
+resource "aws_api_gateway_method" "options_user_originals" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_originals_endpoint.id
+  http_method   = "OPTIONS"
+  authorization = "NONE"
+}
+
+resource "aws_api_gateway_integration" "options_user_originals_integration" {
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.user_originals_endpoint.id
+  http_method      = aws_api_gateway_method.options_user_originals.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
+
+  request_templates = {
+    "application/json" = "{\"statusCode\": 200}"
+  }
+}
+
+resource "aws_api_gateway_method_response" "options_user_originals_200" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_originals_endpoint.id
+  http_method = aws_api_gateway_method.options_user_originals.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = true
+    "method.response.header.Access-Control-Allow-Methods" = true
+    "method.response.header.Access-Control-Allow-Origin"  = true
+  }
+}
+
+resource "aws_api_gateway_integration_response" "options_user_originals_integration_response" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_originals_endpoint.id
+  http_method = aws_api_gateway_method.options_user_originals.http_method
+  status_code = aws_api_gateway_method_response.options_user_originals_200.status_code
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'"
+    "method.response.header.Access-Control-Allow-Methods" = "'GET,OPTIONS'"
+    "method.response.header.Access-Control-Allow-Origin"  = "'*'"
+  }
+}
+
+# GET method for images that look like a given one
+resource "aws_api_gateway_method" "get_user_image_similar" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_image_similar_endpoint.id
+  http_method   = "GET"
+  authorization = "NONE"
+
+  request_parameters = {
+    "method.request.path.user_id"             = true
+    "method.request.path.image_id"            = true
+    "method.request.querystring.max_distance" = false
+    "method.request.querystring.limit"        = false
+  }
+}
+
+resource "aws_api_gateway_integration" "get_user_image_similar_integration" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_image_similar_endpoint.id
+  http_method = aws_api_gateway_method.get_user_image_similar.http_method
+
+  integration_http_method = "POST"
+  type                    = "AWS_PROXY"
+  uri                     = aws_lambda_function.api_lambda.invoke_arn
+}
+
+# OPTIONS method for CORS on the similar images endpoint
+resource "aws_api_gateway_method" "options_user_image_similar" {
+  rest_api_id   = aws_api_gateway_rest_api.api.id
+  resource_id   = aws_api_gateway_resource.user_image_similar_endpoint.id
+  http_method   = "OPTIONS"
+  authorization = "NONE"
+}
+
+resource "aws_api_gateway_integration" "options_user_image_similar_integration" {
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.user_image_similar_endpoint.id
+  http_method      = aws_api_gateway_method.options_user_image_similar.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
+
+  request_templates = {
+    "application/json" = "{\"statusCode\": 200}"
+  }
+}
+
+resource "aws_api_gateway_method_response" "options_user_image_similar_200" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_image_similar_endpoint.id
+  http_method = aws_api_gateway_method.options_user_image_similar.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = true
+    "method.response.header.Access-Control-Allow-Methods" = true
+    "method.response.header.Access-Control-Allow-Origin"  = true
+  }
+}
+
+resource "aws_api_gateway_integration_response" "options_user_image_similar_integration_response" {
+  rest_api_id = aws_api_gateway_rest_api.api.id
+  resource_id = aws_api_gateway_resource.user_image_similar_endpoint.id
+  http_method = aws_api_gateway_method.options_user_image_similar.http_method
+  status_code = aws_api_gateway_method_response.options_user_image_similar_200.status_code
+
+  response_parameters = {
+    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'"
+    "method.response.header.Access-Control-Allow-Methods" = "'GET,OPTIONS'"
+    "method.response.header.Access-Control-Allow-Origin"  = "'*'"
+  }
+}
+
 # OPTIONS method for CORS on images endpoint
 resource "aws_api_gateway_method" "options_user_images" {
   rest_api_id   = aws_api_gateway_rest_api.api.id
@@ -768,10 +1232,11 @@ resource "aws_api_gateway_method" "options_user_images" {
 }
 
 resource "aws_api_gateway_integration" "options_user_images_integration" {
-  rest_api_id = aws_api_gateway_rest_api.api.id
-  resource_id = aws_api_gateway_resource.user_images_endpoint.id
-  http_method = aws_api_gateway_method.options_user_images.http_method
-  type        = "MOCK"
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.user_images_endpoint.id
+  http_method      = aws_api_gateway_method.options_user_images.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
 
   request_templates = {
     "application/json" = "{\"statusCode\": 200}"
@@ -798,7 +1263,7 @@ resource "aws_api_gateway_integration_response" "options_user_images_integration
   status_code = aws_api_gateway_method_response.options_user_images_200.status_code
 
   response_parameters = {
-    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'"
+    "method.response.header.Access-Control-Allow-Headers" = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,If-None-Match'"
     "method.response.header.Access-Control-Allow-Methods" = "'GET,DELETE,OPTIONS'"
     "method.response.header.Access-Control-Allow-Origin"  = "'*'"
   }
@@ -813,10 +1278,11 @@ resource "aws_api_gateway_method" "options_user_image" {
 }
 
 resource "aws_api_gateway_integration" "options_user_image_integration" {
-  rest_api_id = aws_api_gateway_rest_api.api.id
-  resource_id = aws_api_gateway_resource.user_image_endpoint.id
-  http_method = aws_api_gateway_method.options_user_image.http_method
-  type        = "MOCK"
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.user_image_endpoint.id
+  http_method      = aws_api_gateway_method.options_user_image.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
 
   request_templates = {
     "application/json" = "{\"statusCode\": 200}"
@@ -902,10 +1368,11 @@ resource "aws_api_gateway_method_response" "options_200" {
 }
 
 resource "aws_api_gateway_integration" "options_integration" {
-  rest_api_id = aws_api_gateway_rest_api.api.id
-  resource_id = aws_api_gateway_resource.images_resource.id
-  http_method = aws_api_gateway_method.options_images.http_method
-  type        = "MOCK"
+  rest_api_id      = aws_api_gateway_rest_api.api.id
+  resource_id      = aws_api_gateway_resource.images_resource.id
+  http_method      = aws_api_gateway_method.options_images.http_method
+  type             = "MOCK"
+  content_handling = "CONVERT_TO_TEXT"
 
   request_templates = {
     "application/json" = "{\"statusCode\": 200}"
@@ -931,37 +1398,78 @@ resource "aws_api_gateway_deployment" "api_deployment" {
     aws_api_gateway_method.options_images,
     aws_api_gateway_method.get_user_images,
     aws_api_gateway_method.delete_user_image,
+    aws_api_gateway_method.delete_user_images,
     aws_api_gateway_method.options_user_images,
     aws_api_gateway_method.options_user_image,
+    aws_api_gateway_method.get_user_status,
+    aws_api_gateway_method.options_user_status,
+    aws_api_gateway_method.get_user_stats,
+    aws_api_gateway_method.options_user_stats,
+    aws_api_gateway_method.get_user_originals,
+    aws_api_gateway_method.options_user_originals,
+    aws_api_gateway_method.get_user_image_similar,
+    aws_api_gateway_method.options_user_image_similar,
     aws_api_gateway_integration.get_image_key_integration,
     aws_api_gateway_integration.options_integration,
     aws_api_gateway_integration.get_user_images_integration,
     aws_api_gateway_integration.delete_user_image_integration,
+    aws_api_gateway_integration.delete_user_images_integration,
     aws_api_gateway_integration.options_user_images_integration,
-    aws_api_gateway_integration.options_user_image_integration
+    aws_api_gateway_integration.options_user_image_integration,
+    aws_api_gateway_integration.get_user_status_integration,
+    aws_api_gateway_integration.options_user_status_integration,
+    aws_api_gateway_integration.get_user_stats_integration,
+    aws_api_gateway_integration.options_user_stats_integration,
+    aws_api_gateway_integration.get_user_originals_integration,
+    aws_api_gateway_integration.options_user_originals_integration,
+    aws_api_gateway_integration.get_user_image_similar_integration,
+    aws_api_gateway_integration.options_user_image_similar_integration
   ]
 
   rest_api_id = aws_api_gateway_rest_api.api.id
 
   triggers = {
     redeployment = sha1(jsonencode([
+      aws_api_gateway_rest_api.api.binary_media_types,
       aws_api_gateway_resource.images_resource.id,
       aws_api_gateway_resource.image_key_resource.id,
       aws_api_gateway_resource.api_resource.id,
       aws_api_gateway_resource.user_images_endpoint.id,
       aws_api_gateway_resource.user_image_endpoint.id,
+      aws_api_gateway_resource.user_status_endpoint.id,
+      aws_api_gateway_resource.user_stats_endpoint.id,
+      aws_api_gateway_resource.user_originals_endpoint.id,
+      aws_api_gateway_resource.user_image_similar_endpoint.id,
       aws_api_gateway_method.get_image_key.id,
       aws_api_gateway_method.options_images.id,
       aws_api_gateway_method.get_user_images.id,
       aws_api_gateway_method.delete_user_image.id,
+      aws_api_gateway_method.delete_user_images.id,
       aws_api_gateway_method.options_user_images.id,
       aws_api_gateway_method.options_user_image.id,
+      aws_api_gateway_method.get_user_status.id,
+      aws_api_gateway_method.options_user_status.id,
+      aws_api_gateway_method.get_user_stats.id,
+      aws_api_gateway_method.options_user_stats.id,
+      aws_api_gateway_method.get_user_originals.id,
+      aws_api_gateway_method.options_user_originals.id,
+      aws_api_gateway_method.get_user_image_similar.id,
+      aws_api_gateway_method.options_user_image_similar.id,
       aws_api_gateway_integration.get_image_key_integration.id,
       aws_api_gateway_integration.options_integration.id,
       aws_api_gateway_integration.get_user_images_integration.id,
       aws_api_gateway_integration.delete_user_image_integration.id,
+      aws_api_gateway_integration.delete_user_images_integration.id,
       aws_api_gateway_integration.options_user_images_integration.id,
       aws_api_gateway_integration.options_user_image_integration.id,
+      aws_api_gateway_integration.get_user_status_integration.id,
+      aws_api_gateway_integration.options_user_status_integration.id,
+      aws_api_gateway_integration.get_user_stats_integration.id,
+      aws_api_gateway_integration.options_user_stats_integration.id,
+      aws_api_gateway_integration.get_user_originals_integration.id,
+      aws_api_gateway_integration.options_user_originals_integration.id,
+      aws_api_gateway_integration.get_user_image_similar_integration.id,
+      aws_api_gateway_integration.options_user_image_similar_integration.id,
     ]))
   }
 
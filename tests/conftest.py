@@ -0,0 +1,40 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The Lambda functions read their configuration at import time
+os.environ.setdefault('THUMBNAIL_BUCKET', 'test-thumbnails')
+os.environ.setdefault('METADATA_TABLE', 'test-metadata')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ.setdefault('METRICS_SAMPLE_RATE', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path[:0] = [os.path.join(REPO_ROOT, 'shared'), os.path.join(REPO_ROOT, 'benchmarks')]
+
+from fakes import FakeDynamoDBClient, FakeS3, FakeTable
+
+def load_handler(name, relative_path):
+    """Import a lambda_function.py under a unique module name"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def resizer():
+    """A fresh resizer module wired to an empty FakeS3 and FakeTable"""
+    module = load_handler('image_resizer', 'lambda/lambda_function.py')
+    module.s3 = FakeS3()
+    module.dynamodb = FakeDynamoDBClient(FakeTable(os.environ['METADATA_TABLE']))
+    return module
+
+@pytest.fixture
+def api(resizer):
+    """A fresh API module sharing the resizer's fakes"""
+    module = load_handler('image_api', 'api_lambda/lambda_function.py')
+    module._clients['dynamodb'] = resizer.dynamodb
+    module._clients['s3'] = resizer.s3
+    return module
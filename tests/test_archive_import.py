@@ -0,0 +1,86 @@
+"""ZIP archive imports: in-archive deduplication, failed members and retried checkpoints."""
+import io
+import zipfile
+
+from PIL import Image
+
+from metadata_table import status_row_id, user_summary_id
+
+IMAGES_BUCKET = 'test-images'
+ARCHIVE_KEY = 'public/1700-pics.zip'
+JOB_KEY = status_row_id('alice', ARCHIVE_KEY)
+
+def jpeg(width, height, color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def upload_archive(resizer, members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    resizer.s3.add_object(IMAGES_BUCKET, ARCHIVE_KEY, buffer.getvalue(), 'application/zip',
+                          {'user-id': 'alice', 'upload-time': '2024-05-01T00:00:00'})
+    return {'s3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': ARCHIVE_KEY}}}
+
+def image_rows(table):
+    return [item for item in table.items.values() if item.get('user_id') == 'alice']
+
+def summary(table):
+    return table.get_item(Key={'image_id': user_summary_id('alice')})['Item']
+
+def test_identical_members_are_deduplicated_and_failed_copies_deleted(resizer):
+    photo = jpeg(640, 480, (200, 40, 40))
+    record = upload_archive(resizer, [
+        ('a.jpg', photo), ('b.jpg', jpeg(640, 480, (40, 200, 40))), ('dup.jpg', photo), ('broken.jpg', b'not an image')
+    ])
+
+    assert resizer.process_archive(record)['status'] == 'processed'
+
+    table = resizer.dynamodb.table
+    results = {result['name']: result for result in table.items[JOB_KEY]['results']}
+    assert results['dup.jpg']['status'] == 'deduplicated'
+    assert results['broken.jpg']['status'] == 'error'
+    rows = {row['original_name']: row for row in image_rows(table)}
+    assert rows['dup.jpg']['deduplicated_from'] == rows['a.jpg']['image_id']
+    assert rows['dup.jpg']['renditions'] == rows['a.jpg']['renditions']
+    assert summary(table)['image_count'] == 3
+    members = [key for bucket, key in resizer.s3.objects if key.startswith(resizer.ARCHIVE_MEMBER_PREFIX)]
+    assert len(members) == 3
+    assert not any(key.endswith('broken.jpg') for key in members)
+
+def test_a_retried_checkpoint_counts_members_once(resizer):
+    record = upload_archive(resizer, [(f"{index}.jpg", jpeg(320, 240, (index * 40, 90, 90))) for index in range(5)])
+    assert resizer.process_archive(record)['status'] == 'processed'
+    table = resizer.dynamodb.table
+    before = summary(table)
+
+    # An invocation that wrote its rows but died before saving the job is resumed
+    table.update_item(Key={'image_id': JOB_KEY}, UpdateExpression='SET next_member = :zero, #status = :importing',
+                      ExpressionAttributeNames={'#status': 'status'},
+                      ExpressionAttributeValues={':zero': 0, ':importing': 'importing'})
+    assert resizer.process_archive(record)['status'] == 'processed'
+
+    after = summary(table)
+    assert after['image_count'] == before['image_count'] == 5
+    assert after['original_bytes'] == before['original_bytes']
+    assert after['thumbnail_bytes'] == before['thumbnail_bytes']
+    assert len(image_rows(table)) == 5
+
+def test_a_stale_cursor_stops_the_import(resizer):
+    record = upload_archive(resizer, [(f"{index}.jpg", jpeg(320, 240, (90, index * 40, 90))) for index in range(3)])
+    table = resizer.dynamodb.table
+    checkpoint = resizer.checkpoint_archive
+    written = []
+
+    def overlapping_checkpoint(job, user_id, rows, results, saved_cursor):
+        # Another invocation saved the job at member 2 after this one loaded it at 0
+        table.put_item(Item={**job, 'next_member': 2})
+        written.extend(rows)
+        return checkpoint(job, user_id, rows, results, 0)
+
+    resizer.checkpoint_archive = overlapping_checkpoint
+    assert resizer.process_archive(record)['status'] == 'duplicate'
+    assert table.items[JOB_KEY]['next_member'] == 2
+    assert summary(table)['image_count'] == len(written) == 3
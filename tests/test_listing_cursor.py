@@ -0,0 +1,57 @@
+"""Listing cursors are only accepted for the listing they were issued for."""
+import base64
+import json
+
+import pytest
+
+from corpus import encode_synthetic
+
+IMAGES_BUCKET = 'test-images'
+
+def list_images(api, user_id, **params):
+    response = api.lambda_handler({
+        'httpMethod': 'GET',
+        'resource': '/api/user/{user_id}/images',
+        'pathParameters': {'user_id': user_id},
+        'queryStringParameters': params,
+        'headers': {}
+    }, None)
+    return response['statusCode'], json.loads(response['body'])
+
+def make_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+@pytest.fixture
+def pages(resizer, api):
+    for index in range(3):
+        payload, content_type, _ = encode_synthetic('jpeg', 0.1, seed=index)
+        resizer.s3.add_object(IMAGES_BUCKET, f"{index}.jpg", payload, content_type,
+                              {'user-id': 'alice', 'upload-time': f"2024-05-0{index + 1}T00:00:00"})
+        resizer.process_record({'s3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': f"{index}.jpg"}}})
+    status, body = list_images(api, 'alice', limit='1')
+    assert status == 200
+    return body
+
+def test_a_cursor_pages_through_its_own_listing(api, pages):
+    status, body = list_images(api, 'alice', limit='1', cursor=pages['next_cursor'])
+    assert status == 200
+    assert body['images'][0]['id'] != pages['images'][0]['id']
+
+def test_a_cursor_of_another_user_is_rejected(api, pages):
+    status, body = list_images(api, 'mallory', limit='1', cursor=pages['next_cursor'])
+    assert status == 400
+    assert body['error'] == 'Invalid pagination parameters'
+
+@pytest.mark.parametrize('key', [
+    {'image_id': 'x'},
+    {'image_id': 'x', 'user_id': 'alice', 'upload_time': '2024', 'status': 'processed'},
+    {'image_id': 'x', 'user_id': 'alice', 'upload_time': 7},
+    ['image_id'],
+])
+def test_a_malformed_cursor_is_rejected(api, pages, key):
+    status, _ = list_images(api, 'alice', cursor=make_cursor(key))
+    assert status == 400
+
+def test_a_cursor_that_is_not_base64_json_is_rejected(api, pages):
+    status, _ = list_images(api, 'alice', cursor='not a cursor!')
+    assert status == 400
@@ -0,0 +1,52 @@
+"""The near-duplicate index: one entry item per image and band, and failed index writes."""
+
+from corpus import encode_synthetic
+from metadata_table import PHASH_BANDS, PHASH_PREFIX
+
+IMAGES_BUCKET = 'test-images'
+
+def s3_record(key, etag):
+    return {'s3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': key, 'eTag': etag}}}
+
+def upload(resizer, key, seed_scale):
+    payload, content_type, _ = encode_synthetic('jpeg', seed_scale)
+    resizer.s3.add_object(IMAGES_BUCKET, key, payload, content_type, {'user-id': 'alice'})
+    return s3_record(key, resizer.s3.head_object(Bucket=IMAGES_BUCKET, Key=key)['ETag'])
+
+def index_entries(table):
+    return [item for key, item in table.items.items() if key.startswith(PHASH_PREFIX)]
+
+def test_every_image_gets_one_entry_per_band(resizer):
+    table = resizer.dynamodb.table
+    first = resizer.process_record(upload(resizer, 'one.jpg', 0.3))
+    second = resizer.process_record(upload(resizer, 'two.jpg', 0.5))
+
+    entries = index_entries(table)
+    assert len(entries) == 2 * PHASH_BANDS
+    for result in (first, second):
+        row = table.items[result['image_id']]
+        mine = [entry for entry in entries if entry['target_image_id'] == result['image_id']]
+        assert {entry['phash'] for entry in mine} == {row['phash']}
+        assert len({entry['phash_band'] for entry in mine}) == PHASH_BANDS
+
+def test_a_failed_index_write_is_flagged_and_repaired_by_reprocess(resizer, monkeypatch):
+    table = resizer.dynamodb.table
+    record = upload(resizer, 'photo.jpg', 0.3)
+
+    def unavailable(**kwargs):
+        raise RuntimeError('ProvisionedThroughputExceededException')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(resizer.dynamodb, 'batch_write_item', unavailable)
+        result = resizer.process_record(record)
+
+    assert result['status'] == 'processed'
+    row = table.items[result['image_id']]
+    assert row['phash_index_status'] == 'error'
+    assert 'ProvisionedThroughput' in row['phash_index_error']
+    assert index_entries(table) == []
+
+    resizer.process_record(record, reprocess=True)
+
+    assert len(index_entries(table)) == PHASH_BANDS
+    assert 'phash_index_status' not in table.items[result['image_id']]
@@ -0,0 +1,54 @@
+"""Reprocessing rows written before image IDs were derived from the S3 ETag.
+
+Runs the resizer in-process against the benchmark fakes:
+
+    python -m pytest tests
+"""
+import uuid
+
+import pytest
+
+from corpus import encode_synthetic
+from metadata_table import status_row_id, stored_thumbnail_bytes, user_summary_id
+
+IMAGES_BUCKET = 'test-images'
+
+def s3_record(key, etag):
+    return {'s3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': key, 'eTag': etag}}}
+
+def image_rows(table, user_id):
+    return [item for item in table.items.values() if item.get('user_id') == user_id]
+
+@pytest.mark.parametrize('keep_status_row', [True, False])
+def test_reprocess_reuses_a_random_id_row(resizer, keep_status_row):
+    table = resizer.dynamodb.table
+    payload, content_type, _ = encode_synthetic('jpeg', 0.3)
+    resizer.s3.add_object(IMAGES_BUCKET, 'photo.jpg', payload, content_type, {'user-id': 'alice'})
+    etag = resizer.s3.head_object(Bucket=IMAGES_BUCKET, Key='photo.jpg')['ETag']
+    assert resizer.process_record(s3_record('photo.jpg', etag))['status'] == 'processed'
+
+    # Move the row to a random ID, as the resizer wrote them before uuid5 IDs
+    (row,) = image_rows(table, 'alice')
+    legacy_id = str(uuid.uuid4())
+    table.delete_item(Key={'image_id': row['image_id']})
+    table.put_item(Item={**row, 'image_id': legacy_id})
+    status_key = status_row_id('alice', 'photo.jpg')
+    if keep_status_row:
+        table.update_item(Key={'image_id': status_key}, UpdateExpression='SET target_image_id = :id',
+                          ExpressionAttributeValues={':id': legacy_id})
+    else:
+        table.delete_item(Key={'image_id': status_key})
+    summary_key = {'image_id': user_summary_id('alice')}
+    before = table.get_item(Key=summary_key)['Item']
+
+    result = resizer.process_record(s3_record('photo.jpg', etag), reprocess=True)
+
+    assert result['status'] == 'processed'
+    assert result['image_id'] == legacy_id
+    (reprocessed,) = image_rows(table, 'alice')
+    assert reprocessed['image_id'] == legacy_id
+    summary = table.get_item(Key=summary_key)['Item']
+    assert summary['image_count'] == before['image_count'] == 1
+    assert summary['original_bytes'] == before['original_bytes']
+    assert summary['thumbnail_bytes'] == stored_thumbnail_bytes(reprocessed)
+    assert table.get_item(Key={'image_id': status_key})['Item']['target_image_id'] == legacy_id
@@ -0,0 +1,28 @@
+"""The fake table's GSIs match the ones terraform creates."""
+import os
+import re
+
+from fakes import FakeTable
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def terraform_indexes():
+    """name -> (hash key, range key, projected attributes or None for ALL) of the metadata table's GSIs"""
+    with open(os.path.join(REPO_ROOT, 'terraform', 'main.tf')) as terraform:
+        source = terraform.read()
+    indexes = {}
+    for block in re.findall(r'global_secondary_index \{(.*?)\n  \}', source, re.DOTALL):
+        fields = dict(re.findall(r'(\w+)\s*=\s*"([^"]*)"', block))
+        included = re.search(r'non_key_attributes\s*=\s*\[(.*?)\]', block, re.DOTALL)
+        indexes[fields['name']] = (
+            fields['hash_key'], fields.get('range_key'),
+            sorted(re.findall(r'"([^"]+)"', included.group(1))) if included else None
+        )
+    return indexes
+
+def test_fake_indexes_match_terraform():
+    fake = {
+        name: (index.hash_key, index.range_key, sorted(index.projection) if index.projection is not None else None)
+        for name, index in FakeTable().indexes.items()
+    }
+    assert fake == terraform_indexes()
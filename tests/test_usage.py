@@ -0,0 +1,41 @@
+"""Usage totals when identical uploads share rendition objects."""
+import json
+
+from corpus import encode_synthetic
+from metadata_table import user_summary_id
+
+IMAGES_BUCKET = 'test-images'
+
+def upload(resizer, key, payload, content_type):
+    resizer.s3.add_object(IMAGES_BUCKET, key, payload, content_type, {'user-id': 'alice'})
+    etag = resizer.s3.head_object(Bucket=IMAGES_BUCKET, Key=key)['ETag']
+    return resizer.process_record({'s3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': key, 'eTag': etag}}})
+
+def thumbnail_bytes(resizer):
+    return resizer.dynamodb.table.items[user_summary_id('alice')]['thumbnail_bytes']
+
+def delete(api, image_id):
+    response = api.lambda_handler({
+        'httpMethod': 'DELETE',
+        'resource': '/api/user/{user_id}/images/{image_id}',
+        'pathParameters': {'user_id': 'alice', 'image_id': image_id}
+    }, None)
+    assert response['statusCode'] == 200, json.loads(response['body'])
+
+def stored_thumbnail_objects(resizer):
+    return sum(len(stored['Body']) for (bucket, _), stored in resizer.s3.objects.items()
+               if bucket == resizer.THUMBNAIL_BUCKET)
+
+def test_identical_uploads_count_their_renditions_once(resizer, api):
+    payload, content_type, _ = encode_synthetic('jpeg', 0.3)
+    first = upload(resizer, 'first.jpg', payload, content_type)
+    second = upload(resizer, 'second.jpg', payload, content_type)
+    assert second['status'] == 'deduplicated'
+    assert thumbnail_bytes(resizer) == stored_thumbnail_objects(resizer) > 0
+
+    # The copy still references the renditions, so they stay stored and counted
+    delete(api, first['image_id'])
+    assert thumbnail_bytes(resizer) == stored_thumbnail_objects(resizer) > 0
+
+    delete(api, second['image_id'])
+    assert thumbnail_bytes(resizer) == stored_thumbnail_objects(resizer) == 0